@@ -0,0 +1,152 @@
+"""Сравнение конкурентной отдачи файлов: WSGI (file_detail) против ASGI (stream/).
+
+Оба приложения вызываются в процессе, без сети. Каждый клиент «медленный»:
+на каждые полученные 64 КиБ он тратит ``--delay`` секунд. WSGI-путь
+обслуживается пулом из ``--workers`` потоков, как sync-воркеры gunicorn,
+ASGI-путь - одним циклом событий.
+
+    python benchmarks/bench_async_downloads.py --clients 200 --workers 9
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Клиент «читает» 64 КиБ за --delay секунд, независимо от размера блоков ответа
+CLIENT_WINDOW = 64 * 1024
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+
+def setup_django(workdir):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    os.environ['DB_ENGINE'] = 'common.sqlite3'
+    os.environ['DB_NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.MEDIA_ROOT = os.path.join(workdir, 'media')
+    settings.STORAGE_DELIVERY_MODE = 'django'
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def create_fixture(size):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+    from storage import blobs
+    from storage.models import UserFile
+    from users.models import CustomUser
+
+    user = CustomUser.objects.create_user(
+        username='bench', email='bench@example.com', password='Bench123!', full_name='Bench')
+    blob = blobs.ingest_file(SimpleUploadedFile('bench.bin', os.urandom(size)))
+    file = UserFile.objects.create(user=user, original_name='bench.bin', blob=blob,
+                                   file=blob.file.name, sha256=blob.sha256)
+    client = Client()
+    client.force_login(user)
+    return file, f"sessionid={client.cookies['sessionid'].value}"
+
+
+def run_wsgi(path, cookie, clients, workers, delay):
+    from config.wsgi import application
+
+    def download():
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost',
+            'HTTP_COOKIE': cookie, 'wsgi.input': io.BytesIO(), 'wsgi.url_scheme': 'http',
+        }
+        received = 0
+        result = application(environ, lambda status, headers: None)
+        try:
+            for block in result:
+                received += len(block)
+                time.sleep(delay * len(block) / CLIENT_WINDOW)
+        finally:
+            result.close()
+        return received
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        received = sum(pool.map(lambda _: download(), range(clients)))
+    return received, time.perf_counter() - started
+
+
+def run_asgi(path, cookie, clients, delay):
+    from config.asgi import application
+
+    async def download():
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+            'root_path': '', 'headers': [(b'host', b'localhost'), (b'cookie', cookie.encode())],
+            'server': ('localhost', 80), 'client': ('127.0.0.1', 50000),
+        }
+        finished = asyncio.Event()
+        received = 0
+
+        async def receive():
+            if not finished.is_set():
+                finished.set()
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Future()
+
+        async def send(message):
+            nonlocal received
+            if message['type'] == 'http.response.body':
+                body = message.get('body', b'')
+                received += len(body)
+                await asyncio.sleep(delay * len(body) / CLIENT_WINDOW)
+
+        await application(scope, receive, send)
+        return received
+
+    async def main():
+        return sum(await asyncio.gather(*(download() for _ in range(clients))))
+
+    started = time.perf_counter()
+    received = asyncio.run(main())
+    return received, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=9, help='число sync-воркеров для WSGI-пути')
+    parser.add_argument('--size', type=int, default=1024 * 1024, help='размер файла в байтах')
+    parser.add_argument('--delay', type=float, default=0.01, help='время клиента на каждые 64 КиБ, с')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mycloud-bench-')
+    try:
+        setup_django(workdir)
+        file, cookie = create_fixture(args.size)
+        results = {}
+        for name, run in (
+            ('wsgi', lambda: run_wsgi(f'/api/storage/{file.pk}/', cookie, args.clients, args.workers, args.delay)),
+            ('asgi', lambda: run_asgi(f'/api/storage/stream/{file.pk}/', cookie, args.clients, args.delay)),
+        ):
+            received, elapsed = run()
+            results[name] = {
+                'seconds': round(elapsed, 3),
+                'requests_per_second': round(args.clients / elapsed, 2),
+                'megabytes_per_second': round(received / elapsed / 1024 / 1024, 2),
+            }
+        print(json.dumps({'benchmark': 'concurrent_downloads', 'params': vars(args), 'results': results}, indent=2))
+
+        from storage import bookkeeping
+        bookkeeping.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Стоимость аутентификации запроса к API: сессия в БД против подписанного токена.
+
+Один и тот же запрос (GET /api/storage/?limit=1) выполняется через полный
+стек middleware и DRF в процессе, без сети. Считаются время на запрос и
+число SQL-запросов: один из них - сам список файлов, остальное - аутентификация
+(для сессии SELECT сессии и пользователя, для токена с прогретым кэшем - ничего).
+
+    python benchmarks/bench_auth.py --requests 2000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+PATH = '/api/storage/?limit=1'
+
+
+def setup_django(workdir):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    os.environ['DB_ENGINE'] = 'common.sqlite3'
+    os.environ['DB_NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.MEDIA_ROOT = os.path.join(workdir, 'media')
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def run(client, requests, **headers):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for _ in range(requests):
+            response = client.get(PATH, HTTP_HOST='localhost', **headers)
+            assert response.status_code == 200, response.status_code
+        elapsed = time.perf_counter() - started
+    return {
+        'microseconds_per_request': round(elapsed / requests * 1e6, 1),
+        'requests_per_second': round(requests / elapsed, 1),
+        'queries_per_request': round(len(queries) / requests, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mycloud-bench-')
+    try:
+        setup_django(workdir)
+        from django.conf import settings
+        from django.test import Client
+        from users import tokens
+        from users.models import CustomUser
+
+        user = CustomUser.objects.create_user(
+            username='bench', email='bench@example.com', password='Bench123!', full_name='Bench')
+        session_client = Client()
+        session_client.force_login(user)
+        bearer = {'HTTP_AUTHORIZATION': f"Bearer {tokens.issue_tokens(user)['access_token']}"}
+
+        results = {'session': run(session_client, args.requests)}
+        cache_ttl = settings.AUTH_TOKEN_USER_CACHE_TTL
+        settings.AUTH_TOKEN_USER_CACHE_TTL = 0
+        results['token_without_cache'] = run(Client(), args.requests, **bearer)
+        settings.AUTH_TOKEN_USER_CACHE_TTL = cache_ttl
+        results['token'] = run(Client(), args.requests, **bearer)
+
+        print(json.dumps({'benchmark': 'api_authentication', 'params': vars(args), 'results': results}, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Сериализация списка файлов: FileSerializer(many=True) против FileListSerializer.
+
+Для каждого размера таблицы весь список пользователя читается из БД,
+сериализуется и рендерится в JSON так же, как в file_list: FileSerializer
+с JSONRenderer (запрос владельца на каждую строку) и FileListSerializer
+(``values()`` с JOIN) с FastJSONRenderer. Считаются строки в секунду по лучшему
+из ``--runs`` прогонов; байты ответа у обоих вариантов совпадают.
+
+    python benchmarks/bench_listing.py --rows 10000 100000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+
+def setup_django(workdir):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    os.environ['DB_ENGINE'] = 'common.sqlite3'
+    os.environ['DB_NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.MEDIA_ROOT = os.path.join(workdir, 'media')
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def fill(user, rows):
+    from django.utils import timezone
+    from storage.models import UserFile
+
+    UserFile.objects.all().delete()
+    now = timezone.now()
+    UserFile.objects.bulk_create((
+        UserFile(user=user, original_name=f'file_{i}.txt', file=f'user_{user.pk}/ab/cd/{uuid.uuid4()}_file_{i}.txt',
+                 size=i, comment='комментарий' if i % 3 == 0 else '', preview='p.jpg' if i % 5 == 0 else '',
+                 last_downloaded_at=now if i % 2 else None, uploaded_at=now)
+        for i in range(rows)), batch_size=5000)
+
+
+def render_file_serializer(request, queryset):
+    from rest_framework.renderers import JSONRenderer
+    from storage.serializers import FileSerializer
+
+    return JSONRenderer().render(FileSerializer(queryset, many=True, context={'request': request}).data)
+
+
+def render_file_list_serializer(request, queryset):
+    from common.renderers import FastJSONRenderer
+    from storage.serializers import FileListSerializer
+
+    return FastJSONRenderer().render(FileListSerializer(FileListSerializer.columns(queryset),
+                                                        context={'request': request}).data)
+
+
+def measure(render, request, queryset, rows, runs):
+    from django.db import connection
+
+    queries = []
+
+    def count(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    best = None
+    for _ in range(runs):
+        queries.clear()
+        with connection.execute_wrapper(count):
+            started = time.perf_counter()
+            body = render(request, queryset.order_by('-uploaded_at', '-id'))
+            elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return body, {
+        'seconds': round(best, 3),
+        'rows_per_second': round(rows / best),
+        'queries': len(queries),
+        'response_bytes': len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mycloud-bench-')
+    try:
+        setup_django(workdir)
+        from django.test import RequestFactory
+        from storage.models import UserFile
+        from users.models import CustomUser
+
+        user = CustomUser.objects.create_user(
+            username='bench', email='bench@example.com', password='Bench123!', full_name='Bench')
+        request = RequestFactory().get('/api/storage/', HTTP_HOST='localhost')
+        queryset = UserFile.objects.filter(user=user)
+
+        results = {}
+        for rows in args.rows:
+            fill(user, rows)
+            expected, results[f'{rows}_file_serializer'] = measure(
+                render_file_serializer, request, queryset, rows, args.runs)
+            body, results[f'{rows}_file_list_serializer'] = measure(
+                render_file_list_serializer, request, queryset, rows, args.runs)
+            assert body == expected, 'ответы сериализаторов различаются'
+            results[f'{rows}_speedup'] = round(results[f'{rows}_file_serializer']['seconds']
+                                               / results[f'{rows}_file_list_serializer']['seconds'], 1)
+
+        print(json.dumps({'benchmark': 'listing', 'params': vars(args), 'results': results}, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Холодная загрузка оболочки SPA: рендер шаблона на каждый запрос против кеша common.views.home.
+
+Запросы идут через полный стек Django (django.test.Client, все middleware).
+``before`` - прежний ``home``: ``render(request, 'index.html')`` на каждый
+запрос; ``after`` - оболочка, отрендеренная один раз, с ETag; ``revalidate`` -
+повторный заход с If-None-Match (304 без тела). Шаблон - frontend/dist/index.html,
+если фронтенд собран, иначе похожая на вывод html-webpack-plugin заглушка.
+Считаются запросы в секунду и p50 по лучшему из ``--runs`` прогонов.
+
+    python benchmarks/bench_spa.py --requests 5000
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+SHELL = """<!DOCTYPE html>
+<html lang="ru">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>My Cloud Storage</title>
+<script defer src="/static/main.0123456789ab.js"></script></head>
+<body>
+    <div id="root"></div>
+</body>
+</html>
+"""
+
+# URLconf бенчмарка (ROOT_URLCONF='__main__'): оба варианта home рядом
+urlpatterns = []
+
+
+def legacy_home(request):
+    from django.shortcuts import render
+
+    return render(request, 'index.html')
+
+
+def setup_django(workdir):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    os.environ['DB_ENGINE'] = 'common.sqlite3'
+    os.environ['DB_NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ['*']
+    settings.ROOT_URLCONF = '__main__'
+
+    template_dir = os.path.join(BASE_DIR, '..', 'frontend', 'dist')
+    if not os.path.exists(os.path.join(template_dir, 'index.html')):
+        template_dir = os.path.join(workdir, 'dist')
+        os.makedirs(template_dir)
+        with open(os.path.join(template_dir, 'index.html'), 'w') as fh:
+            fh.write(SHELL)
+    settings.TEMPLATES[0]['DIRS'] = [template_dir]
+
+    from django.urls import re_path
+    from common.views import home
+    urlpatterns.extend([re_path(r'^before/', legacy_home), re_path(r'^after/', home)])
+
+
+def measure(client, url, requests, runs, **headers):
+    best = None
+    for _ in range(runs):
+        timings = []
+        started = time.perf_counter()
+        for _ in range(requests):
+            request_started = time.perf_counter()
+            response = client.get(url, **headers)
+            timings.append(time.perf_counter() - request_started)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best[0]:
+            best = elapsed, timings, response
+    elapsed, timings, response = best
+    return response, {
+        'requests_per_second': round(requests / elapsed),
+        'p50_ms': round(statistics.median(timings) * 1000, 3),
+        'status': response.status_code,
+        'response_bytes': len(response.content),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mycloud-bench-')
+    try:
+        setup_django(workdir)
+        from django.test import Client
+
+        client = Client()
+        results = {}
+        before, results['before'] = measure(client, '/before/files/', args.requests, args.runs)
+        after, results['after'] = measure(client, '/after/files/', args.requests, args.runs)
+        assert before.content == after.content, 'оболочки различаются'
+        _, results['revalidate'] = measure(client, '/after/files/', args.requests, args.runs,
+                                           HTTP_IF_NONE_MATCH=after['ETag'])
+        results['speedup'] = round(results['after']['requests_per_second']
+                                   / results['before']['requests_per_second'], 1)
+
+        print(json.dumps({'benchmark': 'spa', 'params': vars(args), 'results': results}, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Дисковый ввод-вывод загрузки файла: обработчики Django против StorageUploadHandler.
+
+POST /api/storage/ выполняется через полный WSGI-стек в процессе; тело
+multipart-запроса заранее записано в файл и читается как wsgi.input. Байты
+считаются по /proc/self/io (rchar/wchar - все read/write процесса), из
+прочитанного вычитается само тело запроса. Режимы: с дедупликацией (блобы)
+и без нее (файл в каталоге пользователя).
+
+    python benchmarks/bench_uploads.py --size-mb 1024
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+BLOCK = 1024 * 1024
+
+
+def setup_django(workdir):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    os.environ['DB_ENGINE'] = 'common.sqlite3'
+    os.environ['DB_NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    import django
+    from django.conf import settings
+    django.setup()
+    settings.MEDIA_ROOT = os.path.join(workdir, 'media')
+    settings.FILE_UPLOAD_TEMP_DIR = workdir
+    settings.STORAGE_PREVIEWS_ENABLED = False
+    settings.METRICS_ENABLED = False
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def write_body(path, size):
+    """multipart/form-data с одним полем file из ``size`` случайных байтов; возвращает boundary."""
+    boundary = uuid.uuid4().hex
+    with open(path, 'wb') as fh:
+        fh.write(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        for offset in range(0, size, BLOCK):
+            fh.write(os.urandom(min(BLOCK, size - offset)))
+        fh.write(f'\r\n--{boundary}--\r\n'.encode())
+    return boundary
+
+
+def process_io():
+    with open('/proc/self/io') as fh:
+        values = dict(line.split(': ') for line in fh.read().splitlines())
+    return int(values['rchar']), int(values['wchar'])
+
+
+def upload(handler, body_path, boundary, token):
+    size = os.path.getsize(body_path)
+    status = []
+    with open(body_path, 'rb') as body:
+        environ = {
+            'REQUEST_METHOD': 'POST', 'PATH_INFO': '/api/storage/', 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'localhost', 'HTTP_AUTHORIZATION': f'Bearer {token}',
+            'CONTENT_TYPE': f'multipart/form-data; boundary={boundary}', 'CONTENT_LENGTH': str(size),
+            'wsgi.input': body, 'wsgi.url_scheme': 'http', 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        result = handler(environ, lambda code, headers: status.append(code))
+        b''.join(result)
+        result.close()
+    assert status[0].startswith('201'), status
+    return size
+
+
+def run(handler, body_path, boundary, token, user):
+    from storage.models import UserFile
+
+    read_before, written_before = process_io()
+    started = time.perf_counter()
+    body_size = upload(handler, body_path, boundary, token)
+    elapsed = time.perf_counter() - started
+    read_after, written_after = process_io()
+    UserFile.objects.filter(user=user).delete_with_storage()
+    return {
+        'seconds': round(elapsed, 2),
+        'megabytes_per_second': round(body_size / elapsed / BLOCK, 1),
+        'megabytes_read_besides_request_body': round((read_after - read_before - body_size) / BLOCK, 1),
+        'megabytes_written': round((written_after - written_before) / BLOCK, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=1024)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mycloud-bench-')
+    try:
+        setup_django(workdir)
+        from django.conf import settings
+        from django.core.handlers.wsgi import WSGIHandler
+        from users import tokens
+        from users.models import CustomUser
+
+        user = CustomUser.objects.create_user(
+            username='bench', email='bench@example.com', password='Bench123!', full_name='Bench')
+        token = tokens.issue_tokens(user)['access_token']
+        body_path = os.path.join(workdir, 'body')
+        boundary = write_body(body_path, args.size_mb * BLOCK)
+        handler = WSGIHandler()
+
+        results = {}
+        for deduplicate in (True, False):
+            settings.STORAGE_DEDUPLICATE = deduplicate
+            mode = 'blobs' if deduplicate else 'user_directory'
+            for direct in (False, True):
+                settings.STORAGE_DIRECT_UPLOADS = direct
+                key = f"{mode}_{'storage_upload_handler' if direct else 'django_handlers'}"
+                results[key] = run(handler, body_path, boundary, token, user)
+
+        print(json.dumps({'benchmark': 'upload_io', 'params': vars(args), 'results': results}, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""Набор нагрузочных и микробенчмарков для API хранилища и авторизации.
+
+Сценарии: загрузка по размерам файлов, скачивание (пропускная способность и
+перцентили задержки), file_list в зависимости от числа строк, частота входов
+и смешанная конкурентная нагрузка. Результат - плоский JSON с метриками; с
+``--baseline`` он сравнивается с сохраненным базовым прогоном, и при
+регрессии больше ``--tolerance`` скрипт завершается с кодом 1. Ошибки
+запросов (``*_errors``) в базовый прогон не попадают: любая ошибка - тоже код 1.
+
+По умолчанию все выполняется в процессе через django.test.Client на временной
+SQLite-базе. С ``--url`` запросы идут по HTTP к уже запущенному серверу, а
+пользователи и строки для file_list создаются через ORM - поэтому скрипт
+нужно запускать с тем же окружением (.env, DB_*), что и сервер. Созданные
+данные удаляются в конце.
+
+Базовый прогон (benchmarks/baseline.json) имеет смысл только на той машине,
+где он снят: при смене железа его нужно пересохранить.
+
+    python benchmarks/suite.py --quick --baseline benchmarks/baseline.json
+    python benchmarks/suite.py --url http://127.0.0.1:8000 --output results.json
+    python benchmarks/suite.py --quick --runs 3 --save-baseline benchmarks/baseline.json
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+PASSWORD = 'Bench123!'
+
+# Метрики, у которых лучше меньшее значение; у остальных - большее
+LOWER_IS_BETTER = ('_ms',)
+
+# Ошибки не сравниваются с базовым прогоном и не сохраняются в него: любая ошибка - провал
+ERRORS = '_errors'
+
+# p99 на десятках замеров слишком шумный, чтобы по нему отклонять сборку
+NOT_COMPARED = ('.p99_ms',)
+
+
+def setup_django(workdir):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    if workdir:
+        os.environ['DB_ENGINE'] = 'common.sqlite3'
+        os.environ['DB_NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    import django
+    from django.conf import settings
+    django.setup()
+    if workdir:
+        # Смешанная нагрузка пишет из нескольких потоков: WAL и ожидание блокировки вместо ошибки
+        from django.db.backends.signals import connection_created
+        settings.DATABASES['default']['OPTIONS'] = {'timeout': 30}
+        connection_created.connect(
+            lambda connection, **kwargs: connection.cursor().execute('PRAGMA journal_mode=WAL'), weak=False)
+        settings.MEDIA_ROOT = os.path.join(workdir, 'media')
+        settings.STORAGE_DELIVERY_MODE = 'django'
+        settings.STORAGE_PREVIEWS_ENABLED = False
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+
+
+class InProcessClient:
+    """Запросы через полный стек Django в этом же процессе."""
+
+    def __init__(self):
+        from django.test import Client
+        self.client = Client(raise_request_exception=False, HTTP_HOST='localhost')
+
+    def login(self, username):
+        response = self.client.post('/api/auth/login/', {'username': username, 'password': PASSWORD},
+                                    content_type='application/json')
+        return response.status_code
+
+    def get(self, path):
+        response = self.client.get(path)
+        if response.streaming:
+            return response.status_code, sum(len(block) for block in response.streaming_content)
+        return response.status_code, len(response.content)
+
+    def upload(self, name, content):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        response = self.client.post('/api/storage/', {'file': SimpleUploadedFile(name, content)})
+        return response.status_code, response.json().get('id') if response.status_code == 201 else None
+
+
+class HttpClient:
+    """Те же запросы по HTTP к запущенному серверу; авторизация - access-токен."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = (http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection)(
+            parts.hostname, parts.port)
+        self.headers = {}
+
+    def login(self, username):
+        body = json.dumps({'username': username, 'password': PASSWORD, 'session': False})
+        self.connection.request('POST', '/api/auth/login/', body=body, headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        data = json.loads(response.read() or b'{}')
+        if response.status == 200:
+            self.headers = {'Authorization': f"Bearer {data['access_token']}"}
+        return response.status
+
+    def get(self, path):
+        self.connection.request('GET', path, headers=self.headers)
+        response = self.connection.getresponse()
+        size = 0
+        while block := response.read(64 * 1024):
+            size += len(block)
+        return response.status, size
+
+    def upload(self, name, content):
+        boundary = uuid.uuid4().hex
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+        self.connection.request('POST', '/api/storage/', body=body, headers={
+            **self.headers, 'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        response = self.connection.getresponse()
+        body = response.read()
+        return response.status, json.loads(body)['id'] if response.status == 201 else None
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+        self.prefix = f'bench_{uuid.uuid4().hex[:8]}'
+        self.users = []
+
+    def client(self, username=None):
+        client = HttpClient(self.args.url) if self.args.url else InProcessClient()
+        if username:
+            status = client.login(username)
+            if status != 200:
+                raise RuntimeError(f'Не удалось войти как {username}: {status}')
+        return client
+
+    def create_user(self, suffix):
+        from users.models import CustomUser
+        username = f'{self.prefix}_{suffix}'
+        user = CustomUser.objects.create_user(
+            username=username, email=f'{username}@example.com', password=PASSWORD, full_name='Benchmark')
+        self.users.append(user)
+        return user
+
+    def cleanup(self):
+        from django.db import transaction
+        from storage.models import UserFile
+        for user in self.users:
+            with transaction.atomic():
+                UserFile.objects.filter(user=user).delete_with_storage()
+                user.delete()
+
+    def record(self, name, value):
+        self.results[name] = round(value, 3)
+
+    def record_latencies(self, name, seconds):
+        milliseconds = sorted(value * 1000 for value in seconds)
+        quantiles = statistics.quantiles(milliseconds, n=100, method='inclusive')
+        self.record(f'{name}.p50_ms', quantiles[49])
+        self.record(f'{name}.p95_ms', quantiles[94])
+        self.record(f'{name}.p99_ms', quantiles[98])
+
+    def upload(self):
+        user = self.create_user('upload')
+        client = self.client(user.username)
+        for size in self.args.sizes:
+            count = max(3, min(200, self.args.volume // size))
+            payloads = [os.urandom(size) for _ in range(count)]
+            started = time.perf_counter()
+            for i, payload in enumerate(payloads):
+                status, _ = client.upload(f'upload_{size}_{i}.bin', payload)
+                if status != 201:
+                    raise RuntimeError(f'Загрузка вернула {status}')
+            elapsed = time.perf_counter() - started
+            self.record(f'upload.{size}.mb_per_s', size * count / elapsed / 1024 / 1024)
+            self.record(f'upload.{size}.files_per_s', count / elapsed)
+
+    def download(self):
+        user = self.create_user('download')
+        client = self.client(user.username)
+        for size in self.args.sizes:
+            status, file_id = client.upload(f'download_{size}.bin', os.urandom(size))
+            count = max(5, min(200, self.args.volume // size))
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(count):
+                request_started = time.perf_counter()
+                status, received = client.get(f'/api/storage/{file_id}/')
+                latencies.append(time.perf_counter() - request_started)
+                if status != 200 or received != size:
+                    raise RuntimeError(f'Скачивание вернуло {status}, {received} байт')
+            elapsed = time.perf_counter() - started
+            self.record(f'download.{size}.mb_per_s', size * count / elapsed / 1024 / 1024)
+            self.record_latencies(f'download.{size}', latencies)
+
+    def file_list(self):
+        from django.utils import timezone
+        from storage.models import UserFile
+        user = self.create_user('list')
+        client = self.client(user.username)
+        existing = 0
+        now = timezone.now()
+        for rows in self.args.rows:
+            # Строки без файлов на диске: file_list их не читает
+            UserFile.objects.bulk_create(
+                [UserFile(user=user, original_name=f'file_{i}.txt', file=f'{user.storage_path}/file_{i}.txt',
+                          size=random.randint(1, 10 ** 6), uploaded_at=now) for i in range(existing, rows)],
+                batch_size=5000)
+            existing = rows
+            for name, path in (('first_page', '/api/storage/?limit=100'),
+                               ('by_name', '/api/storage/?limit=100&sort=original_name&name=file_5')):
+                latencies = []
+                for _ in range(self.args.repeat):
+                    request_started = time.perf_counter()
+                    status, _ = client.get(path)
+                    latencies.append(time.perf_counter() - request_started)
+                    if status != 200:
+                        raise RuntimeError(f'file_list вернул {status}')
+                self.record_latencies(f'file_list.{rows}.{name}', latencies)
+
+    def login(self):
+        user = self.create_user('login')
+        count = self.args.logins
+        started = time.perf_counter()
+        latencies = []
+        for _ in range(count):
+            client = self.client()
+            request_started = time.perf_counter()
+            status = client.login(user.username)
+            latencies.append(time.perf_counter() - request_started)
+            if status != 200:
+                raise RuntimeError(f'Вход вернул {status}')
+        self.record('login.per_s', count / (time.perf_counter() - started))
+        self.record_latencies('login', latencies)
+
+    def mixed(self):
+        """Потоки с долями 70% список / 20% скачивание / 10% загрузка, каждый под своим пользователем."""
+        workers = self.args.concurrency
+        clients = []
+        for n in range(workers):
+            user = self.create_user(f'mixed{n}')
+            client = self.client(user.username)
+            _, file_id = client.upload('mixed.bin', os.urandom(256 * 1024))
+            clients.append((client, file_id))
+
+        latencies = {'list': [], 'download': [], 'upload': []}
+        errors = []
+        lock = threading.Lock()
+        deadline = time.perf_counter() + self.args.duration
+
+        def work(n):
+            client, file_id = clients[n]
+            rng = random.Random(n)
+            local = {key: [] for key in latencies}
+            failures = 0
+            while time.perf_counter() < deadline:
+                choice = rng.random()
+                started = time.perf_counter()
+                if choice < 0.7:
+                    kind, status = 'list', client.get('/api/storage/?limit=50')[0]
+                elif choice < 0.9:
+                    kind, status = 'download', client.get(f'/api/storage/{file_id}/')[0]
+                else:
+                    kind, status = 'upload', client.upload('mixed_upload.bin', os.urandom(64 * 1024))[0]
+                local[kind].append(time.perf_counter() - started)
+                failures += status >= 400
+            with lock:
+                for key, values in local.items():
+                    latencies[key].extend(values)
+                errors.append(failures)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(work, range(workers)))
+        elapsed = time.perf_counter() - started
+        total = sum(len(values) for values in latencies.values())
+        self.record('mixed.requests_per_s', total / elapsed)
+        self.record('mixed.total_errors', sum(errors))
+        for kind, values in latencies.items():
+            if len(values) >= 2:
+                self.record_latencies(f'mixed.{kind}', values)
+
+
+def compare(results, baseline, tolerance):
+    """Метрики, ухудшившиеся относительно базового прогона больше чем на ``tolerance``, и ненулевые ошибки."""
+    regressions = [{'metric': name, 'baseline': 0, 'current': value, 'change': 1.0}
+                   for name, value in results.items() if name.endswith(ERRORS) and value > 0]
+    for name, expected in baseline.get('results', {}).items():
+        actual = results.get(name)
+        if actual is None or name.endswith(NOT_COMPARED + (ERRORS,)):
+            continue
+        lower_is_better = name.endswith(LOWER_IS_BETTER)
+        if not expected:
+            change = 1.0 if (actual > 0 if lower_is_better else actual < 0) else 0.0
+        else:
+            change = (actual - expected) / expected
+        if (change > tolerance) if lower_is_better else (change < -tolerance):
+            regressions.append({'metric': name, 'baseline': expected, 'current': actual,
+                                'change': round(change, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='адрес запущенного сервера; без него - в процессе')
+    parser.add_argument('--quick', action='store_true', help='меньшие объемы для быстрой проверки')
+    parser.add_argument('--scenarios', default='upload,download,file_list,login,mixed')
+    parser.add_argument('--output', help='куда записать JSON с результатами (по умолчанию stdout)')
+    parser.add_argument('--baseline', help='JSON базового прогона для сравнения')
+    parser.add_argument('--save-baseline', help='сохранить результаты как базовый прогон')
+    parser.add_argument('--runs', type=int, default=1, help='повторов; берется медиана каждой метрики')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='допустимое ухудшение, доля')
+    args = parser.parse_args()
+
+    args.sizes = [4 * 1024, 1024 * 1024] if args.quick else [4 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+    args.volume = 16 * 1024 * 1024 if args.quick else 128 * 1024 * 1024
+    args.rows = [1000, 10000] if args.quick else [1000, 10000, 100000]
+    args.repeat = 30 if args.quick else 100
+    args.logins = 5 if args.quick else 20
+    args.concurrency = 4 if args.quick else 8
+    args.duration = 3 if args.quick else 15
+
+    workdir = None if args.url else tempfile.mkdtemp(prefix='mycloud-bench-')
+    try:
+        setup_django(workdir)
+        import django
+        from storage import bookkeeping
+        runs = []
+        # Представления пишут отладочные print; stdout остается под JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            for _ in range(max(1, args.runs)):
+                bench = Bench(args)
+                try:
+                    for scenario in args.scenarios.split(','):
+                        getattr(bench, scenario.strip())()
+                finally:
+                    bench.cleanup()
+                    bookkeeping.flush()
+                runs.append(bench.results)
+        results = {name: round(statistics.median(run[name] for run in runs if name in run), 3) for name in runs[0]}
+
+        report = {
+            'benchmark': 'suite',
+            'params': {'url': args.url, 'quick': args.quick, 'scenarios': args.scenarios, 'runs': args.runs},
+            'environment': {'python': platform.python_version(), 'django': django.get_version(),
+                            'machine': platform.machine(), 'cpus': os.cpu_count()},
+            'results': results,
+        }
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline) as fh:
+                baseline = json.load(fh)
+        report['regressions'] = compare(results, baseline, args.tolerance)
+
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as fh:
+                fh.write(output + '\n')
+        else:
+            print(output)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as fh:
+                baseline = {key: report[key] for key in ('benchmark', 'params', 'environment')}
+                baseline['results'] = {name: value for name, value in results.items() if not name.endswith(ERRORS)}
+                json.dump(baseline, fh, indent=2)
+                fh.write('\n')
+        if report.get('regressions'):
+            sys.exit(1)
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
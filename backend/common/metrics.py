@@ -0,0 +1,178 @@
+"""Счетчики и гистограммы запросов в текстовом формате Prometheus.
+
+Каждый процесс копит значения в памяти. Если задан ``METRICS_DIR``, процесс
+раз в ``METRICS_FLUSH_INTERVAL`` секунд (и при завершении) атомарно
+перезаписывает в нем свой файл ``<pid>_<token>.json`` с накопленными с
+запуска значениями, а /metrics складывает файлы всех процессов - так метрики
+воркеров gunicorn сводятся в одну выдачу. Файлы завершившихся воркеров
+остаются, чтобы счетчики не уменьшались; каталог очищают при деплое, до
+запуска gunicorn. Без ``METRICS_DIR`` /metrics показывает только свой процесс.
+"""
+import atexit
+import glob
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.signals import request_finished
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STREAM_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# имя -> (тип, описание, границы корзин гистограммы)
+METRICS = {
+    'http_requests_total': ('counter', 'Запросы по представлению, методу и статусу', None),
+    'http_request_duration_seconds': ('histogram', 'Время до возврата ответа представлением', DURATION_BUCKETS),
+    'http_request_db_queries': ('histogram', 'SQL-запросов за один HTTP-запрос', QUERY_BUCKETS),
+    'http_db_queries_total': ('counter', 'SQL-запросы', None),
+    'http_db_seconds_total': ('counter', 'Время выполнения SQL-запросов', None),
+    'http_request_bytes_total': ('counter', 'Принятые байты тела запроса', None),
+    'http_response_bytes_total': ('counter', 'Отправленные байты тела ответа', None),
+    'http_response_stream_seconds': ('histogram', 'Время отдачи потокового ответа целиком', STREAM_BUCKETS),
+}
+
+# (имя, метки) -> значение счетчика или [счетчики корзин..., +Inf, сумма]
+_values = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_owner = None
+_token = None
+
+
+def _reset_after_fork():
+    """Воркер после fork начинает с нуля и пишет в собственный файл."""
+    global _owner, _token
+    if _owner != os.getpid():
+        _owner = os.getpid()
+        _token = uuid.uuid4().hex[:8]
+        _values.clear()
+
+
+def inc(name, labels, value=1):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _reset_after_fork()
+        _values[key] = _values.get(key, 0) + value
+
+
+def observe(name, labels, value):
+    buckets = METRICS[name][2]
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _reset_after_fork()
+        entry = _values.get(key)
+        if entry is None:
+            entry = _values[key] = [0] * (len(buckets) + 2)
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        entry[index] += 1
+        entry[-1] += value
+
+
+def _snapshot():
+    with _lock:
+        _reset_after_fork()
+        return [[name, list(labels), value] for (name, labels), value in _values.items()]
+
+
+def flush():
+    """Перезаписывает файл процесса в ``METRICS_DIR``."""
+    global _last_flush
+    _last_flush = time.monotonic()
+    if not settings.METRICS_DIR:
+        return
+    data = _snapshot()
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    path = os.path.join(settings.METRICS_DIR, f'{_owner}_{_token}.json')
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(data, fh)
+    os.replace(f'{path}.tmp', path)
+
+
+def flush_if_due(**kwargs):
+    if settings.METRICS_DIR and time.monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def collect():
+    """Значения всех процессов: ``{(имя, метки): значение}``."""
+    if not settings.METRICS_DIR:
+        return {(name, tuple(map(tuple, labels))): value for name, labels, value in _snapshot()}
+
+    flush()
+    merged = {}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            logger.warning('Не удалось прочитать файл метрик %s', path)
+            continue
+        for name, labels, value in data:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(map(tuple, labels)))
+            if isinstance(value, list):
+                current = merged.setdefault(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Текстовый формат экспозиции Prometheus 0.0.4."""
+    values = collect()
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind == 'counter':
+                lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + (math.inf,), value[:-1]):
+                cumulative += count
+                bound = '+Inf' if math.isinf(bound) else _format_number(bound)
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(value[-1])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except OSError:
+        logger.exception('Не удалось сохранить метрики при завершении процесса')
+
+
+request_finished.connect(flush_if_due, dispatch_uid='common.metrics.flush_if_due')
+atexit.register(_flush_at_exit)
@@ -0,0 +1,146 @@
+import time
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.functional import SimpleLazyObject, empty
+from . import metrics
+
+KNOWN_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+class QueryTimer:
+    """``execute_wrapper``, считающий SQL-запросы и их суммарное время."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    # Имя маршрута, а не путь: число меток не растет с числом файлов и ссылок
+    return match.view_name if match and match.view_name else 'unmatched'
+
+
+def _request_bytes(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def _timer_installed(timer):
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(timer))
+    return stack
+
+
+def _shows_timing(request):
+    """Server-Timing раскрывает число и время SQL-запросов: только в DEBUG и для персонала."""
+    if settings.DEBUG:
+        return True
+    user = getattr(request, 'user', None)
+    if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+        # Представлению пользователь не понадобился: не загружаем его ради заголовка
+        return False
+    return bool(user is not None and user.is_staff)
+
+
+class MetricsMiddleware:
+    """Время, SQL-запросы и трафик каждого запроса: заголовок Server-Timing и common.metrics.
+
+    Стоит первым в MIDDLEWARE, чтобы время включало остальные middleware.
+    Работает и под WSGI, и под ASGI без переходов между потоками на весь запрос.
+    Потоковые ответы досчитываются, когда тело отдано целиком.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with _timer_installed(timer):
+            response = self.get_response(request)
+        return self._record(request, response, timer, started)
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        # ORM из async-кода работает в отдельном потоке со своими соединениями: обертка ставится там
+        stack = await sync_to_async(_timer_installed)(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self._record(request, response, timer, started)
+
+    def _record(self, request, response, timer, started):
+        elapsed = time.perf_counter() - started
+        if _shows_timing(request):
+            response['Server-Timing'] = (f'app;dur={elapsed * 1000:.1f}, '
+                                         f'db;desc="{timer.count} queries";dur={timer.duration * 1000:.1f}')
+
+        view = _view_name(request)
+        method = request.method if request.method in KNOWN_METHODS else 'other'
+        metrics.inc('http_requests_total', {'view': view, 'method': method, 'status': str(response.status_code)})
+        metrics.observe('http_request_duration_seconds', {'view': view, 'method': method}, elapsed)
+        metrics.observe('http_request_db_queries', {'view': view}, timer.count)
+        if timer.count:
+            metrics.inc('http_db_queries_total', {'view': view}, timer.count)
+            metrics.inc('http_db_seconds_total', {'view': view}, timer.duration)
+        received = _request_bytes(request)
+        if received:
+            metrics.inc('http_request_bytes_total', {'view': view}, received)
+
+        if not response.streaming:
+            metrics.inc('http_response_bytes_total', {'view': view}, len(response.content))
+        elif getattr(response, 'file_to_stream', None) is not None:
+            # FileResponse не оборачиваем: сервер отдает такой файл через wsgi.file_wrapper (sendfile)
+            metrics.inc('http_response_bytes_total', {'view': view}, int(response.get('Content-Length', 0)))
+        elif response.is_async:
+            response.streaming_content = self._count_async(response.streaming_content, view, started)
+        else:
+            response.streaming_content = self._count(response.streaming_content, view, started)
+        return response
+
+    @staticmethod
+    def _count(content, view, started):
+        sent = 0
+        try:
+            for chunk in content:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            metrics.inc('http_response_bytes_total', {'view': view}, sent)
+            metrics.observe('http_response_stream_seconds', {'view': view}, time.perf_counter() - started)
+
+    @staticmethod
+    async def _count_async(content, view, started):
+        sent = 0
+        try:
+            async for chunk in content:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            metrics.inc('http_response_bytes_total', {'view': view}, sent)
+            metrics.observe('http_response_stream_seconds', {'view': view}, time.perf_counter() - started)
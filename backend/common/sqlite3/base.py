@@ -0,0 +1,13 @@
+"""SQLite, у которого транзакции начинаются с BEGIN IMMEDIATE (как transaction_mode в Django 5.1).
+
+Обычная (DEFERRED) транзакция, которая сначала читает, а потом пишет, при
+параллельной записи сразу получает "database is locked": поднять блокировку
+до записи нельзя, и timeout тут не помогает. IMMEDIATE берет блокировку
+записи в начале транзакции, и параллельные писатели ждут ее до timeout.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
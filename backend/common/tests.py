@@ -1,3 +1,73 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from common import views
+from common.middleware import MetricsMiddleware
+from users.models import CustomUser
 
-# Create your tests here.
+
+class SpaShellTests(TestCase):
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        with open(f'{self.template_dir}/index.html', 'w') as fh:
+            fh.write('<div id="root"></div>')
+        settings_override = override_settings(
+            DEBUG=False, TEMPLATES=[{**settings.TEMPLATES[0], 'DIRS': [self.template_dir]}])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.template_dir, ignore_errors=True)
+        views._cached_shell.cache_clear()
+        self.addCleanup(views._cached_shell.cache_clear)
+
+    def test_shell_is_cached_with_etag(self):
+        response = self.client.get('/files/report')
+        self.assertEqual(response.content, b'<div id="root"></div>')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        etag = response['ETag']
+
+        with open(f'{self.template_dir}/index.html', 'w') as fh:
+            fh.write('changed')
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/').content, b'<div id="root"></div>')
+
+
+class MetricsViewTests(TestCase):
+    def test_requires_token(self):
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 404)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+
+class MetricsMiddlewareTests(TestCase):
+    def test_server_timing_only_for_staff(self):
+        self.assertNotIn('Server-Timing', self.client.get('/api/storage/'))
+        user = CustomUser.objects.create_user(
+            username='owner1', email='owner@example.com', password='Passw0rd!', full_name='Owner')
+        self.client.force_login(user)
+        self.assertNotIn('Server-Timing', self.client.get('/api/storage/'))
+        user.is_staff = True
+        user.save()
+        self.assertIn('queries', self.client.get('/api/storage/')['Server-Timing'])
+        with override_settings(DEBUG=True):
+            self.client.logout()
+            self.assertIn('Server-Timing', self.client.get('/api/storage/'))
+
+    def test_async_chain_stays_async(self):
+        async def get_response(request):
+            await CustomUser.objects.aexists()
+            return HttpResponse(b'ok')
+
+        middleware = MetricsMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertFalse(iscoroutinefunction(MetricsMiddleware(lambda request: HttpResponse(b'ok'))))
+        with override_settings(DEBUG=True):
+            response = async_to_sync(middleware)(RequestFactory().get('/'))
+        self.assertEqual(response.content, b'ok')
+        self.assertIn('"1 queries"', response['Server-Timing'])
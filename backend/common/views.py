@@ -1,5 +1,54 @@
-from django.shortcuts import render
+import functools
+import hashlib
+import hmac
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.views.decorators.http import require_GET
+from . import metrics
+
+
+def _render_shell():
+    content = render_to_string('index.html').encode()
+    return content, f'"{hashlib.sha256(content).hexdigest()}"'
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_shell():
+    return _render_shell()
+
+
+def spa_shell():
+    """Оболочка SPA (frontend/dist/index.html) и ее ETag.
+
+    Шаблон рендерится без запроса один раз на процесс, то есть на деплой
+    (с DEBUG - на каждый запрос, чтобы видеть свежую сборку), поэтому
+    оболочка не должна зависеть от пользователя и запроса.
+    """
+    return _render_shell() if settings.DEBUG else _cached_shell()
 
 
 def home(request):
-    return render(request, 'index.html')
+    content, etag = spa_shell()
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type='text/html; charset=utf-8')
+    response['ETag'] = etag
+    # Кешировать можно, но с проверкой: после деплоя оболочка ссылается на новые бандлы
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@require_GET
+def metrics_view(request):
+    """Метрики common.metrics для Prometheus по METRICS_TOKEN (Bearer); без токена эндпоинт выключен.
+
+    Адрес клиента не проверяется: за nginx все запросы приходят с localhost.
+    """
+    if not settings.METRICS_TOKEN:
+        raise Http404
+    expected = f'Bearer {settings.METRICS_TOKEN}'
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), expected):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,6 +1,25 @@
-from rest_framework.authentication import SessionAuthentication
+from rest_framework.authentication import BaseAuthentication, SessionAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+from users import tokens
 
 
 class CsrfExemptSessionAuthentication(SessionAuthentication):
     def enforce_csrf(self, request):
         return
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """``Authorization: Bearer <access_token>`` из users.tokens: без сессии и, как правило, без запросов к БД."""
+
+    def authenticate(self, request):
+        header = get_authorization_header(request).split()
+        if not header or header[0].lower() != b'bearer':
+            return None
+        if len(header) != 2:
+            raise AuthenticationFailed('Неверный заголовок авторизации')
+        try:
+            return tokens.user_from_access(header[1].decode('ascii')), None
+        except UnicodeDecodeError:
+            raise AuthenticationFailed('Неверный токен')
+        except tokens.TokenError as e:
+            raise AuthenticationFailed(str(e))
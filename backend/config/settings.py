@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -28,6 +29,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'common.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -61,9 +63,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
+# SQLite по умолчанию - через common.sqlite3: транзакции с BEGIN IMMEDIATE, и параллельные
+# записи ждут блокировку (timeout), а не падают с "database is locked"
 DATABASES = {
     'default': {
-        'ENGINE': os.getenv('DB_ENGINE', 'django.db.backends.sqlite3'),
+        'ENGINE': os.getenv('DB_ENGINE', 'common.sqlite3'),
         'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
         'USER': os.getenv('DB_USER', ''),
         'PASSWORD': os.getenv('DB_PASSWORD', ''),
@@ -94,7 +98,6 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 STATICFILES_DIRS = [
     BASE_DIR.parent / 'frontend/dist',
@@ -103,11 +106,140 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Хранилище файлов пользователей:
+#   'local' - FileSystemStorage в MEDIA_ROOT
+#   's3'    - S3-совместимое объектное хранилище (storage.s3.S3Storage: AWS S3, MinIO и т. п.)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+
+# S3: адрес API (например, http://127.0.0.1:9000 для MinIO), бакет и ключи; запросы подписываются
+# AWS Signature V4, бакет адресуется в пути (path-style). Файлы больше STORAGE_S3_PART_SIZE байт
+# загружаются multipart-загрузкой частями этого размера (не меньше 5 МБ)
+STORAGE_S3_ENDPOINT_URL = os.getenv('STORAGE_S3_ENDPOINT_URL', 'http://127.0.0.1:9000')
+STORAGE_S3_BUCKET = os.getenv('STORAGE_S3_BUCKET', 'mycloud')
+STORAGE_S3_ACCESS_KEY = os.getenv('STORAGE_S3_ACCESS_KEY', '')
+STORAGE_S3_SECRET_KEY = os.getenv('STORAGE_S3_SECRET_KEY', '')
+STORAGE_S3_REGION = os.getenv('STORAGE_S3_REGION', 'us-east-1')
+STORAGE_S3_PART_SIZE = int(os.getenv('STORAGE_S3_PART_SIZE', 16 * 1024 * 1024))
+STORAGE_S3_TIMEOUT = 60
+
+# Скачивание файла (file_detail, file_share) редиректом на подписанную ссылку S3 со сроком жизни
+# STORAGE_S3_PRESIGN_EXPIRES секунд: байты идут клиенту из хранилища, минуя приложение.
+# Сжатые на диске файлы (codec) по-прежнему отдает приложение
+STORAGE_S3_PRESIGNED_DOWNLOADS = os.getenv('STORAGE_S3_PRESIGNED_DOWNLOADS', 'False') == 'True'
+STORAGE_S3_PRESIGN_EXPIRES = int(os.getenv('STORAGE_S3_PRESIGN_EXPIRES', 300))
+
+# Локальный каталог для part-файлов возобновляемых загрузок и временных файлов перед отправкой
+# в удаленное хранилище; с 'local' временные файлы лежат в MEDIA_ROOT (перенос переименованием)
+STORAGE_STAGING_DIR = os.getenv('STORAGE_STAGING_DIR', os.path.join(tempfile.gettempdir(), 'mycloud-staging'))
+
+STORAGES = {
+    'default': {
+        'BACKEND': {
+            'local': 'django.core.files.storage.FileSystemStorage',
+            's3': 'storage.s3.S3Storage',
+        }[STORAGE_BACKEND],
+    },
+    'staticfiles': {
+        'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Статика с хешем содержимого в имени (сборка webpack и ManifestStaticFilesStorage) отдается
+# с Cache-Control: immutable на 10 лет; .br и .gz рядом с файлом WhiteNoise отдает вместо сжатия на лету
+WHITENOISE_IMMUTABLE_FILE_TEST = r'\.[0-9a-f]{12}\.[^/]+$'
+
+# Возобновляемая загрузка: максимальный размер одного куска в байтах
+STORAGE_UPLOAD_MAX_CHUNK_SIZE = int(os.getenv('STORAGE_UPLOAD_MAX_CHUNK_SIZE', 64 * 1024 * 1024))
+
+# Раскладка файлов пользователя, хранящихся вне блобов: число уровней подкаталогов из начала MD5
+# имени файла (2 - user_x/ab/cd/<файл>, 0 - все файлы в одном каталоге user_x/).
+# Уже сохраненные файлы переносит manage.py shard_user_storage
+STORAGE_USER_DIR_LEVELS = int(os.getenv('STORAGE_USER_DIR_LEVELS', 2))
+
+# Прием файлов в POST /api/storage/ через storage.upload_handlers.StorageUploadHandler: запись сразу
+# рядом с хранилищем с подсчетом SHA-256 в том же проходе и переносом на место переименованием
+STORAGE_DIRECT_UPLOADS = os.getenv('STORAGE_DIRECT_UPLOADS', 'True') == 'True'
+
+# Дедупликация: содержимое хранится один раз в STORAGE_BLOB_DIR под именем из своего SHA-256
+STORAGE_DEDUPLICATE = os.getenv('STORAGE_DEDUPLICATE', 'True') == 'True'
+STORAGE_BLOB_DIR = 'blobs'
+
+# Сжатие на диске (gzip) для сжимаемых файлов: включение, минимальный размер файла в байтах и уровень
+STORAGE_COMPRESSION = os.getenv('STORAGE_COMPRESSION', 'False') == 'True'
+STORAGE_COMPRESSION_MIN_SIZE = 1024
+STORAGE_COMPRESSION_LEVEL = int(os.getenv('STORAGE_COMPRESSION_LEVEL', 6))
+
+# Квота по умолчанию в байтах (пусто - без ограничений); персональная задается в CustomUser.storage_quota
+STORAGE_DEFAULT_QUOTA = int(os.getenv('STORAGE_DEFAULT_QUOTA')) if os.getenv('STORAGE_DEFAULT_QUOTA') else None
+
+# Размер страницы списка файлов (keyset-пагинация в file_list)
+STORAGE_LIST_PAGE_SIZE = 100
+STORAGE_LIST_MAX_PAGE_SIZE = 1000
+
+# Максимум операций в одном запросе /api/storage/batch/
+STORAGE_BATCH_MAX_OPERATIONS = 1000
+
+# Журнал изменений файлов для /api/storage/changes/ (storage.changes): сколько дней хранить записи
+# (старые удаляет manage.py prune_file_changes; клиент с курсором старше получает resync)
+STORAGE_CHANGES_RETENTION_DAYS = int(os.getenv('STORAGE_CHANGES_RETENTION_DAYS', 30))
+
+# Версии файлов (storage.versions): сколько версий хранить на файл, более старые удаляются
+# при создании новой. Куски версий хранятся блобами один раз и в квоту не входят
+STORAGE_MAX_FILE_VERSIONS = int(os.getenv('STORAGE_MAX_FILE_VERSIONS', 50))
+
+# Как часто (в секундах) сбрасывать накопленные last_downloaded_at/download_count в БД
+STORAGE_DOWNLOAD_FLUSH_INTERVAL = 5
+
+# Превью (manage.py run_preview_worker): число процессов, таймаут одной задачи (с) и число попыток.
+# Превью строятся рядом с файлом на диске и доступны только с STORAGE_BACKEND='local'
+STORAGE_PREVIEWS_ENABLED = os.getenv('STORAGE_PREVIEWS_ENABLED', str(STORAGE_BACKEND == 'local')) == 'True'
+STORAGE_PREVIEW_WORKERS = int(os.getenv('STORAGE_PREVIEW_WORKERS', 2))
+STORAGE_PREVIEW_TIMEOUT = 30
+STORAGE_PREVIEW_MAX_ATTEMPTS = 3
+
+# Способ отдачи файлов:
+#   'django'   - байты идут через Python (FileResponse)
+#   'nginx'    - заголовок X-Accel-Redirect на internal location STORAGE_ACCEL_REDIRECT_LOCATION
+#   'sendfile' - заголовок X-Sendfile с абсолютным путем (Apache mod_xsendfile, lighttpd)
+# 'nginx' и 'sendfile' требуют STORAGE_BACKEND='local'
+STORAGE_DELIVERY_MODE = os.getenv('STORAGE_DELIVERY_MODE', 'django')
+STORAGE_ACCEL_REDIRECT_LOCATION = os.getenv('STORAGE_ACCEL_REDIRECT_LOCATION', '/protected-media/')
+
+# Скачивание по публичной ссылке (storage.throttling): максимум одновременных скачиваний и байт в
+# секунду на ссылку и на IP клиента (0 - без ограничения). Состояние общее для воркеров через файлы
+# в STORAGE_SHARE_THROTTLE_DIR. STORAGE_SHARE_CLIENT_IP_HEADER - ключ request.META с адресом клиента
+# за прокси (например, HTTP_X_REAL_IP); пусто - REMOTE_ADDR. За прокси REMOTE_ADDR у всех клиентов
+# один, поэтому лимиты на IP выключены по умолчанию: включайте их вместе с заголовком
+STORAGE_SHARE_MAX_CONCURRENT_PER_LINK = int(os.getenv('STORAGE_SHARE_MAX_CONCURRENT_PER_LINK', 8))
+STORAGE_SHARE_MAX_CONCURRENT_PER_IP = int(os.getenv('STORAGE_SHARE_MAX_CONCURRENT_PER_IP', 0))
+STORAGE_SHARE_RATE_PER_LINK = int(os.getenv('STORAGE_SHARE_RATE_PER_LINK', 0))
+STORAGE_SHARE_RATE_PER_IP = int(os.getenv('STORAGE_SHARE_RATE_PER_IP', 0))
+STORAGE_SHARE_THROTTLE_DIR = os.getenv('STORAGE_SHARE_THROTTLE_DIR',
+                                       os.path.join(tempfile.gettempdir(), 'mycloud-throttle'))
+STORAGE_SHARE_CLIENT_IP_HEADER = os.getenv('STORAGE_SHARE_CLIENT_IP_HEADER', '')
+
+# Подписанные токены (Authorization: Bearer): время жизни access и refresh в секундах
+# и сколько секунд процесс держит пользователя в памяти, не перечитывая его из БД
+AUTH_ACCESS_TOKEN_TTL = int(os.getenv('AUTH_ACCESS_TOKEN_TTL', 15 * 60))
+AUTH_REFRESH_TOKEN_TTL = int(os.getenv('AUTH_REFRESH_TOKEN_TTL', 14 * 24 * 60 * 60))
+AUTH_TOKEN_USER_CACHE_TTL = 30
+
+# Метрики запросов (заголовок Server-Timing и /metrics для Prometheus). Server-Timing с числом
+# SQL-запросов получают только персонал и режим DEBUG. METRICS_DIR - каталог, общий для всех
+# воркеров gunicorn (пусто - /metrics показывает только свой процесс), куда процесс раз в
+# METRICS_FLUSH_INTERVAL секунд сбрасывает свои значения. METRICS_TOKEN - Bearer-токен
+# для /metrics; без него эндпоинт выключен (404)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = 5
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'config.authentication.CsrfExemptSessionAuthentication',
+        'config.authentication.SignedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -121,7 +253,7 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
-CORS_EXPOSE_HEADERS = ['Content-Type', 'X-CSRFToken']
+CORS_EXPOSE_HEADERS = ['Content-Type', 'X-CSRFToken', 'Link', 'X-Next-Cursor', 'X-Change-Cursor', 'Server-Timing']
 CORS_ALLOW_HEADERS = [
     'accept',
     'accept-encoding',
@@ -2,11 +2,12 @@ from django.contrib import admin
 from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
-from common.views import home
+from common.views import home, metrics_view
 
 urlpatterns = [
     path('', home, name='home'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('api/auth/', include('users.urls')),
     path('api/storage/', include('storage.urls')),
     re_path(r'^(?!api/|admin/|media/|static/).*$', home),  # Для SPA
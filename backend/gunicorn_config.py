@@ -1,8 +1,11 @@
 import multiprocessing
+import os
 
 bind = "127.0.0.1:8000"
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
+# Для ASGI (config.asgi:application и асинхронные /api/storage/stream/...):
+# GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
 timeout = 120
 keepalive = 5
 max_requests = 1000
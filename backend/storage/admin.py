@@ -1,19 +1,43 @@
 from django.contrib import admin
-from .models import UserFile
+from django.db.models.expressions import RawSQL
+from .models import Blob, PreviewJob, UserFile
+from . import search
 
 
 @admin.register(UserFile)
 class UserFileAdmin(admin.ModelAdmin):
-    list_display = ('original_name', 'user', 'size', 'uploaded_at', 'last_downloaded_at')
+    list_display = ('original_name', 'user', 'size', 'uploaded_at', 'last_downloaded_at', 'download_count')
     list_filter = ('user', 'uploaded_at')
     search_fields = ('original_name', 'user__username')
-    readonly_fields = ('size', 'uploaded_at', 'last_downloaded_at', 'share_link')
+    readonly_fields = ('size', 'uploaded_at', 'last_downloaded_at', 'download_count', 'share_link', 'sha256', 'blob', 'codec')
     fieldsets = (
         (None, {
             'fields': ('user', 'original_name', 'file', 'comment')
         }),
         ('Дополнительная информация', {
-            'fields': ('size', 'uploaded_at', 'last_downloaded_at', 'share_link', 'file_path'),
+            'fields': ('size', 'uploaded_at', 'last_downloaded_at', 'download_count', 'share_link', 'file_path', 'sha256', 'blob', 'codec'),
             'classes': ('collapse',)
         }),
     )
+
+    def get_search_results(self, request, queryset, search_term):
+        """Имя и комментарий ищутся по полнотекстовому индексу, логин - как раньше."""
+        subquery = search.matching_ids(search_term) if search.terms(search_term) else None
+        if subquery is None:
+            return super().get_search_results(request, queryset, search_term)
+        matches = queryset.filter(pk__in=RawSQL(*subquery))
+        return matches | queryset.filter(user__username__icontains=search_term.strip()), False
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'size', 'codec', 'ref_count', 'created_at')
+    search_fields = ('sha256',)
+    readonly_fields = ('sha256', 'file', 'size', 'codec', 'ref_count', 'created_at')
+
+
+@admin.register(PreviewJob)
+class PreviewJobAdmin(admin.ModelAdmin):
+    list_display = ('user_file', 'status', 'attempts', 'created_at', 'started_at', 'duration')
+    list_filter = ('status',)
+    readonly_fields = ('user_file', 'attempts', 'created_at', 'started_at', 'finished_at', 'duration', 'error')
@@ -1,6 +1,24 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def _ensure_triggers(sender, using, **kwargs):
+    """На SQLite пересоздание storage_userfile миграцией удаляет триггеры поиска и журнала - восстанавливаем."""
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+    from . import changes, search
+
+    connection = connections[using]
+    applied = MigrationRecorder(connection).applied_migrations()
+    if ('storage', '0011_search') in applied:
+        search.ensure_index(connection)
+    if ('storage', '0012_file_changes') in applied:
+        changes.ensure_triggers(connection)
 
 
 class StorageConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'storage'
+
+    def ready(self):
+        post_migrate.connect(_ensure_triggers, sender=self)
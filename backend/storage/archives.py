@@ -0,0 +1,82 @@
+import mimetypes
+import os
+import zipfile
+from django.utils import timezone
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# Форматы, которые уже сжаты: повторное сжатие только тратит CPU
+PRECOMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.br', '.lz4',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub', '.jar', '.apk',
+}
+PRECOMPRESSED_MIME_PREFIXES = ('image/', 'audio/', 'video/')
+UNCOMPRESSED_MIME_TYPES = {'image/bmp', 'image/svg+xml', 'image/tiff', 'audio/wav', 'audio/x-wav'}
+
+
+def is_precompressed(name):
+    if os.path.splitext(name)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+        return True
+    mime = mimetypes.guess_type(name)[0] or ''
+    return mime.startswith(PRECOMPRESSED_MIME_PREFIXES) and mime not in UNCOMPRESSED_MIME_TYPES
+
+
+class _ZipSink:
+    """Поток без seek для ``ZipFile``: копит записанное до следующей выдачи клиенту."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def _unique_name(name, used):
+    name = os.path.basename(name) or 'file'
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in used:
+        candidate = f'{stem} ({n}){ext}'
+        n += 1
+    used.add(candidate)
+    return candidate
+
+
+def stream_zip(files):
+    """Собирает ZIP на лету, не создавая временного архива.
+
+    Поток не поддерживает seek, поэтому zipfile пишет размеры и CRC в
+    дескрипторы данных после каждого файла; в памяти держится не больше
+    одного блока чтения.
+    """
+    sink = _ZipSink()
+    used = set()
+    with zipfile.ZipFile(sink, mode='w') as archive:
+        for user_file in files:
+            info = zipfile.ZipInfo(_unique_name(user_file.original_name, used),
+                                   date_time=timezone.localtime(user_file.uploaded_at).timetuple()[:6])
+            info.file_size = user_file.size
+            info.compress_type = (zipfile.ZIP_STORED if is_precompressed(user_file.original_name)
+                                  else zipfile.ZIP_DEFLATED)
+            with user_file.open_content() as source, archive.open(info, mode='w') as dest:
+                for block in iter(lambda: source.read(READ_BLOCK_SIZE), b''):
+                    dest.write(block)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
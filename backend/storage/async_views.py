@@ -0,0 +1,121 @@
+"""Асинхронные представления для отдачи и приема байтов под ASGI (config/asgi.py).
+
+Медленный клиент здесь не занимает процесс или поток: файловый ввод-вывод
+уходит в пул потоков, проверки прав делаются асинхронными запросами ORM.
+Под WSGI эти представления тоже работают, но выигрыша не дают.
+"""
+import asyncio
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.utils import timezone
+from users import tokens
+from .models import UploadSession, UserFile
+from .downloads import serve_file
+from .serializers import UploadSessionSerializer
+from . import bookkeeping, throttling, uploads
+
+
+def _error(message, status, **extra):
+    return JsonResponse({'error': message, **extra}, status=status, json_dumps_params={'ensure_ascii': False})
+
+
+async def _authenticated_user(request):
+    """Пользователь по ``Authorization: Bearer`` (users.tokens) или по сессии."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer':
+        try:
+            return await sync_to_async(tokens.user_from_access)(token.strip())
+        except tokens.TokenError:
+            return None
+    user = await sync_to_async(get_user)(request)
+    return user if user.is_authenticated else None
+
+
+def _respond(request, file, lease):
+    response = serve_file(request, file, asynchronous=True)
+    return throttling.apply(response, lease) if lease is not None else response
+
+
+async def _send(request, file, lease=None):
+    try:
+        # Размер в хранилище, подписанная ссылка и слоты - блокирующие вызовы: не в цикле событий
+        response = await asyncio.to_thread(_respond, request, file, lease)
+    except BaseException:
+        # Без ответа слоты некому освободить при закрытии
+        if lease is not None:
+            await asyncio.to_thread(lease.release)
+        raise
+    if response.status_code in (200, 206, 302):
+        bookkeeping.record_download(file)
+    return response
+
+
+async def file_download(request, pk):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    user = await _authenticated_user(request)
+    if user is None:
+        return _error('Требуется авторизация', 403)
+
+    try:
+        file = await UserFile.objects.aget(pk=pk)
+    except UserFile.DoesNotExist:
+        return _error('Файл не найден', 404)
+
+    if not user.is_administrator and file.user_id != user.pk:
+        return _error('Нет прав доступа', 403)
+    return await _send(request, file)
+
+
+async def file_share_download(request, share_link):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    try:
+        file = await UserFile.objects.aget(share_link=share_link)
+    except UserFile.DoesNotExist:
+        return _error('Файл не найден', 404)
+    try:
+        lease = await asyncio.to_thread(throttling.acquire, request, file)
+    except throttling.Throttled as e:
+        response = _error('Слишком много одновременных скачиваний, повторите позже', 429)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    return await _send(request, file, lease)
+
+
+async def upload_chunk(request, pk):
+    """Аналог PUT в ``views.upload_detail``: кусок пишется на диск в пуле потоков."""
+    if request.method != 'PUT':
+        return HttpResponseNotAllowed(['PUT'])
+    user = await _authenticated_user(request)
+    if user is None:
+        return _error('Требуется авторизация', 403)
+
+    try:
+        session = await UploadSession.objects.aget(pk=pk, user=user)
+    except UploadSession.DoesNotExist:
+        return _error('Сессия загрузки не найдена', 404)
+
+    try:
+        start, end, total = uploads.parse_content_range(request.headers.get('Content-Range', ''))
+        if total is not None and total != session.size:
+            raise uploads.ChunkError('Размер файла не совпадает с сессией')
+        uploads.check_chunk(session, start, end)
+        written = await asyncio.to_thread(uploads.write_part, session, start, end, request)
+        await UploadSession.objects.filter(pk=session.pk).aupdate(
+            received=Greatest(F('received'), start + written), updated_at=timezone.now())
+        await session.arefresh_from_db(fields=['received', 'updated_at'])
+        if written != end - start + 1:
+            raise uploads.ChunkError('Получено меньше данных, чем указано в Content-Range')
+    except uploads.ChunkError as e:
+        return _error(str(e), 409, received=session.received)
+
+    return JsonResponse(UploadSessionSerializer(session).data, json_dumps_params={'ensure_ascii': False})
+
+
+# Декораторы Django 4.2 не умеют оборачивать корутины, поэтому помечаем вручную,
+# как и остальной API (config.authentication.CsrfExemptSessionAuthentication)
+upload_chunk.csrf_exempt = True
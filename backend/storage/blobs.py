@@ -0,0 +1,93 @@
+import hashlib
+import os
+import uuid
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from .models import Blob, blob_path
+from . import compression, staging
+
+# Сколько раз повторять попытку, если блоб удаляется параллельно с загрузкой
+INGEST_ATTEMPTS = 5
+
+
+def temp_path():
+    """Путь для временного файла на той же файловой системе, что и блобы (staging при удаленном хранилище)."""
+    path = staging.local_path(f"{settings.STORAGE_BLOB_DIR}/tmp/{uuid.uuid4()}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def ingest_file(file, name=None):
+    """Копирует загруженный файл во временный файл, считая SHA-256 (и сжимая) в том же проходе.
+
+    Файл от ``StorageUploadHandler`` уже лежит рядом с блобами и только переименовывается.
+    """
+    if getattr(file, 'sha256', None) and hasattr(file, 'temporary_file_path'):
+        return commit(file.temporary_file_path(), file.sha256, file.size, file.codec)
+    path = temp_path()
+    try:
+        with open(path, 'wb') as out:
+            codec, sha256, size = compression.write_stream(file.chunks(), out, name or file.name, file.size)
+    except BaseException:
+        os.remove(path)
+        raise
+    return commit(path, sha256, size, codec)
+
+
+def ingest_path(path, name=''):
+    """Забирает готовый файл с диска (например, собранный part-файл) без копирования.
+
+    Сжимаемый файл копируется со сжатием, а исходный удаляется.
+    """
+    if compression.codec_for_path(path, name):
+        with open(path, 'rb') as source:
+            blob = ingest_file(File(source), name)
+        os.remove(path)
+        return blob
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return commit(path, digest.hexdigest(), os.path.getsize(path))
+
+
+def reference(sha256):
+    """Добавляет ссылку на существующий блоб с хешем ``sha256``; ``None``, если такого нет."""
+    blob = Blob.objects.filter(sha256=sha256, ref_count__gt=0).first()
+    if blob is None or not Blob.objects.filter(pk=blob.pk, ref_count__gt=0).update(ref_count=F('ref_count') + 1):
+        return None
+    blob.ref_count += 1
+    return blob
+
+
+def commit(path, sha256, size, codec=''):
+    """Превращает временный файл в блоб или добавляет ссылку на уже существующий.
+
+    При совпадении хеша временный файл удаляется, и новая копия на диске не появляется.
+    Байты кладутся в хранилище до транзакции (с S3 это может быть долгая загрузка),
+    под именем из SHA-256 и случайного суффикса: удаление прежнего блоба с тем же
+    хешем не заденет новый файл, а проигравший гонку за строку Blob удаляет свою копию.
+    """
+    blob = reference(sha256)
+    if blob is not None:
+        os.remove(path)
+        return blob
+
+    name = staging.place(path, f'{blob_path(sha256)}-{uuid.uuid4().hex[:12]}')
+    for _ in range(INGEST_ATTEMPTS):
+        with transaction.atomic():
+            blob, created = Blob.objects.get_or_create(
+                sha256=sha256, defaults={'file': name, 'size': size, 'codec': codec, 'ref_count': 1})
+            if created:
+                return blob
+            referenced = Blob.objects.filter(pk=blob.pk, ref_count__gt=0).update(ref_count=F('ref_count') + 1)
+        if referenced:
+            default_storage.delete(name)
+            blob.refresh_from_db(fields=['ref_count'])
+            return blob
+    default_storage.delete(name)
+    raise RuntimeError(f'Не удалось сохранить блоб {sha256}')
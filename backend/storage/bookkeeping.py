@@ -0,0 +1,78 @@
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DatabaseError
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from .models import UserFile
+
+logger = logging.getLogger(__name__)
+
+# file_id -> [число скачиваний, время последнего скачивания]
+_pending = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def record_download(file):
+    """Запоминает скачивание в памяти процесса; в БД оно попадет при ближайшем сбросе."""
+    now = timezone.now()
+    with _lock:
+        entry = _pending.setdefault(file.pk, [0, now])
+        entry[0] += 1
+        entry[1] = max(entry[1], now)
+
+
+def flush():
+    """Пишет накопленные скачивания одним UPDATE на все файлы.
+
+    Если запись не удалась, пачка возвращается в память и уйдет при следующем сбросе.
+    """
+    global _last_flush
+    with _lock:
+        batch = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not batch:
+        return 0
+
+    # Другой процесс мог уже записать более позднее скачивание: время только растет
+    files = [
+        UserFile(pk=pk, download_count=F('download_count') + count,
+                 last_downloaded_at=Greatest(Coalesce(F('last_downloaded_at'), Value(last)), Value(last)))
+        for pk, (count, last) in batch.items()
+    ]
+    try:
+        UserFile.objects.bulk_update(files, ['download_count', 'last_downloaded_at'])
+    except BaseException:
+        with _lock:
+            for pk, (count, last) in batch.items():
+                entry = _pending.setdefault(pk, [0, last])
+                entry[0] += count
+                entry[1] = max(entry[1], last)
+        raise
+    return len(files)
+
+
+def flush_if_due(**kwargs):
+    if _pending and time.monotonic() - _last_flush >= settings.STORAGE_DOWNLOAD_FLUSH_INTERVAL:
+        try:
+            flush()
+        except DatabaseError:
+            logger.exception('Не удалось сохранить статистику скачиваний, повторим при следующем сбросе')
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except DatabaseError:
+        logger.exception('Не удалось сохранить статистику скачиваний при завершении процесса')
+
+
+# request_finished приходит после отправки ответа, так что запись не задерживает первый байт
+request_finished.connect(flush_if_due, dispatch_uid='storage.bookkeeping.flush_if_due')
+atexit.register(_flush_at_exit)
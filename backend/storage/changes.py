@@ -0,0 +1,175 @@
+"""Журнал изменений файлов (FileChange) и выборка изменений после курсора.
+
+Журнал пишут триггеры на storage_userfile: INSERT - ``create``, смена
+original_name - ``rename``, смена comment - ``comment``, смена sha256
+(новая версия содержимого) - ``update``, DELETE - ``delete``.
+Поэтому запись появляется в той же транзакции при любом способе изменения:
+``save()``, ``QuerySet.update()``, ``bulk_update()``, каскадное удаление.
+
+Курсор - id последней полученной записи. Чтобы клиент не пропустил запись,
+закоммиченную позже записи с большим id, изменения одного пользователя пишутся
+по очереди: на PostgreSQL триггер берет advisory-блокировку на пользователя до
+конца транзакции, SQLite и так пишет в одну транзакцию за раз. Записи разных
+пользователей коммитятся в любом порядке, поэтому общий журнал (список всех
+файлов у администратора) читается только до записи, перед которой все уже
+закоммичено: триггер держит еще и разделяемую блокировку на весь журнал, а
+чтение дожидается исключительной (см. ``_settled_newest``).
+На остальных СУБД журнал не ведется, и клиенту всегда предлагается полная
+пересинхронизация.
+
+Триггеры создаются миграциями 0012 и 0013 и проверяются после каждой ``migrate``
+(см. apps.py). Старые записи удаляет ``manage.py prune_file_changes``.
+"""
+from django.db import connection, transaction
+from .models import FileChange, UserFile
+
+TABLE = FileChange._meta.db_table
+SQLITE_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+SQLITE_TRIGGERS = {
+    'storage_userfile_change_ai': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_change_ai AFTER INSERT ON storage_userfile BEGIN
+            INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (new.user_id, new.id, 'create', {SQLITE_NOW});
+        END""",
+    'storage_userfile_change_ad': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_change_ad AFTER DELETE ON storage_userfile BEGIN
+            INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (old.user_id, old.id, 'delete', {SQLITE_NOW});
+        END""",
+    'storage_userfile_change_an': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_change_an AFTER UPDATE OF original_name ON storage_userfile
+        WHEN old.original_name IS NOT new.original_name BEGIN
+            INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (new.user_id, new.id, 'rename', {SQLITE_NOW});
+        END""",
+    'storage_userfile_change_ac': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_change_ac AFTER UPDATE OF comment ON storage_userfile
+        WHEN old.comment IS NOT new.comment BEGIN
+            INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (new.user_id, new.id, 'comment', {SQLITE_NOW});
+        END""",
+    'storage_userfile_change_au': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_change_au AFTER UPDATE OF sha256 ON storage_userfile
+        WHEN old.sha256 IS NOT new.sha256 BEGIN
+            INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (new.user_id, new.id, 'update', {SQLITE_NOW});
+        END""",
+}
+
+PG_FUNCTION = f"""
+    CREATE OR REPLACE FUNCTION storage_userfile_change() RETURNS trigger AS $$
+    DECLARE
+        row storage_userfile;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN row := OLD; ELSE row := NEW; END IF;
+        PERFORM pg_advisory_xact_lock_shared(hashtext('{TABLE}'));
+        PERFORM pg_advisory_xact_lock(hashtext('{TABLE}'), (row.user_id % 2147483647)::int);
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (NEW.user_id, NEW.id, 'create', now());
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (OLD.user_id, OLD.id, 'delete', now());
+        ELSE
+            IF NEW.original_name IS DISTINCT FROM OLD.original_name THEN
+                INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (NEW.user_id, NEW.id, 'rename', now());
+            END IF;
+            IF NEW.comment IS DISTINCT FROM OLD.comment THEN
+                INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (NEW.user_id, NEW.id, 'comment', now());
+            END IF;
+            IF NEW.sha256 IS DISTINCT FROM OLD.sha256 THEN
+                INSERT INTO {TABLE}(user_id, file_id, kind, created_at) VALUES (NEW.user_id, NEW.id, 'update', now());
+            END IF;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql"""
+
+
+def supported(using_connection=None):
+    return (using_connection or connection).vendor in ('sqlite', 'postgresql')
+
+
+def ensure_triggers(using_connection=None):
+    """Создает недостающие триггеры журнала; идемпотентна."""
+    conn = using_connection or connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            for sql in SQLITE_TRIGGERS.values():
+                cursor.execute(sql)
+        elif conn.vendor == 'postgresql':
+            cursor.execute(PG_FUNCTION)
+            cursor.execute('DROP TRIGGER IF EXISTS storage_userfile_change ON storage_userfile')
+            cursor.execute('CREATE TRIGGER storage_userfile_change AFTER INSERT OR UPDATE OR DELETE '
+                           'ON storage_userfile FOR EACH ROW EXECUTE FUNCTION storage_userfile_change()')
+
+
+def drop_triggers(using_connection=None):
+    conn = using_connection or connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            for name in SQLITE_TRIGGERS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        elif conn.vendor == 'postgresql':
+            cursor.execute('DROP TRIGGER IF EXISTS storage_userfile_change ON storage_userfile')
+            cursor.execute('DROP FUNCTION IF EXISTS storage_userfile_change()')
+
+
+def _settled_newest():
+    """Наибольший id журнала, перед которым нет незакоммиченных записей других транзакций.
+
+    На PostgreSQL исключительная блокировка дожидается транзакций, уже пишущих в журнал
+    (их триггер держит разделяемую); новые получат id больше прочитанного.
+    """
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [TABLE])
+        return FileChange.objects.order_by('-id').values_list('id', flat=True).first()
+
+
+def latest(user_id):
+    """Курсор ``user_id`` (``None`` - все пользователи), с которого начинать синхронизацию после полного списка файлов.
+
+    Не меньше id перед самой старой записью: если записи пользователя удалены
+    по сроку, курсор все равно не требует пересинхронизации.
+    """
+    if user_id is None:
+        last = _settled_newest()
+    else:
+        last = FileChange.objects.filter(user_id=user_id).order_by('-id').values_list('id', flat=True).first()
+    oldest = FileChange.objects.order_by('id').values_list('id', flat=True).first()
+    return max(last or 0, (oldest or 1) - 1)
+
+
+def since(user_id, cursor, limit):
+    """Изменения файлов ``user_id`` (``None`` - всех пользователей) после ``cursor``.
+
+    Возвращает ``(изменения, новый курсор, есть ли еще, нужна ли полная пересинхронизация)``.
+    Из нескольких изменений одного файла на странице остается последнее:
+    клиенту достаточно его и текущего состояния файла.
+    """
+    if not supported():
+        return [], cursor, False, True
+    oldest = FileChange.objects.order_by('id').values_list('id', flat=True).first()
+    if user_id is None:
+        newest = _settled_newest()
+    else:
+        newest = FileChange.objects.order_by('-id').values_list('id', flat=True).first()
+    # Курсор из будущего (БД пересоздана) или записи после него уже удалены по сроку
+    if cursor > (newest or 0) or (oldest is not None and cursor < oldest - 1):
+        return [], cursor, False, True
+
+    rows = FileChange.objects.filter(id__gt=cursor, id__lte=newest or 0)
+    if user_id is not None:
+        rows = rows.filter(user_id=user_id)
+    rows = list(rows.order_by('id').values_list('id', 'file_id', 'kind')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], cursor, False, False
+
+    last = {}
+    for change_id, file_id, kind in rows:
+        last.pop(file_id, None)
+        last[file_id] = (change_id, kind)
+    files = UserFile.objects.select_related('user').in_bulk(
+        [file_id for file_id, (_, kind) in last.items() if kind != FileChange.KIND_DELETE])
+    # Файл, удаленный уже после этой страницы, отдается как удаленный: запись delete придет следом
+    changes = [(file_id, kind if file_id in files else FileChange.KIND_DELETE, files.get(file_id))
+               for file_id, (_, kind) in last.items()]
+    return changes, rows[-1][0], has_more, False
@@ -0,0 +1,137 @@
+"""Сжатие содержимого на диске (STORAGE_COMPRESSION).
+
+Файл сжимается gzip прямо во время записи, если он не выглядит уже сжатым:
+решение принимается по расширению и MIME (``archives.is_precompressed``) и по
+энтропии первого блока. Кодек сохраняется в ``Blob.codec``/``UserFile.codec``;
+SHA-256 и размер всегда считаются по исходным байтам.
+"""
+import gzip
+import hashlib
+import math
+import os
+import tempfile
+from collections import Counter
+from django.conf import settings
+from django.core.files import File
+from .archives import is_precompressed
+
+CODEC_GZIP = 'gzip'
+CODEC_CHOICES = [('', 'Без сжатия'), (CODEC_GZIP, 'gzip')]
+
+SAMPLE_SIZE = 64 * 1024
+
+# Выше этой энтропии (бит на байт) данные считаются уже сжатыми или случайными
+MAX_ENTROPY = 7.5
+
+
+def entropy(sample):
+    """Энтропия Шеннона выборки в битах на байт (0 - 8)."""
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(sample).values())
+
+
+def choose_codec(name, size, sample):
+    """Кодек для нового файла или ``''``, если сжимать не стоит."""
+    if not settings.STORAGE_COMPRESSION or size < settings.STORAGE_COMPRESSION_MIN_SIZE:
+        return ''
+    if is_precompressed(name) or entropy(sample[:SAMPLE_SIZE]) > MAX_ENTROPY:
+        return ''
+    return CODEC_GZIP
+
+
+def codec_for_path(path, name):
+    with open(path, 'rb') as source:
+        return choose_codec(name, os.path.getsize(path), source.read(SAMPLE_SIZE))
+
+
+class StreamWriter:
+    """Пишет куски в открытый файл ``out``, по пути сжимая их, если это выгодно.
+
+    Если ``size`` известен, решение о сжатии принимается по первому куску, иначе
+    по первым SAMPLE_SIZE байтам (или по всему файлу, если он меньше). ``close()``
+    возвращает ``(кодек, SHA-256, размер)`` исходных данных.
+    """
+
+    def __init__(self, out, name, size=None):
+        self.out = out
+        self.name = name
+        self.size = size
+        self.digest = hashlib.sha256()
+        self.written = 0
+        self.codec = None
+        self.target = None
+        self.pending = []
+
+    def _start(self, sample):
+        self.codec = choose_codec(self.name, self.written if self.size is None else self.size, sample)
+        # mtime=0: одинаковое содержимое дает одинаковые сжатые байты
+        self.target = gzip.GzipFile(fileobj=self.out, mode='wb', compresslevel=settings.STORAGE_COMPRESSION_LEVEL,
+                                    mtime=0) if self.codec else self.out
+        for chunk in self.pending:
+            self.target.write(chunk)
+        self.pending = []
+
+    def write(self, chunk):
+        self.digest.update(chunk)
+        self.written += len(chunk)
+        if self.target is not None:
+            self.target.write(chunk)
+            return
+        self.pending.append(chunk)
+        if self.size is not None or self.written >= SAMPLE_SIZE:
+            self._start(b''.join(self.pending))
+
+    def close(self):
+        if self.target is None:
+            self._start(b''.join(self.pending))
+        if self.codec:
+            self.target.close()
+        return self.codec, self.digest.hexdigest(), self.written
+
+
+def write_stream(chunks, out, name, size):
+    """Пишет ``chunks`` в открытый файл ``out`` через ``StreamWriter``; возвращает ``(кодек, SHA-256, размер)``."""
+    writer = StreamWriter(out, name, size)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+    finally:
+        result = writer.close()
+    return result
+
+
+def spool_upload(upload):
+    """Сжатая копия загрузки во временном файле для хранения без дедупликации.
+
+    Возвращает ``(файл, кодек, SHA-256)`` или ``None``, если файл лучше хранить как есть.
+    """
+    sample = upload.read(SAMPLE_SIZE)
+    upload.seek(0)
+    if not choose_codec(upload.name, upload.size, sample):
+        return None
+    spool = tempfile.TemporaryFile(dir=settings.FILE_UPLOAD_TEMP_DIR)
+    codec, sha256, _ = write_stream(upload.chunks(), spool, upload.name, upload.size)
+    spool.seek(0)
+    return File(spool, name=upload.name), codec, sha256
+
+
+class _GzipReader(gzip.GzipFile):
+    """``GzipFile``, который закрывает и переданный ему файл хранилища."""
+
+    def close(self):
+        source = self.fileobj
+        try:
+            super().close()
+        finally:
+            if source is not None:
+                source.close()
+
+
+def open_stored(storage, name, codec):
+    """Открывает хранимый файл на чтение исходных (распакованных) байтов."""
+    source = storage.open(name, 'rb')
+    if not codec:
+        return source
+    return _GzipReader(fileobj=source, mode='rb')
@@ -0,0 +1,263 @@
+import asyncio
+import mimetypes
+import re
+import uuid
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.text import get_valid_filename
+from . import staging
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# Больше диапазонов в одном запросе не обрабатываем и отдаем файл целиком
+MAX_RANGES = 16
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def file_etag(user_file, encoding=''):
+    """ETag исходных байтов; у сжатого представления (``encoding``) он свой."""
+    suffix = f'-{encoding}' if encoding else ''
+    if user_file.sha256:
+        return f'"{user_file.sha256}{suffix}"'
+    return f'"{user_file.size:x}-{int(user_file.uploaded_at.timestamp()):x}{suffix}"'
+
+
+def accepts_encoding(header, codec):
+    """Допускает ли заголовок Accept-Encoding кодек ``codec`` (с учетом ``q=0`` и ``*``)."""
+    weights = {}
+    for item in header.split(','):
+        token, *params = [part.strip() for part in item.split(';')]
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if token:
+            weights[token.lower()] = weight
+    return weights.get(codec, weights.get('*', 0.0)) > 0
+
+
+def parse_range(header, size):
+    """Возвращает список диапазонов ``(start, end)`` включительно.
+
+    ``None`` означает, что заголовок некорректен и его нужно проигнорировать,
+    пустой список - что ни один диапазон не пересекается с файлом (416).
+    Пустой файл отдается целиком: диапазонов в нем нет, а суффиксный дал бы ``(0, -1)``.
+    """
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec or size == 0:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        match = RANGE_RE.match(part)
+        if not match or match.group(1) == match.group(2) == '':
+            return None
+        first, last = match.group(1), match.group(2)
+        if first == '':
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            end = min(int(last), size - 1) if last else size - 1
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _read_ranges(user_file, ranges):
+    """Читает диапазоны исходных байтов; сжатый файл распаковывается на лету."""
+    with user_file.open_content() as fh:
+        for start, end in ranges:
+            fh.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = fh.read(min(READ_BLOCK_SIZE, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+
+
+def _multipart_ranges(user_file, ranges, content_type, boundary):
+    size = user_file.size
+    for start, end in ranges:
+        yield (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+        ).encode()
+        yield from _read_ranges(user_file, [(start, end)])
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+
+def _multipart_length(ranges, size, content_type, boundary):
+    length = len(f'\r\n--{boundary}--\r\n')
+    for start, end in ranges:
+        length += len(
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+        )
+        length += end - start + 1
+    return length
+
+
+async def _async_blocks(blocks):
+    """Отдает блоки синхронного итератора, читая каждый в пуле потоков, а не в цикле событий."""
+    done = object()
+    try:
+        while True:
+            block = await asyncio.to_thread(next, blocks, done)
+            if block is done:
+                break
+            yield block
+    finally:
+        blocks.close()
+
+
+def serve_file(request, user_file, asynchronous=False):
+    """Отдает файл с поддержкой условных запросов и HTTP Range.
+
+    С ``asynchronous=True`` тело ответа - асинхронный итератор для ASGI-представлений.
+    Сжатый на диске файл уходит как есть с Content-Encoding, если клиент его
+    принимает и не просит диапазонов; иначе он распаковывается потоком.
+    """
+    encoding = ''
+    if (user_file.codec and not request.headers.get('Range')
+            and accepts_encoding(request.headers.get('Accept-Encoding', ''), user_file.codec)):
+        encoding = user_file.codec
+    etag = file_etag(user_file, encoding)
+    last_modified = int(user_file.uploaded_at.timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _build_response(request, user_file, etag, last_modified, asynchronous, encoding)
+
+    if user_file.codec:
+        patch_vary_headers(response, ['Accept-Encoding'])
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _offload_response(user_file, content_type):
+    """Ответ без тела: сами байты (и Range) отдает фронтовой веб-сервер через sendfile."""
+    response = HttpResponse(content_type=content_type)
+    if settings.STORAGE_DELIVERY_MODE == 'nginx':
+        location = settings.STORAGE_ACCEL_REDIRECT_LOCATION.rstrip('/')
+        response['X-Accel-Redirect'] = f'{location}/{quote(user_file.file.name)}'
+    elif settings.STORAGE_DELIVERY_MODE == 'sendfile':
+        response['X-Sendfile'] = user_file.file.path
+    else:
+        raise ImproperlyConfigured(f'Неизвестный STORAGE_DELIVERY_MODE: {settings.STORAGE_DELIVERY_MODE}')
+    return response
+
+
+def _encoded_response(user_file, content_type, asynchronous):
+    """Сжатые байты с диска как есть, без распаковки."""
+    storage, name = user_file.file.storage, user_file.file.name
+    if asynchronous:
+        response = StreamingHttpResponse(_async_blocks(_read_stored(user_file)), content_type=content_type)
+        response['Content-Length'] = str(storage.size(name))
+    else:
+        response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+    response['Content-Encoding'] = user_file.codec
+    return response
+
+
+def _read_stored(user_file):
+    with user_file.file.storage.open(user_file.file.name, 'rb') as fh:
+        yield from iter(lambda: fh.read(READ_BLOCK_SIZE), b'')
+
+
+def _build_response(request, user_file, etag, last_modified, asynchronous, encoding=''):
+    content_type = mimetypes.guess_type(user_file.original_name)[0] or 'application/octet-stream'
+    disposition = f'attachment; filename="{get_valid_filename(user_file.original_name)}"'
+    size = user_file.size
+
+    storage = user_file.file.storage
+    # Байты отдает само хранилище по подписанной ссылке, минуя приложение
+    if settings.STORAGE_S3_PRESIGNED_DOWNLOADS and not user_file.codec and hasattr(storage, 'presigned_url'):
+        return HttpResponseRedirect(storage.presigned_url(user_file.file.name, parameters={
+            'response-content-type': content_type, 'response-content-disposition': disposition}))
+
+    # Сжатые файлы отдаем сами: фронтовой сервер не знает об их Content-Encoding
+    if settings.STORAGE_DELIVERY_MODE != 'django' and not user_file.codec and staging.is_local(storage):
+        response = _offload_response(user_file, content_type)
+        response['Content-Disposition'] = disposition
+        return response
+
+    if encoding:
+        response = _encoded_response(user_file, content_type, asynchronous)
+        response['Content-Disposition'] = disposition
+        return response
+
+    ranges = None
+    range_header = request.headers.get('Range')
+    if range_header and request.method == 'GET' and _if_range_matches(request, etag, last_modified):
+        ranges = parse_range(range_header, size)
+
+    if ranges is None and (asynchronous or user_file.codec):
+        body = _read_ranges(user_file, [(0, size - 1)])
+        response = StreamingHttpResponse(_async_blocks(body) if asynchronous else body,
+                                         content_type=content_type)
+        response['Content-Length'] = str(size)
+    elif ranges is None:
+        response = FileResponse(user_file.file.open('rb'), content_type=content_type)
+    elif not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        body = _read_ranges(user_file, ranges)
+        response = StreamingHttpResponse(_async_blocks(body) if asynchronous else body, status=206,
+                                         content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        boundary = uuid.uuid4().hex
+        body = _multipart_ranges(user_file, ranges, content_type, boundary)
+        response = StreamingHttpResponse(
+            _async_blocks(body) if asynchronous else body, status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}')
+        response['Content-Length'] = str(_multipart_length(ranges, size, content_type, boundary))
+
+    response['Content-Disposition'] = disposition
+    return response
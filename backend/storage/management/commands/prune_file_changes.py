@@ -0,0 +1,31 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from storage.models import FileChange
+
+
+class Command(BaseCommand):
+    help = 'Удаляет записи журнала изменений файлов старше STORAGE_CHANGES_RETENTION_DAYS дней'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.STORAGE_CHANGES_RETENTION_DAYS)
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        border = timezone.now() - timedelta(days=options['days'])
+        newest = FileChange.objects.order_by('-id').values_list('id', flat=True).first()
+        if newest is None:
+            return
+        # Удаляется только начало журнала по id: created_at не растет вместе с id (на PostgreSQL now() -
+        # начало транзакции), а дыру посреди журнала since() не заметит. Последняя запись остается всегда:
+        # по ней отличается курсор из будущего от актуального
+        keep = FileChange.objects.filter(created_at__gte=border).order_by('id').values_list('id', flat=True).first()
+        old = FileChange.objects.filter(id__lt=min(keep or newest, newest))
+        deleted = 0
+        while True:
+            ids = list(old.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted += FileChange.objects.filter(id__in=ids).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f'Удалено записей журнала: {deleted}'))
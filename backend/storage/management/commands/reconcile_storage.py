@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from storage.reconcile import Reconciler, ReconcileError
+from storage import staging
+
+LABELS = {
+    'orphan': 'сирота на диске',
+    'missing': 'нет на диске',
+    'size': 'размер не совпадает',
+}
+
+
+class Command(BaseCommand):
+    help = ('Сверяет MEDIA_ROOT с таблицами файлов: файлы без записей, записи без файлов, '
+            'расхождения размера. Без ключей только сообщает о проблемах')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='удалить сирот, исправить размеры, сбросить пропавшие превью и куски загрузок')
+        parser.add_argument('--delete-missing', action='store_true',
+                            help='удалить записи файлов и блобов, содержимого которых нет на диске')
+        parser.add_argument('--workers', type=int, default=8, help='потоков для stat/unlink')
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='не трогать файлы моложе стольких секунд (идущие загрузки)')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='строк БД за одно чтение')
+
+    def handle(self, *args, **options):
+        if not staging.is_local():
+            raise CommandError('Команда работает только с локальным хранилищем (STORAGE_BACKEND=local)')
+        workers = max(1, options['workers'])
+        verbosity = options['verbosity']
+
+        def report(kind, name, detail):
+            if verbosity >= 1:
+                self.stdout.write(f'{LABELS[kind]}: {name} ({detail})')
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            reconciler = Reconciler(
+                str(settings.MEDIA_ROOT), pool, workers, report, fix=options['fix'],
+                delete_missing=options['delete_missing'], min_age=options['min_age'],
+                chunk_size=options['chunk_size'])
+            try:
+                stats = reconciler.run()
+            except ReconcileError as e:
+                raise CommandError(str(e))
+
+        if stats['sizes_fixed'] or stats['missing_fixed']:
+            call_command('recount_usage', stdout=self.stdout)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Файлов на диске: {stats['disk_files']}, записей в БД: {stats['db_records']}; "
+            f"сирот: {stats['orphans']} ({stats['orphan_bytes']} байт), нет на диске: {stats['missing']}, "
+            f"расхождений размера: {stats['size_mismatches']}, пропущено свежих: {stats['skipped_recent']}; "
+            f"удалено сирот: {stats['orphans_removed']}, исправлено размеров: {stats['sizes_fixed']}, "
+            f"исправлено пропаж: {stats['missing_fixed']}"))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from storage.models import FileVersion, StorageUsage, UserFile
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики занятого места (StorageUsage) по таблице файлов и истории версий'
+
+    def handle(self, *args, **options):
+        totals = {
+            row['user']: row
+            for row in UserFile.objects.order_by().values('user').annotate(bytes=Sum('size'), files=Count('id'))
+        }
+        # История версий учитывается в квоте так же, как при ее записи (storage.versions)
+        history = FileVersion.objects.all().history_usage()
+        usages = [
+            StorageUsage(user_id=user_id,
+                         bytes_used=(totals.get(user_id, {}).get('bytes') or 0) + history[user_id],
+                         files_count=totals.get(user_id, {}).get('files') or 0)
+            for user_id in CustomUser.objects.values_list('pk', flat=True).iterator()
+        ]
+        StorageUsage.objects.bulk_create(usages, batch_size=1000, update_conflicts=True,
+                                         unique_fields=['user'], update_fields=['bytes_used', 'files_count'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано пользователей: {len(usages)}'))
@@ -0,0 +1,123 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Avg, F, Max
+from django.utils import timezone
+from storage.models import PreviewJob, UserFile
+from storage.previews import RenderProcess, delete_previews, timed_render_preview
+from storage import staging
+
+
+class Command(BaseCommand):
+    help = 'Строит превью файлов из очереди PreviewJob в дочерних процессах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.STORAGE_PREVIEW_WORKERS,
+                            help='сколько задач выполнять одновременно')
+        parser.add_argument('--poll', type=float, default=1.0, help='пауза между опросами очереди, с')
+        parser.add_argument('--once', action='store_true', help='выйти, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        if not staging.is_local():
+            raise CommandError('Команда работает только с локальным хранилищем (STORAGE_BACKEND=local)')
+        self.processes = max(1, options['processes'])
+        self.timeout = settings.STORAGE_PREVIEW_TIMEOUT
+        self.requeue_stale()
+
+        inflight = {}
+        processed = 0
+        try:
+            while True:
+                for job_id, (result, job) in list(inflight.items()):
+                    if result.ready():
+                        self.finish(job, result)
+                        del inflight[job_id]
+                        processed += 1
+
+                claimed = self.claim(self.processes - len(inflight))
+                for job in claimed:
+                    # Превью кладется рядом с содержимым файла (для блоба - рядом с блобом)
+                    path = job.user_file.file.path
+                    # Соединения с БД не должны достаться дочернему процессу при fork
+                    connections.close_all()
+                    inflight[job.pk] = (RenderProcess(
+                        timed_render_preview,
+                        (path, path, job.user_file.original_name, self.timeout, job.user_file.codec),
+                        self.timeout), job)
+
+                if options['once'] and not inflight and not claimed:
+                    break
+                if not claimed:
+                    time.sleep(min(options['poll'], 0.05) if inflight else options['poll'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for result, _ in inflight.values():
+                result.kill()
+            # Недоделанные задачи возвращаем в очередь, попытка не засчитывается
+            PreviewJob.objects.filter(pk__in=inflight.keys()).update(
+                status=PreviewJob.STATUS_PENDING, attempts=F('attempts') - 1)
+        self.report(processed)
+
+    def requeue_stale(self):
+        """Задачи, брошенные упавшим воркером, возвращаются в очередь."""
+        stale_before = timezone.now() - timedelta(seconds=self.timeout * 10)
+        PreviewJob.objects.filter(status=PreviewJob.STATUS_RUNNING, started_at__lt=stale_before).update(
+            status=PreviewJob.STATUS_PENDING)
+
+    def claim(self, limit):
+        if limit <= 0:
+            return []
+        now = timezone.now()
+        candidates = (PreviewJob.objects.select_related('user_file')
+                      .filter(status=PreviewJob.STATUS_PENDING, run_after__lte=now)[:limit * 2])
+        claimed = []
+        for job in candidates:
+            # Условный UPDATE: задачу забирает только один воркер, даже если их несколько
+            if PreviewJob.objects.filter(pk=job.pk, status=PreviewJob.STATUS_PENDING).update(
+                    status=PreviewJob.STATUS_RUNNING, started_at=now, attempts=F('attempts') + 1):
+                job.attempts += 1
+                job.started_at = now
+                claimed.append(job)
+                if len(claimed) == limit:
+                    break
+        return claimed
+
+    def finish(self, job, result):
+        now = timezone.now()
+        job.finished_at = now
+        job.duration = (now - job.started_at).total_seconds()
+        try:
+            suffix, job.duration = result.get()
+        except Exception as e:
+            job.error = f'{type(e).__name__}: {e}'
+            if job.attempts < settings.STORAGE_PREVIEW_MAX_ATTEMPTS:
+                job.status = PreviewJob.STATUS_PENDING
+                job.run_after = now + timedelta(seconds=10 * 2 ** job.attempts)
+            else:
+                job.status = PreviewJob.STATUS_FAILED
+        else:
+            job.status = PreviewJob.STATUS_DONE
+            job.error = ''
+            if suffix:
+                # Содержимое сменилось, пока строилось превью: старое превью к новому не прикрепляем
+                UserFile.objects.filter(pk=job.user_file_id, file=job.user_file.file.name).update(
+                    preview=job.user_file.file.name + suffix)
+        updated = PreviewJob.objects.filter(pk=job.pk).update(
+            status=job.status, finished_at=job.finished_at, duration=job.duration, error=job.error,
+            run_after=job.run_after)
+        # Файл удален во время построения (задача ушла каскадом): превью больше никому не нужно,
+        # если содержимое (например, общий блоб) не осталось у других файлов
+        name = job.user_file.file.name
+        if not updated and not UserFile.objects.filter(file=name).exists():
+            delete_previews(job.user_file.file.storage, name)
+
+    def report(self, processed):
+        stats = PreviewJob.objects.filter(status=PreviewJob.STATUS_DONE, duration__isnull=False).aggregate(
+            avg=Avg('duration'), max=Max('duration'))
+        pending = PreviewJob.objects.filter(status=PreviewJob.STATUS_PENDING).count()
+        self.stdout.write(
+            f"Обработано задач: {processed}; в очереди: {pending}; "
+            f"время задачи, с: среднее {stats['avg'] or 0:.3f}, максимум {stats['max'] or 0:.3f}")
@@ -0,0 +1,124 @@
+import collections
+import os
+import posixpath
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from storage.models import UserFile, sharded_path
+from storage.previews import PREVIEW_SUFFIXES
+from storage import staging
+
+
+def _link(root, source, target):
+    """Создает ``target`` как жесткую ссылку на ``source`` (копию, если ссылки не поддерживаются)."""
+    source_path, target_path = os.path.join(root, source), os.path.join(root, target)
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        # Остался от прерванного запуска: подходит, только если это тот же файл
+        if not os.path.samefile(source_path, target_path):
+            raise
+    except OSError:
+        if not os.path.exists(source_path):
+            raise
+        shutil.copy2(source_path, target_path)
+
+
+def _link_move(root, move):
+    """Связывает новое место файла и его превью со старым; возвращает пары (старое, новое) или None."""
+    _, name, _, target = move
+    if not os.path.exists(os.path.join(root, name)):
+        return None
+    pairs = [(name, target)] + [(name + suffix, target + suffix) for suffix in PREVIEW_SUFFIXES
+                                if os.path.exists(os.path.join(root, name + suffix))]
+    for source, destination in pairs:
+        _link(root, source, destination)
+    return pairs
+
+
+def _unlink(root, names):
+    for name in names:
+        try:
+            os.remove(os.path.join(root, name))
+        except FileNotFoundError:
+            pass
+
+
+class Command(BaseCommand):
+    help = ('Переносит файлы пользователей (вне блобов) в раскладку STORAGE_USER_DIR_LEVELS и обновляет '
+            'UserFile.file пачками, не останавливая сервис. Повторный запуск продолжает с того же места: '
+            'уже перенесенные файлы пропускаются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='файлов в одной транзакции')
+        parser.add_argument('--workers', type=int, default=4, help='потоков для операций с файлами')
+        parser.add_argument('--start-id', type=int, default=0, help='начать с файлов с id больше этого')
+        parser.add_argument('--unlink-delay', type=float, default=5,
+                            help='через сколько секунд после обновления записей удалять старые пути '
+                                 '(запросы, уже прочитавшие запись, успеют открыть файл)')
+        parser.add_argument('--dry-run', action='store_true', help='только посчитать, что нужно перенести')
+
+    def handle(self, *args, **options):
+        if not staging.is_local():
+            raise CommandError('Команда работает только с локальным хранилищем (STORAGE_BACKEND=local)')
+        root = str(settings.MEDIA_ROOT)
+        stats = collections.Counter()
+        # (время, после которого можно удалять, старые пути)
+        pending = collections.deque()
+        last_pk = options['start_id']
+
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            while True:
+                rows = list(UserFile.objects.filter(blob__isnull=True, pk__gt=last_pk).exclude(file='')
+                            .order_by('pk').values_list('pk', 'file', 'preview', 'user__storage_path')
+                            [:options['batch_size']])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+                stats['scanned'] += len(rows)
+                moves = [(pk, name, preview, target) for pk, name, preview, directory in rows
+                         if (target := sharded_path(directory, posixpath.basename(name))) != name]
+                if options['dry_run']:
+                    stats['to_move'] += len(moves)
+                    continue
+
+                linked = list(pool.map(lambda move: _link_move(root, move), moves))
+                stale, done = [], []
+                with transaction.atomic():
+                    for move, pairs in zip(moves, linked):
+                        pk, name, preview, target = move
+                        if pairs is None:
+                            stats['missing'] += 1
+                            self.stderr.write(f'Нет на диске: {name} (файл #{pk})')
+                            continue
+                        new_preview = target + preview[len(name):] if preview.startswith(name + '.') else preview
+                        # Условие по старому имени: запись могли удалить или перезаписать за это время
+                        if UserFile.objects.filter(pk=pk, file=name).update(file=target, preview=new_preview):
+                            done.extend(source for source, _ in pairs)
+                            stats['moved'] += 1
+                        else:
+                            stale.extend(destination for _, destination in pairs)
+                            stats['skipped'] += 1
+                _unlink(root, stale)
+                pending.append((time.monotonic() + options['unlink_delay'], done))
+                while pending and pending[0][0] <= time.monotonic():
+                    pool.submit(_unlink, root, pending.popleft()[1])
+                if options['verbosity'] >= 2:
+                    self.stdout.write(f"Обработано до id {last_pk}: перенесено {stats['moved']}")
+
+            while pending:
+                deadline, names = pending.popleft()
+                time.sleep(max(0, deadline - time.monotonic()))
+                pool.submit(_unlink, root, names)
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Проверено файлов: {stats['scanned']}, нужно перенести: {stats['to_move']}"))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Проверено файлов: {stats['scanned']}, перенесено: {stats['moved']}, "
+            f"нет на диске: {stats['missing']}, изменились во время переноса: {stats['skipped']}"))
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0003_upload_session'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfile',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0005_blob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userfile',
+            index=models.Index(fields=['user', 'uploaded_at', 'id'], name='userfile_user_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfile',
+            index=models.Index(fields=['user', 'original_name', 'id'], name='userfile_user_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfile',
+            index=models.Index(fields=['user', 'size', 'id'], name='userfile_user_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfile',
+            index=models.Index(fields=['uploaded_at', 'id'], name='userfile_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfile',
+            index=models.Index(fields=['original_name', 'id'], name='userfile_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfile',
+            index=models.Index(fields=['size', 'id'], name='userfile_size_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0006_userfile_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfile',
+            name='download_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
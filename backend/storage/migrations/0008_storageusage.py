@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_usage(apps, schema_editor):
+    UserFile = apps.get_model('storage', 'UserFile')
+    StorageUsage = apps.get_model('storage', 'StorageUsage')
+    rows = UserFile.objects.order_by().values('user').annotate(
+        bytes=models.Sum('size'), files=models.Count('id'))
+    StorageUsage.objects.bulk_create(
+        [StorageUsage(user_id=row['user'], bytes_used=row['bytes'] or 0, files_count=row['files'])
+         for row in rows],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_customuser_storage_quota'),
+        ('storage', '0007_userfile_download_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes_used', models.BigIntegerField(default=0)),
+                ('files_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(fill_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0008_storageusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfile',
+            name='preview',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.CreateModel(
+            name='PreviewJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('user_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='preview_jobs', to='storage.userfile')),
+            ],
+            options={
+                'ordering': ['run_after', 'id'],
+                'indexes': [models.Index(fields=['status', 'run_after'], name='previewjob_queue_idx')],
+            },
+        ),
+    ]
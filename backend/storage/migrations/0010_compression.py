@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0009_preview_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='codec',
+            field=models.CharField(blank=True, choices=[('', 'Без сжатия'), ('gzip', 'gzip')], max_length=10),
+        ),
+        migrations.AddField(
+            model_name='userfile',
+            name='codec',
+            field=models.CharField(blank=True, choices=[('', 'Без сжатия'), ('gzip', 'gzip')], max_length=10),
+        ),
+    ]
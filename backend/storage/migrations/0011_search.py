@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    from storage.search import ensure_index
+    ensure_index(schema_editor.connection)
+
+
+def drop_index(apps, schema_editor):
+    from storage.search import drop_index
+    drop_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0010_compression'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
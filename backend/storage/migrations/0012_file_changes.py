@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def create_triggers(apps, schema_editor):
+    from storage.changes import ensure_triggers
+    ensure_triggers(schema_editor.connection)
+
+
+def drop_triggers(apps, schema_editor):
+    from storage.changes import drop_triggers
+    drop_triggers(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('storage', '0011_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_id', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('create', 'Создан'), ('rename', 'Переименован'), ('comment', 'Комментарий'), ('delete', 'Удален')], max_length=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['user', 'id'], name='filechange_user_idx'), models.Index(fields=['created_at'], name='filechange_created_idx')],
+            },
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
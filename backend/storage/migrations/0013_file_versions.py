@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_triggers(apps, schema_editor):
+    # Триггер журнала на смену sha256 (запись 'update')
+    from storage.changes import ensure_triggers
+    ensure_triggers(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0012_file_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('size', models.BigIntegerField(default=0)),
+                ('sha256', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='storage.userfile')),
+            ],
+            options={
+                'ordering': ['-number'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='filechange',
+            name='kind',
+            field=models.CharField(choices=[('create', 'Создан'), ('rename', 'Переименован'), ('comment', 'Комментарий'), ('update', 'Изменено содержимое'), ('delete', 'Удален')], max_length=10),
+        ),
+        migrations.CreateModel(
+            name='VersionChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='version_chunks', to='storage.blob')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='storage.fileversion')),
+            ],
+            options={
+                'ordering': ['version', 'index'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='versionchunk',
+            constraint=models.UniqueConstraint(fields=('version', 'index'), name='versionchunk_index_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='fileversion',
+            constraint=models.UniqueConstraint(fields=('user_file', 'number'), name='fileversion_number_unique'),
+        ),
+        migrations.RunPython(create_triggers, migrations.RunPython.noop),
+    ]
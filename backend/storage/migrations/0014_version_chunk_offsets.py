@@ -0,0 +1,68 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:05
+
+from collections import defaultdict
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_chunks(apps, schema_editor):
+    VersionChunk = apps.get_model('storage', 'VersionChunk')
+    FileVersion = apps.get_model('storage', 'FileVersion')
+    StorageUsage = apps.get_model('storage', 'StorageUsage')
+    offsets = {}
+    chunks = []
+    for chunk in VersionChunk.objects.select_related('blob').order_by('version_id', 'index').iterator():
+        chunk.sha256, chunk.size = chunk.blob.sha256, chunk.blob.size
+        chunk.offset = offsets.get(chunk.version_id, 0)
+        offsets[chunk.version_id] = chunk.offset + chunk.size
+        chunks.append(chunk)
+    VersionChunk.objects.bulk_update(chunks, ['sha256', 'size', 'offset'], batch_size=1000)
+
+    # Прежние версии теперь учитываются в квоте; последняя - это текущее содержимое файла
+    latest = {}
+    history = defaultdict(int)
+    for user_id, user_file_id, number, size in FileVersion.objects.order_by('user_file_id', '-number').values_list(
+            'user_file__user_id', 'user_file_id', 'number', 'size'):
+        if user_file_id in latest:
+            history[user_id] += size
+        latest.setdefault(user_file_id, number)
+    for user_id, size in history.items():
+        StorageUsage.objects.filter(user_id=user_id).update(bytes_used=models.F('bytes_used') + size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0013_file_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='versionchunk',
+            name='offset',
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='versionchunk',
+            name='sha256',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='versionchunk',
+            name='size',
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='versionchunk',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='version_chunks', to='storage.blob'),
+        ),
+        migrations.RunPython(fill_chunks, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='versionchunk',
+            index=models.Index(fields=['sha256'], name='versionchunk_sha256_idx'),
+        ),
+    ]
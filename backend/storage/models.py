@@ -1,11 +1,100 @@
+import hashlib
 import os
 import uuid
-from django.db import models
+from collections import Counter, defaultdict
+from django.db import models, transaction
+from django.db.models import Case, F, Max, Value, When
+from django.utils import timezone
+from .compression import CODEC_CHOICES, open_stored
+from .previews import delete_previews, preview_kind
 from django.conf import settings
+from django.core.files.storage import default_storage
+
+
+def sharded_path(directory, filename):
+    """``directory/ab/cd/filename`` при STORAGE_USER_DIR_LEVELS = 2: ab, cd - начало MD5 имени файла."""
+    digest = hashlib.md5(filename.encode(), usedforsecurity=False).hexdigest()
+    levels = [digest[2 * i:2 * i + 2] for i in range(settings.STORAGE_USER_DIR_LEVELS)]
+    return '/'.join([directory, *levels, filename])
 
 
 def user_directory_path(instance, filename):
-    return f"{instance.user.storage_path}/{uuid.uuid4()}_{filename}"
+    # Имя приводится к допустимому заранее: по нему считается подкаталог, и хранилище не должно его менять
+    return sharded_path(instance.user.storage_path, default_storage.get_valid_name(f"{uuid.uuid4()}_{filename}"))
+
+
+def blob_path(sha256):
+    return f"{settings.STORAGE_BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+def file_sha256(file):
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    if getattr(file, '_committed', False):
+        file.close()
+    return digest.hexdigest()
+
+
+class Blob(models.Model):
+    """Содержимое файла, общее для всех ``UserFile`` с одинаковым SHA-256."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(max_length=500)
+    size = models.BigIntegerField(default=0)
+    codec = models.CharField(max_length=10, choices=CODEC_CHOICES, blank=True)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256} ({self.ref_count})"
+
+    @classmethod
+    def release(cls, pk, count=1):
+        """Снимает ``count`` ссылок и удаляет блоб, когда ссылок не осталось; файл - после коммита."""
+        cls.release_many({pk: count})
+
+    @classmethod
+    def release_many(cls, counts):
+        """То же для нескольких блобов сразу: ``counts`` - словарь {pk блоба: число ссылок}."""
+        if not counts:
+            return
+        with transaction.atomic():
+            cls.objects.filter(pk__in=counts).update(ref_count=F('ref_count') - Case(
+                *[When(pk=pk, then=Value(count)) for pk, count in counts.items()], default=Value(0)))
+            unused = list(cls.objects.select_for_update().filter(pk__in=counts, ref_count__lte=0))
+            if unused:
+                cls.objects.filter(pk__in=[blob.pk for blob in unused]).delete()
+                # Файлы - только после коммита: при откате строки блобов остаются, и байты им нужны
+                names = [blob.file.name for blob in unused]
+                transaction.on_commit(lambda: [_delete_stored(default_storage, name) for name in names])
+
+
+def _delete_stored(storage, name):
+    storage.delete(name)
+    delete_previews(storage, name)
+
+
+class UserFileQuerySet(models.QuerySet):
+    def delete_with_storage(self):
+        """Удаляет файлы пачкой вместе с блобами и счетчиками; файлы с диска - после коммита."""
+        with transaction.atomic():
+            rows = list(self.order_by().values_list('user_id', 'blob_id', 'size', 'file'))
+            FileVersion.objects.filter(user_file__in=self.order_by().values('pk')).delete_with_chunks()
+            deleted, _ = self.delete()
+
+            Blob.release_many(Counter(row[1] for row in rows if row[1]))
+
+            usage = defaultdict(lambda: [0, 0])
+            for user_id, _, size, _ in rows:
+                usage[user_id][0] += size
+                usage[user_id][1] += 1
+            for user_id, (size, files) in usage.items():
+                StorageUsage.release(user_id, size, files)
+
+            names = [row[3] for row in rows if not row[1] and row[3]]
+            if names:
+                transaction.on_commit(lambda: [_delete_stored(default_storage, name) for name in names])
+        return deleted
 
 
 class UserFile(models.Model):
@@ -15,18 +104,262 @@ class UserFile(models.Model):
     size = models.BigIntegerField(default=0)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     last_downloaded_at = models.DateTimeField(null=True, blank=True)
+    download_count = models.PositiveIntegerField(default=0)
     comment = models.TextField(blank=True)
     share_link = models.UUIDField(default=uuid.uuid4, unique=True)
     file_path = models.CharField(max_length=500, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='user_files')
+    preview = models.CharField(max_length=500, blank=True)
+    codec = models.CharField(max_length=10, choices=CODEC_CHOICES, blank=True)
+
+    objects = UserFileQuerySet.as_manager()
 
     class Meta:
         ordering = ['-uploaded_at']
+        # Под keyset-пагинацию file_list: (поле сортировки, id) для своих файлов и для всех
+        indexes = [
+            models.Index(fields=['user', 'uploaded_at', 'id'], name='userfile_user_uploaded_idx'),
+            models.Index(fields=['user', 'original_name', 'id'], name='userfile_user_name_idx'),
+            models.Index(fields=['user', 'size', 'id'], name='userfile_user_size_idx'),
+            models.Index(fields=['uploaded_at', 'id'], name='userfile_uploaded_idx'),
+            models.Index(fields=['original_name', 'id'], name='userfile_name_idx'),
+            models.Index(fields=['size', 'id'], name='userfile_size_idx'),
+        ]
 
     def __str__(self):
         return f"{self.original_name} ({self.user.username})"
 
     def save(self, *args, **kwargs):
         if not self.pk and self.file:
-            self.original_name = os.path.basename(self.file.name)
-            self.size = self.file.size
+            self.original_name = self.original_name or os.path.basename(self.file.name)
+            # size - размер исходных байтов; сжатый файл на диске меньше
+            if self.blob is not None:
+                self.size = self.blob.size
+                self.codec = self.blob.codec
+            elif not self.codec:
+                self.size = self.file.size
+            self.sha256 = self.sha256 or file_sha256(self.file)
+        created = self.pk is None
         super().save(*args, **kwargs)
+        if created and settings.STORAGE_PREVIEWS_ENABLED and preview_kind(self.original_name):
+            PreviewJob.objects.create(user_file=self)
+
+    def open_content(self):
+        """Открывает файл на чтение исходных байтов, распаковывая их, если файл хранится сжатым."""
+        return open_stored(self.file.storage, self.file.name, self.codec)
+
+    def release_content(self):
+        """Снимает ссылку на блоб текущего содержимого или удаляет отдельный файл после коммита."""
+        if self.blob_id:
+            Blob.release(self.blob_id)
+        elif self.file:
+            storage, name = self.file.storage, self.file.name
+            transaction.on_commit(lambda: _delete_stored(storage, name))
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self.versions.all().delete_with_chunks()
+            result = super().delete(*args, **kwargs)
+            StorageUsage.release(self.user_id, self.size)
+            self.release_content()
+        return result
+
+
+class StorageUsage(models.Model):
+    """Денормализованные счетчики занятого пользователем места."""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name='storage_usage')
+    bytes_used = models.BigIntegerField(default=0)
+    files_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.bytes_used} ({self.files_count})"
+
+    @classmethod
+    def has_room(cls, user, size):
+        if user.quota is None:
+            return True
+        usage = cls.objects.filter(user_id=user.pk).values_list('bytes_used', flat=True).first() or 0
+        return usage + size <= user.quota
+
+    @classmethod
+    def charge(cls, user, size, files=1):
+        """Атомарно учитывает новые файлы, если они помещаются в квоту.
+
+        Проверка и увеличение делаются одним UPDATE, поэтому параллельные
+        загрузки не могут вместе превысить квоту. Возвращает ``False`` при превышении.
+        """
+        cls.objects.get_or_create(user_id=user.pk)
+        usage = cls.objects.filter(user_id=user.pk)
+        if user.quota is not None:
+            usage = usage.filter(bytes_used__lte=user.quota - size)
+        return bool(usage.update(bytes_used=F('bytes_used') + size, files_count=F('files_count') + files))
+
+    @classmethod
+    def release(cls, user_id, size, files=1):
+        cls.objects.filter(user_id=user_id).update(
+            bytes_used=F('bytes_used') - size, files_count=F('files_count') - files)
+
+
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+    original_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    part_path = models.CharField(max_length=500)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.original_name} ({self.received}/{self.size})"
+
+    def save(self, *args, **kwargs):
+        if not self.part_path:
+            self.part_path = f"{self.user.storage_path}/.uploads/{self.id}.part"
+        super().save(*args, **kwargs)
+
+    @property
+    def is_complete(self):
+        return self.received >= self.size
+
+
+class PreviewJob(models.Model):
+    """Задача очереди на построение превью; выполняется командой run_preview_worker."""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Готово'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    user_file = models.ForeignKey(UserFile, on_delete=models.CASCADE, related_name='preview_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['run_after', 'id']
+        indexes = [models.Index(fields=['status', 'run_after'], name='previewjob_queue_idx')]
+
+    def __str__(self):
+        return f"{self.user_file_id}: {self.status}"
+
+
+class FileChange(models.Model):
+    """Запись журнала изменений файлов для синхронизации клиентов (storage.changes).
+
+    Строки пишут триггеры БД в той же транзакции, что и изменение ``storage_userfile``,
+    поэтому журнал не расходится с таблицей ни при каком способе изменения.
+    """
+    KIND_CREATE = 'create'
+    KIND_RENAME = 'rename'
+    KIND_COMMENT = 'comment'
+    KIND_UPDATE = 'update'
+    KIND_DELETE = 'delete'
+    KIND_CHOICES = [
+        (KIND_CREATE, 'Создан'),
+        (KIND_RENAME, 'Переименован'),
+        (KIND_COMMENT, 'Комментарий'),
+        (KIND_UPDATE, 'Изменено содержимое'),
+        (KIND_DELETE, 'Удален'),
+    ]
+
+    # Без внешних ключей: записи об удаленных файлах и пользователях живут до очистки по сроку
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING, db_constraint=False,
+                             related_name='+')
+    file_id = models.BigIntegerField()
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['user', 'id'], name='filechange_user_idx'),
+            models.Index(fields=['created_at'], name='filechange_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.file_id}: {self.kind}"
+
+
+class FileVersionQuerySet(models.QuerySet):
+    def history_usage(self):
+        """Байты истории по пользователям: размеры версий, кроме последней версии каждого файла.
+
+        Последняя версия - текущее содержимое файла, оно уже учтено в его размере.
+        """
+        rows = list(FileVersion.objects.filter(pk__in=self.order_by().values('pk'))
+                    .values_list('user_file__user_id', 'user_file_id', 'number', 'size'))
+        latest = dict(FileVersion.objects.filter(user_file_id__in={row[1] for row in rows}).order_by()
+                      .values('user_file_id').annotate(last=Max('number')).values_list('user_file_id', 'last'))
+        usage = Counter()
+        for user_id, user_file_id, number, size in rows:
+            if number != latest[user_file_id]:
+                usage[user_id] += size
+        return usage
+
+    def delete_with_chunks(self):
+        """Удаляет версии, снимает ссылки на блобы их кусков и возвращает место истории в квоту."""
+        with transaction.atomic():
+            usage = self.history_usage()
+            chunks = Counter(VersionChunk.objects.filter(version__in=self.order_by().values('pk'), blob__isnull=False)
+                             .values_list('blob_id', flat=True))
+            deleted, _ = self.delete()
+            Blob.release_many(chunks)
+            for user_id, size in usage.items():
+                StorageUsage.release(user_id, size, files=0)
+        return deleted
+
+
+class FileVersion(models.Model):
+    """Версия содержимого файла - список кусков (storage.versions)."""
+    user_file = models.ForeignKey(UserFile, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    size = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = FileVersionQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-number']
+        constraints = [models.UniqueConstraint(fields=['user_file', 'number'], name='fileversion_number_unique')]
+
+    def __str__(self):
+        return f"{self.user_file_id} v{self.number}"
+
+
+class VersionChunk(models.Model):
+    """Кусок версии: ``index``-й по порядку, ``offset`` - его начало в байтах версии.
+
+    Куски прежних версий хранятся блобами с SHA-256 куска; у последней версии
+    ``blob`` пуст - ее байты лежат только в содержимом файла.
+    """
+    version = models.ForeignKey(FileVersion, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField()
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='version_chunks')
+
+    class Meta:
+        ordering = ['version', 'index']
+        constraints = [models.UniqueConstraint(fields=['version', 'index'], name='versionchunk_index_unique')]
+        indexes = [models.Index(fields=['sha256'], name='versionchunk_sha256_idx')]
+
+    def __str__(self):
+        return f"{self.version_id}#{self.index}: {self.sha256}"
@@ -0,0 +1,139 @@
+import base64
+import json
+import math
+from datetime import datetime, time
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils import timezone
+
+SORT_FIELDS = ('uploaded_at', 'original_name', 'size')
+DEFAULT_SORT = '-uploaded_at'
+
+# Целые из курсора должны помещаться в BIGINT
+MAX_INT = 2 ** 63 - 1
+
+
+class ListingError(ValueError):
+    pass
+
+
+def _parse_moment(value, name):
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(value)
+            moment = datetime.combine(day, time.min)
+    except ValueError:
+        raise ListingError(f'Неверный формат даты в параметре {name}')
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _parse_int(value, name):
+    try:
+        return int(value)
+    except ValueError:
+        raise ListingError(f'Параметр {name} должен быть целым числом')
+
+
+def parse_limit(params):
+    limit = _parse_int(params.get('limit', settings.STORAGE_LIST_PAGE_SIZE), 'limit')
+    return max(1, min(limit, settings.STORAGE_LIST_MAX_PAGE_SIZE))
+
+
+def parse_sort(params):
+    sort = params.get('sort', DEFAULT_SORT)
+    if sort.lstrip('-') not in SORT_FIELDS:
+        raise ListingError(f'Сортировка возможна только по полям: {", ".join(SORT_FIELDS)}')
+    return sort
+
+
+def apply_filters(queryset, params):
+    """Фильтры по префиксу имени, диапазону размера и диапазону даты загрузки."""
+    if params.get('name'):
+        queryset = queryset.filter(original_name__startswith=params['name'])
+    if params.get('size_min'):
+        queryset = queryset.filter(size__gte=_parse_int(params['size_min'], 'size_min'))
+    if params.get('size_max'):
+        queryset = queryset.filter(size__lte=_parse_int(params['size_max'], 'size_max'))
+    if params.get('uploaded_after'):
+        queryset = queryset.filter(uploaded_at__gte=_parse_moment(params['uploaded_after'], 'uploaded_after'))
+    if params.get('uploaded_before'):
+        queryset = queryset.filter(uploaded_at__lt=_parse_moment(params['uploaded_before'], 'uploaded_before'))
+    return queryset
+
+
+def encode_cursor(sort, value, pk):
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, pk], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and -MAX_INT <= value <= MAX_INT
+
+
+def _cursor_value(field, value):
+    """Значение поля сортировки из курсора нужного типа или ``None``, если курсор подделан."""
+    if field == 'uploaded_at':
+        try:
+            moment = parse_datetime(value) if isinstance(value, str) else None
+        except ValueError:
+            return None
+        if moment is not None and timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        return moment
+    if field == 'size':
+        return value if _is_int(value) else None
+    if field == 'rank':
+        # Релевантность поиска (storage.search.ranked)
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+        return float(value) if valid else None
+    return value if isinstance(value, str) else None
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, value, pk = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ListingError('Неверный курсор')
+    if cursor_sort != sort:
+        raise ListingError('Курсор получен для другой сортировки')
+    value = _cursor_value(sort.lstrip('-'), value)
+    if value is None or not _is_int(pk):
+        raise ListingError('Неверный курсор')
+    return value, pk
+
+
+def paginate(queryset, params):
+    """Keyset-пагинация по паре (поле сортировки, id).
+
+    Возвращает страницу объектов (или словарей для ``values()``) и курсор следующей страницы (``None`` на последней).
+    """
+    sort = parse_sort(params)
+    field = sort.lstrip('-')
+    descending = sort.startswith('-')
+    limit = parse_limit(params)
+
+    queryset = queryset.order_by(sort, '-id' if descending else 'id')
+    if params.get('cursor'):
+        value, pk = decode_cursor(params['cursor'], sort)
+        op = 'lt' if descending else 'gt'
+        queryset = queryset.filter(Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'id__{op}': pk}))
+
+    page = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        if isinstance(last, dict):
+            next_cursor = encode_cursor(sort, last[field], last['id'])
+        else:
+            next_cursor = encode_cursor(sort, getattr(last, field), last.pk)
+    return page, next_cursor
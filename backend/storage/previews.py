@@ -0,0 +1,162 @@
+"""Построение превью в дочерних процессах воркера (manage.py run_preview_worker).
+
+Функции этого модуля не обращаются к БД: воркер передает им пути на диске
+и сам записывает результат. Каждое превью строится в отдельном процессе
+(``RenderProcess``), который по таймауту убивается вместе со своими
+потомками - зависание внутри C-кода Pillow или pdftoppm не занимает слот навсегда. Pillow и pdftoppm (poppler-utils) необязательны:
+без них превью картинок и PDF просто не строятся. Сжатые на диске файлы
+(``codec``) читаются с распаковкой; PDF не сжимаются никогда.
+"""
+import gzip
+import multiprocessing
+import mimetypes
+import os
+import shutil
+import signal
+import subprocess
+import time
+
+PREVIEW_SIZE = 256
+TEXT_PREVIEW_BYTES = 4096
+PREVIEW_SUFFIXES = ('.preview.jpg', '.preview.png', '.preview.txt')
+TEXT_MIME_TYPES = {'application/json', 'application/xml', 'application/javascript', 'application/x-sh'}
+
+
+def preview_kind(name):
+    mime = mimetypes.guess_type(name)[0] or ''
+    if mime == 'application/pdf':
+        return 'pdf'
+    if mime.startswith('image/') and mime != 'image/svg+xml':
+        return 'image'
+    if mime.startswith('text/') or mime in TEXT_MIME_TYPES:
+        return 'text'
+    return None
+
+
+def existing_preview(target_base):
+    """Превью, уже построенное для того же содержимого (например, для общего блоба)."""
+    for suffix in PREVIEW_SUFFIXES:
+        if os.path.exists(target_base + suffix):
+            return suffix
+    return None
+
+
+def delete_previews(storage, name):
+    for suffix in PREVIEW_SUFFIXES:
+        storage.delete(name + suffix)
+
+
+def _open_source(source_path, codec):
+    return gzip.open(source_path, 'rb') if codec else open(source_path, 'rb')
+
+
+def render_preview(source_path, target_base, original_name, timeout, codec=''):
+    """Строит превью рядом с ``target_base``; возвращает суффикс файла превью или ``None``."""
+    suffix = existing_preview(target_base)
+    if suffix:
+        return suffix
+
+    kind = preview_kind(original_name)
+    if kind == 'image':
+        return _render_image(source_path, target_base, codec)
+    if kind == 'pdf':
+        return _render_pdf(source_path, target_base, timeout)
+    if kind == 'text':
+        return _render_text(source_path, target_base, codec)
+    return None
+
+
+def timed_render_preview(*args):
+    """``render_preview`` плюс чистое время построения в секундах, без ожидания в очереди пула."""
+    started = time.perf_counter()
+    suffix = render_preview(*args)
+    return suffix, time.perf_counter() - started
+
+
+def _run(sender, function, args):
+    # Своя группа процессов: по таймауту убиваются и запущенные отсюда pdftoppm
+    os.setpgrp()
+    try:
+        sender.send((True, function(*args)))
+    except BaseException as e:
+        sender.send((False, e))
+
+
+class RenderProcess:
+    """Вызов ``function(*args)`` в отдельном процессе; интерфейс как у ``AsyncResult`` пула."""
+
+    def __init__(self, function, args, timeout):
+        context = multiprocessing.get_context('fork')
+        self._receiver, sender = context.Pipe(duplex=False)
+        self._process = context.Process(target=_run, args=(sender, function, args), daemon=True)
+        self._process.start()
+        sender.close()
+        self._deadline = time.monotonic() + timeout
+        self._outcome = None
+
+    def ready(self):
+        if self._outcome is None:
+            if self._receiver.poll():
+                try:
+                    self._outcome = self._receiver.recv()
+                except EOFError:
+                    self._process.join()
+                    self._outcome = (False, RuntimeError(
+                        f'Процесс превью завершился с кодом {self._process.exitcode}'))
+            elif time.monotonic() > self._deadline:
+                self._outcome = (False, TimeoutError('Превышено время построения превью'))
+            else:
+                return False
+            self.kill()
+        return True
+
+    def get(self):
+        ok, value = self._outcome
+        if not ok:
+            raise value
+        return value
+
+    def kill(self):
+        """Убивает процесс и всех его потомков; после результата - просто подчищает их."""
+        if self._receiver.closed:
+            return
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        # Процесс мог еще не успеть стать лидером своей группы
+        self._process.kill()
+        self._process.join()
+        self._receiver.close()
+
+
+def _render_image(source_path, target_base, codec):
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with _open_source(source_path, codec) as source, Image.open(source) as image:
+        image.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+        image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+        image.convert('RGB').save(target_base + '.preview.jpg.tmp', 'JPEG', quality=80)
+    os.replace(target_base + '.preview.jpg.tmp', target_base + '.preview.jpg')
+    return '.preview.jpg'
+
+
+def _render_pdf(source_path, target_base, timeout):
+    if shutil.which('pdftoppm') is None:
+        return None
+    subprocess.run(
+        ['pdftoppm', '-png', '-f', '1', '-l', '1', '-singlefile', '-scale-to', str(PREVIEW_SIZE),
+         source_path, target_base + '.preview'],
+        check=True, timeout=timeout, capture_output=True)
+    return '.preview.png'
+
+
+def _render_text(source_path, target_base, codec):
+    with _open_source(source_path, codec) as source:
+        head = source.read(TEXT_PREVIEW_BYTES)
+    with open(target_base + '.preview.txt.tmp', 'w', encoding='utf-8') as target:
+        target.write(head.decode('utf-8', errors='replace'))
+    os.replace(target_base + '.preview.txt.tmp', target_base + '.preview.txt')
+    return '.preview.txt'
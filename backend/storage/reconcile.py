@@ -0,0 +1,303 @@
+"""Сверка MEDIA_ROOT с таблицами файлов (manage.py reconcile_storage).
+
+Диск и БД читаются потоками, отсортированными по имени файла, и сливаются
+как при merge join, поэтому память не растет с числом файлов: в памяти
+держится листинг одного каталога, окно пакетов stat и найденные проблемы.
+stat и unlink выполняются в пуле потоков.
+
+Порядок строк из БД должен совпадать с порядком строк в Python (по кодовым
+точкам), поэтому на PostgreSQL и MySQL сортировка идет в бинарной коллации;
+нарушение порядка прерывает сверку, чтобы не принять живые файлы за сирот.
+"""
+import collections
+import heapq
+import itertools
+import os
+import struct
+import time
+from operator import attrgetter
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Collate
+from .compression import CODEC_GZIP
+from .models import Blob, FileVersion, PreviewJob, UploadSession, UserFile
+from .previews import PREVIEW_SUFFIXES
+
+BINARY_COLLATIONS = {'postgresql': 'C', 'mysql': 'utf8mb4_bin'}
+
+# Сколько путей обрабатывает одна задача пула и сколько задач держим в полете на поток
+STAT_BATCH_SIZE = 256
+WINDOW_PER_WORKER = 4
+
+# Размер пачки при перепроверке сирот по БД и при исправлениях
+FIX_BATCH_SIZE = 500
+
+Record = collections.namedtuple('Record', 'name kind pk size codec')
+DiskFile = collections.namedtuple('DiskFile', 'name size mtime')
+
+
+class ReconcileError(Exception):
+    pass
+
+
+def walk(root):
+    """Относительные пути всех файлов под ``root`` в порядке сравнения строк.
+
+    Каталог сортируется по имени с завершающим ``/``: тогда обход в глубину
+    дает тот же порядок, что и сортировка полных путей.
+    """
+    def _walk(directory, prefix):
+        try:
+            with os.scandir(directory) as entries:
+                listing = sorted(
+                    (entry.name + '/' if is_dir else entry.name, entry.name, is_dir)
+                    for entry, is_dir in ((entry, entry.is_dir(follow_symlinks=False)) for entry in entries)
+                    if is_dir or entry.is_file(follow_symlinks=False))
+        except FileNotFoundError:
+            return
+        for _, name, is_dir in listing:
+            if is_dir:
+                yield from _walk(os.path.join(directory, name), f'{prefix}{name}/')
+            else:
+                yield prefix + name
+
+    return _walk(root, '')
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _stat_batch(root, names):
+    result = []
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(root, name))
+        except FileNotFoundError:
+            continue
+        result.append(DiskFile(name, stat.st_size, stat.st_mtime))
+    return result
+
+
+def _unlink_batch(root, names):
+    removed = 0
+    for name in names:
+        try:
+            os.remove(os.path.join(root, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def disk_files(root, pool, workers):
+    """``DiskFile`` в порядке ``walk``; stat выполняется пакетами в пуле потоков."""
+    pending = collections.deque()
+    for batch in _batched(walk(root), STAT_BATCH_SIZE):
+        pending.append(pool.submit(_stat_batch, root, batch))
+        if len(pending) >= workers * WINDOW_PER_WORKER:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def _ordered(queryset, field, *fields, chunk_size):
+    collation = BINARY_COLLATIONS.get(connection.vendor)
+    queryset = queryset.order_by(Collate(field, collation) if collation else field)
+    return queryset.values_list(field, *fields).iterator(chunk_size)
+
+
+def db_records(chunk_size):
+    """Все имена файлов, на которые ссылается БД, одним отсортированным потоком ``Record``."""
+    blobs = (Record(name, 'blob', pk, size, codec) for name, pk, size, codec in _ordered(
+        Blob.objects.all(), 'file', 'pk', 'size', 'codec', chunk_size=chunk_size))
+    files = (Record(name, 'file', pk, size, codec) for name, pk, size, codec in _ordered(
+        UserFile.objects.filter(blob__isnull=True).exclude(file=''), 'file', 'pk', 'size', 'codec',
+        chunk_size=chunk_size))
+    previews = (Record(name, 'preview', pk, None, '') for name, pk in _ordered(
+        UserFile.objects.exclude(preview=''), 'preview', 'pk', chunk_size=chunk_size))
+    uploads = (Record(name, 'upload', pk, received, '') for name, pk, received in _ordered(
+        UploadSession.objects.all(), 'part_path', 'pk', 'received', chunk_size=chunk_size))
+    return heapq.merge(blobs, files, previews, uploads, key=attrgetter('name'))
+
+
+def _gzip_size(path):
+    """Размер исходных данных из трейлера gzip (ISIZE, по модулю 2**32)."""
+    with open(path, 'rb') as fh:
+        fh.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', fh.read(4))[0]
+
+
+def _in_order(items, key, source):
+    previous = None
+    for item in items:
+        name = key(item)
+        if previous is not None and name < previous:
+            raise ReconcileError(f'{source}: нарушен порядок сортировки ({previous!r} > {name!r})')
+        previous = name
+        yield item
+
+
+class Reconciler:
+    """Находит расхождения между диском и БД и, по запросу, исправляет их.
+
+    ``report(kind, name, detail)`` вызывается для каждой найденной проблемы.
+    """
+
+    def __init__(self, root, pool, workers, report, fix=False, delete_missing=False,
+                 min_age=3600, chunk_size=2000):
+        self.root = root
+        self.pool = pool
+        self.workers = workers
+        self.report = report
+        self.fix = fix
+        self.delete_missing = delete_missing
+        self.min_age = min_age
+        self.chunk_size = chunk_size
+        self.stats = collections.Counter()
+        self.orphan_candidates = []
+        self.unlinks = []
+        # Исправления в БД откладываются до конца обхода: SQLite не изолирует
+        # открытые курсоры от записи в ту же таблицу
+        self.missing = collections.defaultdict(list)
+        self.size_fixes = collections.defaultdict(list)
+
+    def run(self):
+        started_before = time.time() - self.min_age
+        disk = _in_order(disk_files(self.root, self.pool, self.workers), attrgetter('name'), 'диск')
+        records = itertools.groupby(_in_order(db_records(self.chunk_size), attrgetter('name'), 'БД'),
+                                    key=attrgetter('name'))
+
+        file = next(disk, None)
+        name, group = next(records, (None, None))
+        while file is not None or name is not None:
+            if name is None or (file is not None and file.name < name):
+                self.stats['disk_files'] += 1
+                if file.mtime < started_before:
+                    self.orphan(file)
+                else:
+                    self.stats['skipped_recent'] += 1
+                file = next(disk, None)
+            elif file is None or name < file.name:
+                for record in group:
+                    self.stats['db_records'] += 1
+                    self.check_missing(record)
+                name, group = next(records, (None, None))
+            else:
+                self.stats['disk_files'] += 1
+                for record in group:
+                    self.stats['db_records'] += 1
+                    self.check_size(record, file)
+                file = next(disk, None)
+                name, group = next(records, (None, None))
+
+        self.flush_orphans()
+        for future in self.unlinks:
+            self.stats['orphans_removed'] += future.result()
+        if self.fix or self.delete_missing:
+            self.apply_fixes()
+        return self.stats
+
+    def orphan(self, file):
+        # Превью живет, пока на месте файл, для которого оно построено
+        suffix = next((suffix for suffix in PREVIEW_SUFFIXES if file.name.endswith(suffix)), None)
+        if suffix and self._exists(file.name[:-len(suffix)]):
+            return
+        self.orphan_candidates.append(file)
+        if len(self.orphan_candidates) >= FIX_BATCH_SIZE:
+            self.flush_orphans()
+
+    def flush_orphans(self):
+        """Перепроверяет кандидатов по БД (файл могли сослать после начала обхода) и удаляет сирот."""
+        if not self.orphan_candidates:
+            return
+        names = [file.name for file in self.orphan_candidates]
+        referenced = set(Blob.objects.filter(file__in=names).values_list('file', flat=True))
+        for file_name, preview in UserFile.objects.filter(
+                Q(file__in=names) | Q(preview__in=names)).values_list('file', 'preview'):
+            referenced.update((file_name, preview))
+        referenced.update(UploadSession.objects.filter(part_path__in=names).values_list('part_path', flat=True))
+
+        orphans = [file for file in self.orphan_candidates if file.name not in referenced]
+        self.orphan_candidates = []
+        for file in orphans:
+            self.stats['orphans'] += 1
+            self.stats['orphan_bytes'] += file.size
+            self.report('orphan', file.name, f'{file.size} байт')
+        if self.fix and orphans:
+            self.unlinks.append(self.pool.submit(_unlink_batch, self.root, [file.name for file in orphans]))
+
+    def check_missing(self, record):
+        if record.kind == 'upload' and not record.size:
+            # Сессия без единого куска: part-файл еще не создан
+            return
+        self.stats['missing'] += 1
+        detail = {'blob': f'блоб #{record.pk}', 'file': f'файл #{record.pk}',
+                  'preview': f'превью файла #{record.pk}', 'upload': f'сессия загрузки {record.pk}'}[record.kind]
+        self.report('missing', record.name, detail)
+        self.missing[record.kind].append(record)
+
+    def check_size(self, record, file):
+        if record.kind in ('blob', 'file'):
+            if record.codec == CODEC_GZIP:
+                actual = _gzip_size(os.path.join(self.root, file.name)) if file.size >= 18 else -1
+                expected = record.size % 2 ** 32
+            else:
+                actual, expected = file.size, record.size
+            if actual == expected:
+                return
+        elif record.kind == 'upload':
+            if file.size >= record.size:
+                return
+            actual, expected = file.size, record.size
+        else:
+            return
+        self.stats['size_mismatches'] += 1
+        self.report('size', record.name, f'в БД {expected}, на диске {actual}')
+        self.size_fixes[record.kind].append((record, actual))
+
+    def apply_fixes(self):
+        if self.fix:
+            # Размер сжатых файлов не исправляется: трейлер gzip хранит его лишь по модулю 2**32
+            for record, actual in self.size_fixes['blob']:
+                if not record.codec:
+                    Blob.objects.filter(pk=record.pk).update(size=actual)
+                    UserFile.objects.filter(blob_id=record.pk).update(size=actual)
+                    self.stats['sizes_fixed'] += 1
+            for record, actual in self.size_fixes['file']:
+                if not record.codec:
+                    UserFile.objects.filter(pk=record.pk).update(size=actual)
+                    self.stats['sizes_fixed'] += 1
+            for record, actual in self.size_fixes['upload']:
+                # Клиент узнает из received, с какого места продолжать загрузку
+                UploadSession.objects.filter(pk=record.pk, received__gt=actual).update(received=actual)
+                self.stats['sizes_fixed'] += 1
+
+            for batch in _batched(self.missing['preview'], FIX_BATCH_SIZE):
+                pks = [record.pk for record in batch if not self._exists(record.name)]
+                UserFile.objects.filter(pk__in=pks).update(preview='')
+                PreviewJob.objects.bulk_create([PreviewJob(user_file_id=pk) for pk in pks])
+                self.stats['missing_fixed'] += len(pks)
+            for record in self.missing['upload']:
+                if not self._exists(record.name):
+                    UploadSession.objects.filter(pk=record.pk).update(received=0)
+                    self.stats['missing_fixed'] += 1
+
+        if self.delete_missing:
+            for batch in _batched(self.missing['blob'], FIX_BATCH_SIZE):
+                pks = [record.pk for record in batch if not self._exists(record.name)]
+                UserFile.objects.filter(blob_id__in=pks).delete_with_storage()
+                # Версии с потерянными кусками восстановить нельзя
+                FileVersion.objects.filter(chunks__blob_id__in=pks).delete_with_chunks()
+                # Блобы без ссылок удаляет release_many; оставшиеся - без единого файла
+                Blob.objects.filter(pk__in=pks).delete()
+                self.stats['missing_fixed'] += len(pks)
+            for batch in _batched(self.missing['file'], FIX_BATCH_SIZE):
+                pks = [record.pk for record in batch if not self._exists(record.name)]
+                UserFile.objects.filter(pk__in=pks).delete_with_storage()
+                self.stats['missing_fixed'] += len(pks)
+
+    def _exists(self, name):
+        return os.path.exists(os.path.join(self.root, name))
@@ -0,0 +1,307 @@
+"""Хранилище файлов в S3-совместимом объектном хранилище (AWS S3, MinIO и т. п.).
+
+Без внешних зависимостей: запросы к REST API S3 через http.client с подписью
+AWS Signature V4, бакет адресуется в пути (``<endpoint>/<bucket>/<ключ>``).
+Файл до ``part_size`` байт загружается одним PUT, больше - multipart-загрузкой
+частями по ``part_size`` (в памяти держится одна часть). Короткие запросы
+идут по keep-alive соединению потока и повторяются на новом, если сервер его
+закрыл; неидемпотентный POST (создание и завершение multipart-загрузки)
+повторяется, только если запрос не успел уйти. Чтение идет одним
+GET-потоком с Range от текущей позиции, поэтому ``seek`` и выборочное чтение
+диапазонов не качают объект целиком. ``url()`` - подписанная ссылка на GET.
+"""
+import datetime
+import hashlib
+import hmac
+import http.client
+import io
+import logging
+import threading
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import quote, urlencode, urlsplit
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.core.files.utils import validate_file_name
+from django.utils.deconstruct import deconstructible
+from django.utils.http import parse_http_date_safe
+
+logger = logging.getLogger(__name__)
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+# S3 не принимает части multipart-загрузки меньше 5 МБ (кроме последней)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class S3Error(OSError):
+    def __init__(self, status, body=b''):
+        super().__init__(f'S3 {status}: {body[:500].decode(errors="replace")}')
+        self.status = status
+
+
+def _quote(value, safe='-_.~'):
+    return quote(value, safe=safe)
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+def _xml_text(body, tag):
+    root = ElementTree.fromstring(body)
+    if root.tag.rpartition('}')[2] == 'Error':
+        raise S3Error(200, body)
+    node = root.find(f'.//{{*}}{tag}')
+    if node is None:
+        node = root.find(f'.//{tag}')
+    return node.text if node is not None else None
+
+
+class _ObjectReader(io.RawIOBase):
+    """Чтение объекта с произвольной позиции: GET с ``Range: bytes=<позиция>-``, пока чтение последовательно."""
+
+    def __init__(self, storage, name, size):
+        self.storage = storage
+        self.name = name
+        self.size = size
+        self.position = 0
+        self.response = None
+        self.response_position = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        if self.response is None or self.response_position != self.position:
+            self._close_response()
+            self.response = self.storage._get_stream(self.name, self.position)
+            self.response_position = self.position
+        count = self.response.readinto(buffer)
+        if not count:
+            raise S3Error(0, f'объект {self.name} оборвался на {self.position} из {self.size} байт'.encode())
+        self.position += count
+        self.response_position += count
+        return count
+
+    def _close_response(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    def close(self):
+        self._close_response()
+        super().close()
+
+
+@deconstructible(path='storage.s3.S3Storage')
+class S3Storage(Storage):
+    def __init__(self, endpoint_url=None, bucket=None, access_key=None, secret_key=None, region=None,
+                 part_size=None, timeout=None):
+        self.endpoint_url = (endpoint_url or settings.STORAGE_S3_ENDPOINT_URL).rstrip('/')
+        self.bucket = bucket or settings.STORAGE_S3_BUCKET
+        self.access_key = access_key if access_key is not None else settings.STORAGE_S3_ACCESS_KEY
+        self.secret_key = secret_key if secret_key is not None else settings.STORAGE_S3_SECRET_KEY
+        self.region = region or settings.STORAGE_S3_REGION
+        self.part_size = max(MIN_PART_SIZE, part_size or settings.STORAGE_S3_PART_SIZE)
+        self.timeout = timeout or settings.STORAGE_S3_TIMEOUT
+        endpoint = urlsplit(self.endpoint_url)
+        self.scheme, self.host, self.base_path = endpoint.scheme, endpoint.netloc, endpoint.path
+        # Соединение keep-alive на поток для коротких запросов; потоковое чтение открывает свое
+        self._local = threading.local()
+
+    # Подпись AWS Signature V4
+
+    def _object_path(self, name):
+        return f'{self.base_path}/{self.bucket}/{_quote(name, safe="/-_.~")}'
+
+    def _signature(self, method, path, query, headers, payload_hash, amz_date):
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        canonical_query = '&'.join(f'{_quote(k)}={_quote(v)}' for k, v in sorted(query.items()))
+        names = sorted(name.lower() for name in headers)
+        values = {name.lower(): ' '.join(str(value).split()) for name, value in headers.items()}
+        canonical = '\n'.join([method, path, canonical_query, ''.join(f'{name}:{values[name]}\n' for name in names),
+                               ';'.join(names), payload_hash])
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+        key = _hmac(f'AWS4{self.secret_key}'.encode(), amz_date[:8])
+        for part in (self.region, 's3', 'aws4_request'):
+            key = _hmac(key, part)
+        return scope, ';'.join(names), hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+
+    def presigned_url(self, name, expires=None, parameters=None, now=None):
+        """Подписанная ссылка на GET объекта; ``parameters`` - например, response-content-disposition."""
+        amz_date = (now or datetime.datetime.now(datetime.timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
+        path = self._object_path(name)
+        query = dict(parameters or {})
+        query.update({
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f'{self.access_key}/{amz_date[:8]}/{self.region}/s3/aws4_request',
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires or settings.STORAGE_S3_PRESIGN_EXPIRES),
+            'X-Amz-SignedHeaders': 'host',
+        })
+        _, _, signature = self._signature('GET', path, query, {'host': self.host}, 'UNSIGNED-PAYLOAD', amz_date)
+        query['X-Amz-Signature'] = signature
+        return f'{self.scheme}://{self.host}{path}?{urlencode(sorted(query.items()), quote_via=quote)}'
+
+    # HTTP
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.host, timeout=self.timeout)
+
+    def _send(self, connection, method, name, query, headers, body):
+        path = self._object_path(name) if name is not None else f'{self.base_path}/{self.bucket}'
+        payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+        amz_date = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        headers = {**headers, 'Host': self.host, 'X-Amz-Date': amz_date, 'X-Amz-Content-SHA256': payload_hash}
+        scope, signed, signature = self._signature(method, path, query, headers, payload_hash, amz_date)
+        headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={signed}, Signature={signature}')
+        url = f'{path}?{urlencode(sorted(query.items()), quote_via=quote)}' if query else path
+        connection.request(method, url, body=body or None, headers=headers)
+
+    def _request(self, method, name=None, query=None, headers=None, body=b'', expect=(200,)):
+        """Короткий запрос: ``(ответ, тело)``; статус вне ``expect`` - ``S3Error`` (404 - ``FileNotFoundError``)."""
+        idempotent = method != 'POST'
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            if connection is not None and not idempotent:
+                # Простоявшее keep-alive соединение сервер мог закрыть, а повторить POST после
+                # отправки нельзя: он идет по новому соединению
+                connection.close()
+                connection = None
+            if connection is None:
+                connection = self._local.connection = self._connect()
+            sent = False
+            try:
+                self._send(connection, method, name, query or {}, headers or {}, body)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # Сервер закрыл простаивавшее keep-alive соединение - повторяем один раз на новом
+                connection.close()
+                self._local.connection = None
+                if attempt or (sent and not idempotent):
+                    raise
+            except BaseException:
+                connection.close()
+                self._local.connection = None
+                raise
+        if response.status not in expect:
+            if response.status == 404:
+                raise FileNotFoundError(f'{self.bucket}/{name}')
+            raise S3Error(response.status, data)
+        return response, data
+
+    def _get_stream(self, name, start):
+        connection = self._connect()
+        self._send(connection, 'GET', name, {}, {'Range': f'bytes={start}-'}, b'')
+        response = connection.getresponse()
+        if response.status == 206 or (response.status == 200 and start == 0):
+            return response
+        data = response.read()
+        connection.close()
+        if response.status == 404:
+            raise FileNotFoundError(f'{self.bucket}/{name}')
+        raise S3Error(response.status, data)
+
+    def _head(self, name):
+        response, _ = self._request('HEAD', name)
+        return response
+
+    # Storage API
+
+    def _open(self, name, mode='rb'):
+        if 'r' not in mode or '+' in mode:
+            raise ValueError(f'S3Storage открывает файлы только на чтение, а не {mode!r}')
+        size = int(self._head(name).getheader('Content-Length'))
+        file = File(io.BufferedReader(_ObjectReader(self, name, size), READ_BLOCK_SIZE), name=name)
+        file.size = size
+        return file
+
+    def _read_part(self, content, head=b''):
+        chunks, size = [head], len(head)
+        while size < self.part_size:
+            chunk = content.read(self.part_size - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return b''.join(chunks)
+
+    def _save(self, name, content):
+        if content.seekable():
+            content.seek(0)
+        part = self._read_part(content)
+        # Байт сверх первой части показывает, нужна ли multipart-загрузка
+        carry = content.read(1) if len(part) == self.part_size else b''
+        if not carry:
+            self._request('PUT', name, body=part)
+            return name
+
+        _, data = self._request('POST', name, query={'uploads': ''})
+        upload_id = _xml_text(data, 'UploadId')
+        etags = []
+        try:
+            while part:
+                response, _ = self._request('PUT', name, body=part, query={
+                    'partNumber': str(len(etags) + 1), 'uploadId': upload_id})
+                etags.append(response.getheader('ETag'))
+                part, carry = self._read_part(content, carry), b''
+            body = ''.join(f'<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>'
+                           for number, etag in enumerate(etags, 1))
+            _, data = self._request('POST', name, query={'uploadId': upload_id},
+                                    body=f'<CompleteMultipartUpload>{body}</CompleteMultipartUpload>'.encode())
+            # Ошибка завершения может прийти с кодом 200 в теле ответа
+            _xml_text(data, 'ETag')
+        except BaseException:
+            # Сбой отмены не должен подменять исходную ошибку; брошенную загрузку уберет lifecycle бакета
+            try:
+                self._request('DELETE', name, query={'uploadId': upload_id}, expect=(200, 204, 404))
+            except Exception:
+                logger.warning('Не удалось отменить multipart-загрузку %s', name, exc_info=True)
+            raise
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Ключи объектов уникальны по построению (uuid в имени, SHA-256 у блобов): PUT перезаписывает
+        validate_file_name(name, allow_relative_path=True)
+        return name
+
+    def delete(self, name):
+        self._request('DELETE', name, expect=(200, 204, 404))
+
+    def exists(self, name):
+        try:
+            self._head(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, name):
+        return int(self._head(name).getheader('Content-Length'))
+
+    def url(self, name):
+        return self.presigned_url(name)
+
+    def get_modified_time(self, name):
+        timestamp = parse_http_date_safe(self._head(name).getheader('Last-Modified') or '')
+        return datetime.datetime.fromtimestamp(timestamp or 0, datetime.timezone.utc)
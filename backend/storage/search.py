@@ -0,0 +1,154 @@
+"""Полнотекстовый поиск по ``UserFile.original_name`` и ``UserFile.comment``.
+
+SQLite: FTS5-таблица с внешним содержимым (storage_userfile_fts) и триггеры,
+которые обновляют ее при любом INSERT/UPDATE/DELETE в storage_userfile, в том
+числе при ``QuerySet.update()`` и каскадном удалении. id владельца тоже
+проиндексирован, поэтому поиск по своим файлам - пересечение списков FTS.
+
+PostgreSQL: GIN-индекс по tsvector (имя с весом A, комментарий с весом B)
+и триграммный GIN-индекс по имени (pg_trgm) для поиска по подстроке.
+Обе СУБД поддерживают эти индексы сами. На остальных - поиск через ``icontains``.
+
+Индекс создается миграцией 0011 и проверяется после каждой ``migrate``: на
+SQLite пересоздание таблицы storage_userfile удаляет триггеры.
+"""
+import re
+from django.db import connection
+from django.db.models import Q
+from .models import UserFile
+
+FTS_TABLE = 'storage_userfile_fts'
+FTS_TRIGGERS = {
+    'storage_userfile_fts_ai': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_fts_ai AFTER INSERT ON storage_userfile BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, user_id, original_name, comment)
+            VALUES (new.id, new.user_id, new.original_name, new.comment);
+        END""",
+    'storage_userfile_fts_ad': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_fts_ad AFTER DELETE ON storage_userfile BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, user_id, original_name, comment)
+            VALUES ('delete', old.id, old.user_id, old.original_name, old.comment);
+        END""",
+    'storage_userfile_fts_au': f"""
+        CREATE TRIGGER IF NOT EXISTS storage_userfile_fts_au
+        AFTER UPDATE OF user_id, original_name, comment ON storage_userfile BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, user_id, original_name, comment)
+            VALUES ('delete', old.id, old.user_id, old.original_name, old.comment);
+            INSERT INTO {FTS_TABLE}(rowid, user_id, original_name, comment)
+            VALUES (new.id, new.user_id, new.original_name, new.comment);
+        END""",
+}
+
+# Выражение должно совпадать с индексом storage_userfile_search_idx, иначе PostgreSQL его не использует
+PG_VECTOR = ("(setweight(to_tsvector('simple', original_name), 'A') || "
+             "setweight(to_tsvector('simple', comment), 'B'))")
+
+# Вес совпадения в имени относительно комментария при ранжировании (FTS5 bm25)
+NAME_WEIGHT = 5.0
+
+
+def terms(query):
+    return re.findall(r'\w+', query)[:16]
+
+
+def ensure_index(using_connection=None):
+    """Создает недостающие таблицу, триггеры и индексы; идемпотентна."""
+    conn = using_connection or connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'storage_userfile_fts_%'")
+            existing = {row[0] for row in cursor.fetchall()}
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                "user_id, original_name, comment, content='storage_userfile', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2')")
+            for sql in FTS_TRIGGERS.values():
+                cursor.execute(sql)
+            if existing != set(FTS_TRIGGERS):
+                # Пока триггеров не было, индекс мог отстать от таблицы
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        elif conn.vendor == 'postgresql':
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS storage_userfile_search_idx '
+                           f'ON storage_userfile USING gin ({PG_VECTOR})')
+            cursor.execute('CREATE INDEX IF NOT EXISTS storage_userfile_name_trgm_idx '
+                           'ON storage_userfile USING gin (original_name gin_trgm_ops)')
+
+
+def drop_index(using_connection=None):
+    conn = using_connection or connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            for name in FTS_TRIGGERS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+        elif conn.vendor == 'postgresql':
+            cursor.execute('DROP INDEX IF EXISTS storage_userfile_search_idx')
+            cursor.execute('DROP INDEX IF EXISTS storage_userfile_name_trgm_idx')
+
+
+def _fts_match(words, user_id=None):
+    expression = ' AND '.join(f'"{word}"*' for word in words)
+    match = f'{{original_name comment}} : ({expression})'
+    if user_id is not None:
+        match = f'user_id : "{int(user_id)}" AND {match}'
+    return match
+
+
+def _like_pattern(query):
+    return '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def matching_ids(query):
+    """SQL подзапроса с id подходящих файлов и его параметры (для ``pk__in=RawSQL(...)``)."""
+    words = terms(query)
+    if connection.vendor == 'sqlite':
+        return f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [_fts_match(words)]
+    if connection.vendor == 'postgresql':
+        return (f"SELECT id FROM storage_userfile WHERE {PG_VECTOR} @@ to_tsquery('simple', %s) "
+                f"OR original_name ILIKE %s",
+                [' & '.join(f'{word}:*' for word in words), _like_pattern(query.strip())])
+    return None
+
+
+def ranked(query, user_id=None, limit=100, after=None):
+    """Список ``(id, score)`` по убыванию релевантности, не длиннее ``limit``.
+
+    ``after`` - пара ``(score, id)`` последнего результата предыдущей страницы.
+    """
+    words = terms(query)
+    if connection.vendor == 'sqlite':
+        inner = (f'SELECT rowid AS id, -bm25({FTS_TABLE}, 0, {NAME_WEIGHT}, 1.0) AS score '
+                 f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s')
+        params = [_fts_match(words, user_id)]
+    elif connection.vendor == 'postgresql':
+        inner = (f"SELECT id, ts_rank({PG_VECTOR}, q) + similarity(original_name, %s) AS score "
+                 f"FROM storage_userfile, to_tsquery('simple', %s) q "
+                 f"WHERE ({PG_VECTOR} @@ q OR original_name ILIKE %s)")
+        params = [query.strip(), ' & '.join(f'{word}:*' for word in words), _like_pattern(query.strip())]
+        if user_id is not None:
+            inner += ' AND user_id = %s'
+            params.append(user_id)
+    else:
+        return _ranked_fallback(words, user_id, limit, after)
+
+    sql = f'SELECT id, score FROM ({inner}) AS matches'
+    if after is not None:
+        sql += ' WHERE score < %s OR (score = %s AND id > %s)'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY score DESC, id LIMIT %s'
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(row[0], float(row[1])) for row in cursor.fetchall()]
+
+
+def _ranked_fallback(words, user_id, limit, after):
+    files = UserFile.objects.order_by('id')
+    if user_id is not None:
+        files = files.filter(user_id=user_id)
+    for word in words:
+        files = files.filter(Q(original_name__icontains=word) | Q(comment__icontains=word))
+    if after is not None:
+        files = files.filter(id__gt=after[1])
+    return [(pk, 0.0) for pk in files.values_list('id', flat=True)[:limit]]
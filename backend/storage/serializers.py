@@ -1,7 +1,11 @@
 import os
 from rest_framework import serializers
-from .models import UserFile
+from .models import Blob, FileVersion, UserFile, UploadSession
 from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+from . import blobs, compression
 
 
 class FileSerializer(serializers.ModelSerializer):
@@ -9,13 +13,15 @@ class FileSerializer(serializers.ModelSerializer):
     size = serializers.IntegerField(read_only=True)
     uploaded_at = serializers.DateTimeField(read_only=True)
     last_downloaded_at = serializers.DateTimeField(read_only=True)
+    download_count = serializers.IntegerField(read_only=True)
     user = serializers.StringRelatedField(read_only=True)
     share_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
 
     class Meta:
         model = UserFile
         fields = ('id', 'user', 'original_name', 'file', 'size', 'uploaded_at',
-                  'last_downloaded_at', 'comment', 'share_link', 'share_url')
+                  'last_downloaded_at', 'download_count', 'comment', 'share_link', 'share_url', 'preview_url')
         read_only_fields = ('share_link',)
 
     def get_share_url(self, obj):
@@ -24,11 +30,123 @@ class FileSerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(f'/api/storage/share/{obj.share_link}/')
         return None
 
+    def get_preview_url(self, obj):
+        request = self.context.get('request')
+        if request and obj.preview:
+            return request.build_absolute_uri(f'/api/storage/{obj.pk}/preview/')
+        return None
+
     def create(self, validated_data):
         user = self.context['request'].user
         validated_data['user'] = user
-        return super().create(validated_data)
+        if not settings.STORAGE_DEDUPLICATE:
+            upload = validated_data['file']
+            if getattr(upload, 'sha256', None):
+                # Принят StorageUploadHandler: хранилище заберет файл переименованием
+                validated_data.update(original_name=os.path.basename(upload.name), size=upload.size,
+                                      sha256=upload.sha256, codec=upload.codec)
+                return super().create(validated_data)
+            spooled = compression.spool_upload(upload)
+            if spooled:
+                validated_data['file'], validated_data['codec'], validated_data['sha256'] = spooled
+                validated_data.update(original_name=os.path.basename(upload.name), size=upload.size)
+            return super().create(validated_data)
+
+        upload = validated_data.pop('file')
+        blob = blobs.ingest_file(upload)
+        validated_data.update(original_name=os.path.basename(upload.name), blob=blob,
+                              file=blob.file.name, sha256=blob.sha256)
+        try:
+            return super().create(validated_data)
+        except BaseException:
+            Blob.release(blob.pk)
+            raise
+
+
+class FileListSerializer:
+    """Список файлов только для чтения в том же виде, что ``FileSerializer(many=True)``.
+
+    Берет из БД лишь нужные колонки (``values()``, имя владельца - через JOIN)
+    и собирает словари без полей DRF: ссылки - конкатенацией с префиксами,
+    посчитанными один раз на запрос.
+    """
+    COLUMNS = ('id', 'user__username', 'original_name', 'file', 'size', 'uploaded_at',
+               'last_downloaded_at', 'download_count', 'comment', 'share_link', 'preview')
+
+    def __init__(self, rows, context=None):
+        self.rows = rows
+        self.context = context or {}
+
+    @classmethod
+    def columns(cls, queryset):
+        return queryset.values(*cls.COLUMNS)
+
+    @property
+    def data(self):
+        request = self.context.get('request')
+        tz = timezone.get_current_timezone() if settings.USE_TZ else None
+        file_url = self._file_url(request)
+        if request:
+            share_prefix = request.build_absolute_uri('/api/storage/share/')
+            api_prefix = request.build_absolute_uri('/api/storage/')
+
+        def moment(value):
+            if value is None:
+                return None
+            value = (value.astimezone(tz) if tz else value).isoformat()
+            return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+        return [{
+            'id': row['id'],
+            'user': row['user__username'],
+            'original_name': row['original_name'],
+            'file': file_url(row['file']) if row['file'] else None,
+            'size': row['size'],
+            'uploaded_at': moment(row['uploaded_at']),
+            'last_downloaded_at': moment(row['last_downloaded_at']),
+            'download_count': row['download_count'],
+            'comment': row['comment'],
+            'share_link': str(row['share_link']) if row['share_link'] else None,
+            'share_url': f"{share_prefix}{row['share_link']}/" if request and row['share_link'] else None,
+            'preview_url': f"{api_prefix}{row['id']}/preview/" if request and row['preview'] else None,
+        } for row in self.rows]
+
+    @staticmethod
+    def _file_url(request):
+        if default_storage.__class__ is FileSystemStorage:
+            # FileSystemStorage.url - base_url + путь; абсолютный префикс считается один раз
+            prefix = default_storage.base_url
+            if request:
+                prefix = request.build_absolute_uri(prefix)
+            return lambda name: prefix + filepath_to_uri(name).lstrip('/')
+        if request:
+            return lambda name: request.build_absolute_uri(default_storage.url(name))
+        return default_storage.url
 
 
 class FileRenameSerializer(serializers.Serializer):
     new_name = serializers.CharField(max_length=255)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'original_name', 'size', 'received', 'created_at', 'updated_at')
+        read_only_fields = ('id', 'received', 'created_at', 'updated_at')
+
+    def validate_original_name(self, value):
+        value = os.path.basename(value.strip())
+        if not value:
+            raise serializers.ValidationError("Имя файла не может быть пустым")
+        return value
+
+    def validate_size(self, value):
+        if value < 0:
+            raise serializers.ValidationError("Размер файла не может быть отрицательным")
+        return value
+
+
+class FileVersionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = FileVersion
+        fields = ('number', 'size', 'sha256', 'created_at')
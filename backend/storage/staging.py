@@ -0,0 +1,42 @@
+"""Локальные временные файлы загрузок и их перенос в хранилище.
+
+Part-файлы возобновляемых загрузок и временные файлы до подсчета SHA-256
+пишутся на локальный диск. С FileSystemStorage это каталог внутри MEDIA_ROOT,
+и файл встает на место переименованием; с удаленным хранилищем (S3) -
+STORAGE_STAGING_DIR, откуда файл загружается в хранилище и удаляется.
+"""
+import os
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils._os import safe_join
+
+
+def is_local(storage=None):
+    """Хранит ли хранилище файлы на локальном диске (есть ли у него ``path()``)."""
+    try:
+        (storage or default_storage).path('')
+    except NotImplementedError:
+        return False
+    return True
+
+
+def local_path(name):
+    """Локальный путь временного файла с именем ``name`` относительно корня хранилища."""
+    if is_local():
+        return default_storage.path(name)
+    return safe_join(settings.STORAGE_STAGING_DIR, name)
+
+
+def place(path, name):
+    """Переносит локальный файл ``path`` в хранилище под именем ``name``; исходный файл исчезает."""
+    if is_local():
+        final_path = default_storage.path(name)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(path, final_path)
+        return name
+    try:
+        with open(path, 'rb') as source:
+            return default_storage.save(name, File(source, name=name))
+    finally:
+        os.remove(path)
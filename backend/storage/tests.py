@@ -1,3 +1,1013 @@
-from django.test import TestCase
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from asgiref.sync import sync_to_async
+from urllib.parse import parse_qs, unquote, urlsplit
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, transaction
+from django.http import FileResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from users import tokens
+from users.models import CustomUser
+from storage import blobs, bookkeeping, chunking, pagination, previews, throttling, upload_handlers, uploads
+from storage.management.commands.run_preview_worker import Command as PreviewWorker
+from storage.models import Blob, FileChange, PreviewJob, StorageUsage, UploadSession, UserFile, VersionChunk
+from storage.s3 import S3Storage
+from storage.serializers import FileSerializer
 
-# Create your tests here.
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class StorageTestCase(TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='owner1', email='owner@example.com', password='Passw0rd!', full_name='Owner')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        bookkeeping.flush()
+
+    def upload(self, name='report.txt', content=b'0123456789'):
+        response = self.client.post('/api/storage/', {'file': SimpleUploadedFile(name, content)})
+        self.assertEqual(response.status_code, 201)
+        return UserFile.objects.get(pk=response.json()['id'])
+
+
+class DeliveryModeTests(StorageTestCase):
+    @override_settings(STORAGE_DELIVERY_MODE='nginx', STORAGE_ACCEL_REDIRECT_LOCATION='/protected-media/')
+    def test_accel_redirect_headers(self):
+        file = self.upload()
+        for url in (f'/api/storage/{file.pk}/', f'/api/storage/share/{file.share_link}/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{file.file.name}')
+            self.assertEqual(response['Content-Disposition'], 'attachment; filename="report.txt"')
+            self.assertEqual(response['ETag'], f'"{file.sha256}"')
+            self.assertEqual(response.content, b'')
+
+        bookkeeping.flush()
+        file.refresh_from_db()
+        self.assertIsNotNone(file.last_downloaded_at)
+        self.assertEqual(file.download_count, 2)
+
+    @override_settings(STORAGE_DELIVERY_MODE='sendfile')
+    def test_sendfile_headers(self):
+        file = self.upload()
+        for url in (f'/api/storage/{file.pk}/', f'/api/storage/share/{file.share_link}/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Sendfile'], file.file.path)
+            self.assertNotIn('X-Accel-Redirect', response)
+
+    def test_django_mode_streams_body(self):
+        file = self.upload()
+        response = self.client.get(f'/api/storage/{file.pk}/')
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertNotIn('X-Sendfile', response)
+
+
+class FileListSerializerTests(StorageTestCase):
+    def test_list_is_byte_equal_to_model_serializer(self):
+        self.upload('отчет «итог».txt', b'a')
+        file = self.upload('notes.txt', b'bb')
+        UserFile.objects.filter(pk=file.pk).update(
+            comment='line\u2028break "quoted"', preview=file.file.name + '.preview.txt',
+            last_downloaded_at=timezone.now(), download_count=3)
+        response = self.client.get('/api/storage/')
+        files = UserFile.objects.order_by('-uploaded_at', '-id')
+        expected = JSONRenderer().render(FileSerializer(files, many=True, context={'request': response.wsgi_request}).data)
+        self.assertEqual(response.content, expected)
+
+
+class RangeTests(StorageTestCase):
+    def test_ranges_and_conditional_requests(self):
+        file = self.upload('digits.txt', b'0123456789')
+        url = f'/api/storage/{file.pk}/'
+        response = self.client.get(url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-3')
+        self.assertEqual((response['Content-Range'], b''.join(response.streaming_content)), ('bytes 7-9/10', b'789'))
+        response = self.client.get(url, HTTP_RANGE='bytes=20-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-1,5-6,6-7')
+        self.assertEqual(response.status_code, 206)
+        boundary = response['Content-Type'].split('boundary=')[1]
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertEqual(body.count(f'--{boundary}'.encode()), 3)
+        self.assertIn(b'Content-Range: bytes 0-1/10\r\n\r\n01\r\n', body)
+        self.assertIn(b'Content-Range: bytes 5-7/10\r\n\r\n567\r\n', body)
+
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response = self.client.get(url, HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"stale"')
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, b'0123456789'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+
+    def test_empty_file_ignores_range(self):
+        file = UserFile.objects.create(user=self.user, file=ContentFile(b'', name='empty.txt'))
+        for header in ('bytes=-5', 'bytes=0-', 'bytes=0-0'):
+            response = self.client.get(f'/api/storage/{file.pk}/', HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 200, header)
+            self.assertNotIn('Content-Range', response)
+            self.assertEqual(b''.join(response.streaming_content), b'')
+
+
+@override_settings(STORAGE_COMPRESSION=True)
+class CompressionTests(StorageTestCase):
+    def test_round_trip_and_ranges(self):
+        content = b''.join(b'line %d of a plain text log\n' % number for number in range(2000))
+        file = self.upload('server.log', content)
+        self.assertEqual((file.codec, file.size), ('gzip', len(content)))
+        self.assertEqual(file.sha256, hashlib.sha256(content).hexdigest())
+        stored = file.file.size
+        self.assertLess(stored, len(content) // 4)
+        with file.open_content() as fh:
+            self.assertEqual(fh.read(), content)
+
+        url = f'/api/storage/{file.pk}/'
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual((response['Content-Encoding'], response['Content-Length']), ('gzip', str(stored)))
+        self.assertEqual(response['ETag'], f'"{file.sha256}-gzip"')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), content)
+
+        for headers in ({}, {'HTTP_ACCEPT_ENCODING': 'gzip;q=0'}):
+            response = self.client.get(url, **headers)
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(response['Content-Length'], str(len(content)))
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+        # Диапазоны считаются по исходным байтам, даже если клиент принимает gzip
+        response = self.client.get(url, HTTP_RANGE='bytes=30000-30099', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 206)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Content-Range'], f'bytes 30000-30099/{len(content)}')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(b''.join(response.streaming_content), content[30000:30100])
+
+    def test_incompressible_content_stored_as_is(self):
+        for name, content in (('noise.bin', os.urandom(50000)), ('photos.zip', b'a' * 50000),
+                              ('tiny.txt', b'a' * 100)):
+            file = self.upload(name, content)
+            self.assertEqual(file.codec, '', name)
+            self.assertEqual(file.file.size, len(content), name)
+
+
+class PaginationTests(StorageTestCase):
+    def test_cursor_round_trip(self):
+        for index in range(5):
+            self.upload(f'file{index}.txt', b'x' * (index % 3 + 1))
+        for sort in ('-uploaded_at', 'uploaded_at', 'original_name', '-size', 'size'):
+            names, params = [], {'sort': sort, 'limit': 2}
+            while True:
+                response = self.client.get('/api/storage/', params)
+                names += [file['original_name'] for file in response.json()]
+                if 'X-Next-Cursor' not in response:
+                    break
+                params['cursor'] = response['X-Next-Cursor']
+            expected = UserFile.objects.order_by(sort, '-id' if sort.startswith('-') else 'id')
+            self.assertEqual(names, list(expected.values_list('original_name', flat=True)), sort)
+
+    def test_tampered_cursor(self):
+        cursors = [
+            ('-uploaded_at', 'not-a-date', 1), ('-uploaded_at', 5, 1), ('-uploaded_at', '2026-13-40T00:00:00', 1),
+            ('size', '10', 1), ('size', True, 1), ('size', 2 ** 70, 1), ('original_name', 7, 1),
+            ('original_name', 'a', '1'), ('original_name', 'a', None), ('original_name', 'a', 2 ** 64),
+        ]
+        for sort, value, pk in cursors:
+            cursor = pagination.encode_cursor(sort, value, pk)
+            response = self.client.get('/api/storage/', {'sort': sort, 'cursor': cursor})
+            self.assertEqual(response.status_code, 400, (sort, value, pk))
+            self.assertEqual(response.json(), {'error': 'Неверный курсор'})
+        for cursor in ('%%%', 'W10', base64.urlsafe_b64encode(b'{"a":1}').decode()):
+            self.assertEqual(self.client.get('/api/storage/', {'cursor': cursor}).status_code, 400)
+        cursor = pagination.encode_cursor('size', 1, 1)
+        response = self.client.get('/api/storage/', {'sort': 'original_name', 'cursor': cursor})
+        self.assertEqual(response.json(), {'error': 'Курсор получен для другой сортировки'})
+
+    def test_search_rank_cursor(self):
+        self.upload('report one.txt', b'1')
+        self.upload('report two.txt', b'2')
+        response = self.client.get('/api/storage/search/', {'q': 'report', 'limit': 1})
+        response = self.client.get('/api/storage/search/', {'q': 'report', 'cursor': response['X-Next-Cursor']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        for value, pk in (('1.5', 1), (True, 1), (float('nan'), 1), (1.5, 1.5)):
+            cursor = pagination.encode_cursor('rank', value, pk)
+            response = self.client.get('/api/storage/search/', {'q': 'report', 'cursor': cursor})
+            self.assertEqual(response.json(), {'error': 'Неверный курсор'}, (value, pk))
+
+
+class UploadHandlerTests(StorageTestCase):
+    def temp_files(self):
+        return os.listdir(os.path.dirname(blobs.temp_path()))
+
+    def test_hash_and_size_while_streaming(self):
+        handler = upload_handlers.StorageUploadHandler(RequestFactory().post('/api/storage/'))
+        handler.new_file('file', 'data.bin', 'application/octet-stream', None)
+        content = os.urandom(200000)
+        for start in range(0, len(content), 65536):
+            handler.receive_data_chunk(content[start:start + 65536], start)
+        upload = handler.file_complete(len(content))
+        self.assertEqual((upload.size, upload.sha256, upload.codec),
+                         (len(content), hashlib.sha256(content).hexdigest(), ''))
+        with open(upload.temporary_file_path(), 'rb') as fh:
+            self.assertEqual(fh.read(), content)
+        upload.close()
+        self.assertFalse(os.path.exists(upload.path))
+
+    def test_upload_is_stored_without_second_pass(self):
+        content = os.urandom(100000)
+        # Ни повторного чтения для SHA-256, ни копирования: файл переименовывается на место
+        with mock.patch('storage.compression.write_stream', side_effect=AssertionError('copied')), \
+                mock.patch('storage.models.file_sha256', side_effect=AssertionError('hashed')):
+            file = self.upload('blob.bin', content)
+            with self.settings(STORAGE_DEDUPLICATE=False):
+                single = self.upload('single.bin', content)
+        for stored in (file, single):
+            self.assertEqual((stored.size, stored.sha256), (len(content), hashlib.sha256(content).hexdigest()))
+            with stored.file.open('rb') as fh:
+                self.assertEqual(fh.read(), content)
+        self.assertEqual(self.temp_files(), [])
+
+    def test_over_quota_upload_rejected(self):
+        self.user.storage_quota = 1000
+        self.user.save()
+        response = self.client.post('/api/storage/', {'file': SimpleUploadedFile('big.bin', os.urandom(5000))})
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(UserFile.objects.exists())
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes_used, 0)
+        self.assertEqual(self.temp_files(), [])
+        self.upload('small.bin', os.urandom(500))
+
+
+class SearchTests(StorageTestCase):
+    def search(self, query, **params):
+        response = self.client.get('/api/storage/search/', {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [row['original_name'] for row in response.json()]
+
+    def test_ranked_matches(self):
+        self.upload('quarterly report.pdf', b'1')
+        notes = self.upload('notes.txt', b'2')
+        self.upload('holiday.jpg', b'3')
+        UserFile.objects.filter(pk=notes.pk).update(comment='Report draft for the board')
+        other = CustomUser.objects.create_user(
+            username='other1', email='other@example.com', password='Passw0rd!', full_name='Other')
+        UserFile.objects.create(user=other, file=ContentFile(b'4', name='report.doc'))
+
+        # Совпадение в имени выше совпадения в комментарии; чужие файлы не видны
+        self.assertEqual(self.search('report'), ['quarterly report.pdf', 'notes.txt'])
+        self.assertEqual(self.search('QUART'), ['quarterly report.pdf'])
+        self.assertEqual(self.search('report draft'), ['notes.txt'])
+        self.assertEqual(self.search('invoice'), [])
+
+        response = self.client.get('/api/storage/search/', {'q': 'report', 'limit': 1})
+        self.assertEqual([row['original_name'] for row in response.json()], ['quarterly report.pdf'])
+        self.assertEqual(self.search('report', limit=1, cursor=response['X-Next-Cursor']), ['notes.txt'])
+
+        # Индекс следует за переименованием и удалением
+        self.client.patch(f'/api/storage/{notes.pk}/', {'original_name': 'invoice.txt'},
+                          content_type='application/json')
+        self.assertEqual(self.search('invoice'), ['invoice.txt'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/storage/{notes.pk}/')
+        self.assertEqual(self.search('report'), ['quarterly report.pdf'])
+
+        self.assertEqual(self.client.get('/api/storage/search/', {'q': ' ,. '}).status_code, 400)
+
+
+class ResumableUploadTests(StorageTestCase):
+    def start(self, size, name='big.bin'):
+        response = self.client.post('/api/storage/uploads/', {'original_name': name, 'size': size})
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def put(self, pk, data, start, total):
+        return self.client.put(f'/api/storage/uploads/{pk}/', data, content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE=f'bytes {start}-{start + len(data) - 1}/{total}')
+
+    def test_out_of_order_and_duplicate_chunks(self):
+        content = os.urandom(3000)
+        pk = self.start(len(content))
+        response = self.put(pk, content[2000:], 2000, 3000)
+        self.assertEqual((response.status_code, response.json()['received']), (409, 0))
+        self.assertEqual(self.put(pk, content[:1000], 0, 3000).json()['received'], 1000)
+        self.assertEqual(self.put(pk, content[:1000], 0, 3000).json()['received'], 1000)
+        self.assertEqual(self.put(pk, content[500:2000], 500, 3000).json()['received'], 2000)
+        response = self.client.post(f'/api/storage/uploads/{pk}/complete/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.put(pk, content[2000:], 2000, 3000).json()['received'], 3000)
+
+        response = self.client.post(f'/api/storage/uploads/{pk}/complete/')
+        self.assertEqual(response.status_code, 201)
+        file = UserFile.objects.get(pk=response.json()['id'])
+        self.assertEqual(b''.join(self.client.get(f'/api/storage/{file.pk}/').streaming_content), content)
+        self.assertEqual(self.client.post(f'/api/storage/uploads/{pk}/complete/').status_code, 404)
+
+    def test_session_finalized_once(self):
+        pk = self.start(10)
+        self.put(pk, b'0123456789', 0, 10)
+        session = UploadSession.objects.get(pk=pk)
+        stale = UploadSession.objects.get(pk=pk)
+        uploads.finalize(session)
+        with self.assertRaisesMessage(uploads.ChunkError, 'Загрузка уже завершается'):
+            uploads.finalize(stale)
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.bytes_used, usage.files_count, UserFile.objects.count()), (10, 1, 1))
+
+    def test_quota_rejection_keeps_session(self):
+        pk = self.start(10)
+        self.put(pk, b'0123456789', 0, 10)
+        self.user.storage_quota = 5
+        self.user.save()
+        response = self.client.post(f'/api/storage/uploads/{pk}/complete/')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(UploadSession.objects.get(pk=pk).received, 10)
+        self.assertFalse(UserFile.objects.exists())
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes_used, 0)
+
+        self.user.storage_quota = None
+        self.user.save()
+        self.assertEqual(self.client.post(f'/api/storage/uploads/{pk}/complete/').status_code, 201)
+
+
+class AsyncViewTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.auth = {'Authorization': f"Bearer {tokens.issue_tokens(self.user)['access_token']}"}
+
+    async def read(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_chunk_upload_and_download(self):
+        content = os.urandom(3000)
+        response = await sync_to_async(self.client.post)(
+            '/api/storage/uploads/', {'original_name': 'big.bin', 'size': len(content)})
+        pk = response.json()['id']
+        for start in (0, 1000, 2000):
+            response = await self.async_client.put(
+                f'/api/storage/stream/uploads/{pk}/', content[start:start + 1000],
+                content_type='application/octet-stream',
+                headers={'Content-Range': f'bytes {start}-{start + 999}/3000', **self.auth})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['received'], 3000)
+        response = await self.async_client.put(
+            f'/api/storage/stream/uploads/{pk}/', b'x', content_type='application/octet-stream',
+            headers={'Content-Range': 'bytes 0-0/5', **self.auth})
+        self.assertEqual(response.status_code, 409)
+
+        response = await sync_to_async(self.client.post)(f'/api/storage/uploads/{pk}/complete/')
+        file_id = response.json()['id']
+        response = await self.async_client.get(f'/api/storage/stream/{file_id}/', headers=self.auth)
+        self.assertEqual(response['Content-Length'], '3000')
+        self.assertEqual(await self.read(response), content)
+        response = await self.async_client.get(f'/api/storage/stream/{file_id}/',
+                                               headers={'Range': 'bytes=10-19', **self.auth})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(await self.read(response), content[10:20])
+        self.assertEqual((await self.async_client.get(f'/api/storage/stream/{file_id}/')).status_code, 403)
+
+    @override_settings(STORAGE_COMPRESSION=True)
+    async def test_compressed_and_shared_download(self):
+        content = b'compressible text ' * 1000
+        file = await sync_to_async(self.upload)('notes.txt', content)
+        self.assertTrue(file.codec)
+        response = await self.async_client.get(f'/api/storage/stream/{file.pk}/',
+                                               headers={'Accept-Encoding': 'gzip', **self.auth})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = await self.read(response)
+        self.assertEqual(response['Content-Length'], str(len(body)))
+        self.assertEqual(gzip.decompress(body), content)
+
+        response = await self.async_client.get(f'/api/storage/stream/share/{file.share_link}/')
+        self.assertEqual(await self.read(response), content)
+
+
+class ShareThrottlingTests(StorageTestCase):
+    def test_slot_released_when_serving_fails(self):
+        file = self.upload()
+        os.remove(file.blob.file.path)
+        with self.settings(STORAGE_SHARE_THROTTLE_DIR=os.path.join(MEDIA_ROOT, 'throttle'),
+                           STORAGE_SHARE_MAX_CONCURRENT_PER_LINK=1):
+            for _ in range(2):
+                with self.assertRaises(FileNotFoundError), self.assertLogs('django.request', 'ERROR'):
+                    self.client.get(f'/api/storage/share/{file.share_link}/')
+
+    def test_slot_without_rate_keeps_file_wrapper(self):
+        file = self.upload()
+        url = f'/api/storage/share/{file.share_link}/'
+        with self.settings(STORAGE_SHARE_THROTTLE_DIR=os.path.join(MEDIA_ROOT, 'throttle'),
+                           STORAGE_SHARE_MAX_CONCURRENT_PER_LINK=1):
+            request = RequestFactory().get(url)
+            response = throttling.apply(FileResponse(file.file.open('rb')), throttling.acquire(request, file))
+            self.assertIsNotNone(response.file_to_stream)
+            self.assertEqual(self.client.get(url).status_code, 429)
+            response.close()
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class BatchTests(StorageTestCase):
+    def test_mixed_batch_updates_usage_and_blob_refs(self):
+        kept = self.upload('kept.txt', b'shared')
+        twin = self.upload('twin.txt', b'shared')
+        single = self.upload('single.txt', b'unique!')
+        single_path = single.blob.file.path
+        self.assertEqual(Blob.objects.get(pk=kept.blob_id).ref_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/storage/batch/', {'operations': [
+                {'id': kept.pk, 'op': 'rename', 'original_name': ' renamed.txt '},
+                {'id': kept.pk, 'op': 'comment', 'comment': 'keep'},
+                {'id': twin.pk, 'op': 'delete'},
+                {'id': single.pk, 'op': 'comment', 'comment': 'lost'},
+                {'id': single.pk, 'op': 'delete'},
+                {'id': single.pk, 'op': 'rename', 'original_name': 'late.txt'},
+                {'id': kept.pk, 'op': 'rename', 'original_name': '  '},
+                {'id': 999999, 'op': 'delete'},
+            ]}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json()['results']],
+                         ['ok', 'ok', 'ok', 'ok', 'ok', 'error', 'error', 'error'])
+
+        kept.refresh_from_db()
+        self.assertEqual((kept.original_name, kept.comment), ('renamed.txt', 'keep'))
+        self.assertEqual(list(UserFile.objects.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(Blob.objects.get(pk=kept.blob_id).ref_count, 1)
+        self.assertFalse(Blob.objects.filter(pk=single.blob_id).exists())
+        self.assertFalse(os.path.exists(single_path))
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.bytes_used, usage.files_count), (len(b'shared'), 1))
+
+    def test_foreign_files_and_limit(self):
+        other = CustomUser.objects.create_user(
+            username='other1', email='other@example.com', password='Passw0rd!', full_name='Other')
+        foreign = UserFile.objects.create(user=other, file=ContentFile(b'x', name='x.txt'))
+        response = self.client.post('/api/storage/batch/', {'operations': [{'id': foreign.pk, 'op': 'delete'}]},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['results'][0]['error'], 'Файл не найден')
+        self.assertTrue(UserFile.objects.filter(pk=foreign.pk).exists())
+
+        with self.settings(STORAGE_BATCH_MAX_OPERATIONS=2):
+            response = self.client.post('/api/storage/batch/', {'operations': [{'id': foreign.pk, 'op': 'delete'}] * 3},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Не больше 2 операций за раз'})
+        response = self.client.post('/api/storage/batch/', {'operations': []}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ArchiveTests(StorageTestCase):
+    def test_admin_user_id_must_be_integer(self):
+        self.user.is_administrator = True
+        self.user.save()
+        self.upload()
+        for params in ({'all': 'true', 'user_id': 'abc'}, {'all': 'true', 'user_id': '1 OR 1'}):
+            response = self.client.get('/api/storage/archive/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': 'Параметр user_id должен быть целым числом'})
+        response = self.client.get('/api/storage/archive/', {'all': 'true', 'user_id': str(self.user.pk)})
+        self.assertEqual(response.status_code, 200)
+
+
+class BookkeepingTests(StorageTestCase):
+    def test_failed_flush_keeps_downloads(self):
+        file = self.upload()
+        bookkeeping.record_download(file)
+        bookkeeping.record_download(file)
+        with mock.patch.object(UserFile.objects, 'bulk_update', side_effect=DatabaseError('locked')):
+            with self.assertRaises(DatabaseError):
+                bookkeeping.flush()
+        bookkeeping.record_download(file)
+        self.assertEqual(bookkeeping.flush(), 1)
+        file.refresh_from_db()
+        self.assertEqual(file.download_count, 3)
+        self.assertEqual(bookkeeping.flush(), 0)
+
+    def test_flush_never_moves_last_download_back(self):
+        first, second = self.upload('a.txt'), self.upload('b.txt')
+        later = timezone.now() + timedelta(hours=1)
+        UserFile.objects.filter(pk=first.pk).update(last_downloaded_at=later)
+        bookkeeping.record_download(first)
+        bookkeeping.record_download(second)
+        bookkeeping.flush()
+        self.assertEqual(UserFile.objects.get(pk=first.pk).last_downloaded_at, later)
+        self.assertIsNotNone(UserFile.objects.get(pk=second.pk).last_downloaded_at)
+
+
+class VersionTests(StorageTestCase):
+    def test_delta_upload_sends_only_missing_chunks(self):
+        first = os.urandom(3 * 1024 * 1024)
+        file = self.upload('archive.bin', first)
+        second = first[:100000] + b'inserted' + first[100000:]
+        response = self.client.post(f'/api/storage/{file.pk}/versions/', {
+            'file': SimpleUploadedFile('archive.bin', second)})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['number'], 2)
+
+        third = second[:2500000] + b'appended' + second[2500000:]
+        chunks = list(chunking.split([third]))
+        manifest = [{'sha256': hashlib.sha256(chunk).hexdigest(), 'size': len(chunk)} for chunk in chunks]
+        response = self.client.post('/api/storage/chunks/', {'chunks': [entry['sha256'] for entry in manifest]},
+                                    content_type='application/json')
+        missing = response.json()['missing']
+        self.assertLess(len(missing), len(chunks))
+
+        response = self.client.post(f'/api/storage/{file.pk}/versions/', {'manifest': json.dumps(manifest)})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['missing'], missing)
+        stream = b''.join(chunk for chunk in chunks if hashlib.sha256(chunk).hexdigest() in missing)
+        response = self.client.post(f'/api/storage/{file.pk}/versions/', {
+            'manifest': json.dumps(manifest), 'chunks': SimpleUploadedFile('chunks', stream)})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['sha256'], hashlib.sha256(third).hexdigest())
+
+        for number, content in ((1, first), (2, second), (3, third)):
+            response = self.client.get(f'/api/storage/{file.pk}/versions/{number}/')
+            self.assertEqual(b''.join(response.streaming_content), content)
+        response = self.client.get(f'/api/storage/{file.pk}/')
+        self.assertEqual(b''.join(response.streaming_content), third)
+
+        response = self.client.post(f'/api/storage/{file.pk}/versions/1/restore/')
+        self.assertEqual(response.json()['number'], 4)
+        response = self.client.get(f'/api/storage/{file.pk}/')
+        self.assertEqual(b''.join(response.streaming_content), first)
+
+    def test_history_is_charged_and_stored_once(self):
+        first, second = os.urandom(300000), os.urandom(200000)
+        file = self.upload('data.bin', first)
+        self.client.post(f'/api/storage/{file.pk}/versions/', {'file': SimpleUploadedFile('data.bin', second)})
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.bytes_used, usage.files_count), (len(first) + len(second), 1))
+        # Последняя версия - только содержимое файла, прежняя - в блобах кусков
+        self.assertFalse(VersionChunk.objects.filter(version__number=2, blob__isnull=False).exists())
+        self.assertFalse(VersionChunk.objects.filter(version__number=1, blob__isnull=True).exists())
+
+        self.user.storage_quota = len(first) + len(second) + 1000
+        self.user.save()
+        response = self.client.post(f'/api/storage/{file.pk}/versions/', {
+            'file': SimpleUploadedFile('data.bin', os.urandom(5000))})
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes_used, len(first) + len(second))
+        self.assertEqual(UserFile.objects.get(pk=file.pk).sha256, hashlib.sha256(second).hexdigest())
+
+        with self.settings(STORAGE_MAX_FILE_VERSIONS=2):
+            response = self.client.post(f'/api/storage/{file.pk}/versions/', {
+                'file': SimpleUploadedFile('data.bin', first[:500])})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes_used, len(second) + 500)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/storage/{file.pk}/')
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.bytes_used, usage.files_count), (0, 0))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_recount_includes_history(self):
+        first, second = os.urandom(300000), os.urandom(200000)
+        file = self.upload('data.bin', first)
+        self.client.post(f'/api/storage/{file.pk}/versions/', {'file': SimpleUploadedFile('data.bin', second)})
+        StorageUsage.objects.filter(user=self.user).update(bytes_used=0)
+        call_command('recount_usage', stdout=io.StringIO())
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes_used, len(first) + len(second))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/storage/{file.pk}/')
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes_used, 0)
+
+
+class ChangeFeedTests(StorageTestCase):
+    def kinds(self, file_id):
+        return list(FileChange.objects.filter(file_id=file_id).order_by('id').values_list('kind', flat=True))
+
+    def test_triggers_log_every_way_of_writing(self):
+        file = self.upload('a.txt')
+        file.original_name = 'b.txt'
+        file.save()
+        UserFile.objects.filter(pk=file.pk).update(comment='first')
+        file.original_name = 'c.txt'
+        UserFile.objects.bulk_update([file], ['original_name'])
+        file.comment = 'second'
+        UserFile.objects.bulk_update([file], ['comment'])
+        UserFile.objects.filter(pk=file.pk).update(sha256='0' * 64)
+        # Запись без изменения значения в журнал не попадает
+        UserFile.objects.filter(pk=file.pk).update(comment='second')
+        UserFile.objects.filter(pk=file.pk).delete()
+        self.assertEqual(self.kinds(file.pk), ['create', 'rename', 'comment', 'rename', 'comment', 'update', 'delete'])
+
+    def test_list_cursor_handoff_and_collapsing(self):
+        first = self.upload('a.txt')
+        response = self.client.get('/api/storage/')
+        cursor = int(response['X-Change-Cursor'])
+        self.assertEqual(cursor, FileChange.objects.get(file_id=first.pk).pk)
+
+        other = CustomUser.objects.create_user(
+            username='other1', email='other@example.com', password='Passw0rd!', full_name='Other')
+        foreign = UserFile.objects.create(user=other, file=ContentFile(b'x', name='x.txt'))
+        # Чужие записи не двигают курсор пользователя
+        self.assertEqual(int(self.client.get('/api/storage/')['X-Change-Cursor']), cursor)
+
+        self.client.patch(f'/api/storage/{first.pk}/', {'original_name': 'b.txt'}, content_type='application/json')
+        self.client.patch(f'/api/storage/{first.pk}/', {'comment': 'note'}, content_type='application/json')
+        second = self.upload('c.txt')
+        third = self.upload('d.txt')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/storage/{third.pk}/')
+
+        data = self.client.get('/api/storage/changes/', {'cursor': cursor}).json()
+        self.assertFalse(data['resync'])
+        self.assertEqual([(change['id'], change['op']) for change in data['changes']],
+                         [(first.pk, 'comment'), (second.pk, 'create'), (third.pk, 'delete')])
+        self.assertEqual(data['changes'][0]['file']['original_name'], 'b.txt')
+        self.assertIsNone(data['changes'][2]['file'])
+        self.assertNotIn(foreign.pk, [change['id'] for change in data['changes']])
+
+        data = self.client.get('/api/storage/changes/', {'cursor': data['cursor']}).json()
+        self.assertEqual((data['changes'], data['resync']), ([], False))
+
+    def test_admin_list_cursor_covers_all_users(self):
+        self.user.is_administrator = True
+        self.user.save()
+        other = CustomUser.objects.create_user(
+            username='other1', email='other@example.com', password='Passw0rd!', full_name='Other')
+        UserFile.objects.create(user=other, file=ContentFile(b'x', name='x.txt'))
+        own = self.upload('a.txt')
+        cursor = int(self.client.get('/api/storage/')['X-Change-Cursor'])
+        self.assertEqual(cursor, FileChange.objects.get(file_id=own.pk).pk)
+        self.assertEqual(int(self.client.get('/api/storage/', {'user_id': other.pk})['X-Change-Cursor']),
+                         FileChange.objects.filter(user=other).get().pk)
+
+        # Изменение другого пользователя после общего списка приходит в общий журнал
+        foreign = UserFile.objects.create(user=other, file=ContentFile(b'y', name='y.txt'))
+        data = self.client.get('/api/storage/changes/', {'cursor': cursor}).json()
+        self.assertEqual([(change['id'], change['op']) for change in data['changes']], [(foreign.pk, 'create')])
+        data = self.client.get('/api/storage/changes/', {'cursor': cursor, 'user_id': self.user.pk}).json()
+        self.assertEqual(data['changes'], [])
+
+    def test_prune_removes_only_log_prefix(self):
+        file = self.upload('a.txt')
+        UserFile.objects.filter(pk=file.pk).update(comment='old')
+        UserFile.objects.filter(pk=file.pk).update(comment='new')
+        # Запись с большим id, но более ранним created_at (PostgreSQL: now() - начало транзакции)
+        first_comment = FileChange.objects.filter(kind='comment').order_by('id').first()
+        FileChange.objects.filter(pk=first_comment.pk).update(created_at=timezone.now() - timedelta(days=400))
+        call_command('prune_file_changes', days=30, stdout=io.StringIO())
+        self.assertEqual(self.kinds(file.pk), ['create', 'comment', 'comment'])
+
+        FileChange.objects.update(created_at=timezone.now() - timedelta(days=400))
+        call_command('prune_file_changes', days=30, stdout=io.StringIO())
+        self.assertEqual(self.kinds(file.pk), ['comment'])
+
+    def test_resync_after_prune(self):
+        file = self.upload('a.txt')
+        UserFile.objects.filter(pk=file.pk).update(comment='old')
+        FileChange.objects.update(created_at=timezone.now() - timedelta(days=400))
+        UserFile.objects.filter(pk=file.pk).update(comment='new')
+        call_command('prune_file_changes', days=30, stdout=io.StringIO())
+        self.assertEqual(self.kinds(file.pk), ['comment'])
+
+        data = self.client.get('/api/storage/changes/', {'cursor': 0}).json()
+        self.assertTrue(data['resync'])
+        cursor = self.client.get('/api/storage/')['X-Change-Cursor']
+        data = self.client.get('/api/storage/changes/', {'cursor': cursor}).json()
+        self.assertEqual((data['changes'], data['resync']), ([], False))
+
+
+class ReconcileTests(StorageTestCase):
+    def reconcile(self, *args):
+        out = io.StringIO()
+        call_command('reconcile_storage', *args, stdout=out)
+        return out.getvalue()
+
+    def test_report_then_fix(self):
+        kept = self.upload('kept.txt', b'kept content')
+        lost = self.upload('lost.txt', b'lost content')
+        os.remove(lost.file.path)
+        Blob.objects.filter(pk=kept.blob_id).update(size=3)
+        UserFile.objects.filter(pk=kept.pk).update(size=3, preview=kept.file.name + '.preview.txt')
+        orphan = os.path.join(MEDIA_ROOT, 'blobs', 'ff', 'ff', 'orphan.bin')
+        os.makedirs(os.path.dirname(orphan), exist_ok=True)
+        with open(orphan, 'wb') as fh:
+            fh.write(b'x' * 100)
+        hour_ago = time.time() - 7200
+        os.utime(orphan, (hour_ago, hour_ago))
+        fresh = os.path.join(MEDIA_ROOT, 'blobs', 'ff', 'ff', 'fresh.bin')
+        with open(fresh, 'wb') as fh:
+            fh.write(b'y')
+
+        output = self.reconcile()
+        self.assertIn('сирота на диске: blobs/ff/ff/orphan.bin (100 байт)', output)
+        self.assertNotIn('fresh.bin', output)
+        self.assertIn(f'размер не совпадает: {kept.file.name} (в БД 3, на диске 12)', output)
+        self.assertIn(f'нет на диске: {lost.file.name} (блоб #{lost.blob_id})', output)
+        self.assertIn(f'нет на диске: {kept.file.name}.preview.txt (превью файла #{kept.pk})', output)
+        # Без ключей ничего не меняется
+        self.assertTrue(os.path.exists(orphan))
+        self.assertEqual(UserFile.objects.get(pk=kept.pk).size, 3)
+
+        jobs = PreviewJob.objects.filter(user_file=kept).count()
+        self.reconcile('--fix')
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(fresh))
+        kept.refresh_from_db()
+        self.assertEqual((kept.size, kept.preview, Blob.objects.get(pk=kept.blob_id).size), (12, '', 12))
+        self.assertEqual(PreviewJob.objects.filter(user_file=kept).count(), jobs + 1)
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.bytes_used, usage.files_count), (24, 2))
+        self.assertTrue(UserFile.objects.filter(pk=lost.pk).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reconcile('--delete-missing')
+        self.assertFalse(UserFile.objects.filter(pk=lost.pk).exists())
+        self.assertFalse(Blob.objects.filter(pk=lost.blob_id).exists())
+        self.assertEqual(StorageUsage.objects.get(user=self.user).bytes_used, 12)
+        self.assertIn('нет на диске: 0', self.reconcile())
+
+
+@override_settings(STORAGE_DEDUPLICATE=False)
+class ShardingTests(StorageTestCase):
+    def shard(self, *args):
+        out = io.StringIO()
+        call_command('shard_user_storage', '--unlink-delay', '0', *args, stdout=out)
+        return out.getvalue()
+
+    def test_migrate_flat_layout(self):
+        with self.settings(STORAGE_USER_DIR_LEVELS=0):
+            first = self.upload('a.txt', b'first')
+            second = self.upload('b.txt', b'second')
+        self.assertEqual(first.file.name.count('/'), 1)
+        old_name, old_path = first.file.name, first.file.path
+        with open(old_path + '.preview.txt', 'w') as fh:
+            fh.write('first')
+        UserFile.objects.filter(pk=first.pk).update(preview=old_name + '.preview.txt')
+
+        self.assertIn('нужно перенести: 2', self.shard('--dry-run'))
+        self.assertTrue(os.path.exists(old_path))
+        self.assertIn('перенесено: 2', self.shard('--batch-size', '1'))
+
+        first.refresh_from_db()
+        self.assertRegex(first.file.name, r'^user_owner1/[0-9a-f]{2}/[0-9a-f]{2}/[^/]+_a\.txt$')
+        self.assertEqual(first.preview, first.file.name + '.preview.txt')
+        self.assertTrue(os.path.exists(first.file.path + '.preview.txt'))
+        self.assertFalse(os.path.exists(old_path))
+        self.assertFalse(os.path.exists(old_path + '.preview.txt'))
+        for file, content in ((first, b'first'), (second, b'second')):
+            response = self.client.get(f'/api/storage/{file.pk}/')
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+        # Повторный запуск ничего не переносит; новые загрузки сразу ложатся в подкаталоги
+        self.assertIn('перенесено: 0', self.shard())
+        self.assertEqual(self.upload('c.txt', b'third').file.name.count('/'), 3)
+
+
+class BlobTests(StorageTestCase):
+    def test_blob_file_removed_only_after_commit(self):
+        file = self.upload()
+        pk, blob_id, path = file.pk, file.blob_id, file.blob.file.path
+        try:
+            with transaction.atomic():
+                file.delete()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(Blob.objects.get(pk=blob_id).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserFile.objects.get(pk=pk).delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(Blob.objects.exists())
+
+
+class PreviewWorkerTests(StorageTestCase):
+    class Result:
+        def get(self):
+            return '.preview.txt', 0.01
+
+    def test_file_deleted_during_render(self):
+        file = self.upload('notes.txt', b'hello')
+        job = PreviewJob.objects.select_related('user_file').get(user_file=file)
+        job.started_at = timezone.now()
+        file.delete()
+        # Воркер дописывает превью уже после удаления файла
+        preview_path = job.user_file.file.path + '.preview.txt'
+        os.makedirs(os.path.dirname(preview_path), exist_ok=True)
+        with open(preview_path, 'w') as fh:
+            fh.write('hello')
+
+        PreviewWorker().finish(job, self.Result())
+        self.assertFalse(os.path.exists(preview_path))
+        self.assertFalse(PreviewJob.objects.exists())
+
+    def test_content_changed_during_render(self):
+        file = self.upload('notes.txt', b'hello')
+        job = PreviewJob.objects.select_related('user_file').get(user_file=file)
+        job.started_at = timezone.now()
+        UserFile.objects.filter(pk=file.pk).update(file=file.file.name + '.new')
+
+        PreviewWorker().finish(job, self.Result())
+        self.assertEqual(UserFile.objects.get(pk=file.pk).preview, '')
+        self.assertEqual(PreviewJob.objects.get(pk=job.pk).status, PreviewJob.STATUS_DONE)
+
+    def test_hung_render_is_killed(self):
+        result = previews.RenderProcess(time.sleep, (60,), 0.2)
+        started = time.monotonic()
+        while not result.ready():
+            time.sleep(0.02)
+        self.assertLess(time.monotonic() - started, 10)
+        with self.assertRaises(TimeoutError):
+            result.get()
+
+        result = previews.RenderProcess(divmod, (7, 2), 10)
+        while not result.ready():
+            time.sleep(0.02)
+        self.assertEqual(result.get(), (3, 1))
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """Минимальный S3 (как MinIO, path-style) в памяти: PUT, GET с Range, HEAD, DELETE, multipart."""
+    protocol_version = 'HTTP/1.1'
+    objects = {}
+    uploads = {}
+    complete_requests = 0
+    # Завершить multipart-загрузку и оборвать соединение, не ответив
+    drop_after_complete = False
+
+    def log_message(self, *args):
+        pass
+
+    def _target(self):
+        url = urlsplit(self.path)
+        return unquote(url.path).split('/', 2)[2], parse_qs(url.query, keep_blank_values=True)
+
+    def _reply(self, code, body=b'', length=None, headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        key, query = self._target()
+        assert self.headers['Authorization'].startswith('AWS4-HMAC-SHA256 Credential=')
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if 'uploadId' in query:
+            self.uploads[query['uploadId'][0]][int(query['partNumber'][0])] = body
+        else:
+            self.objects[key] = body
+        self._reply(200, headers=[('ETag', f'"{len(body)}"')])
+
+    def do_POST(self):
+        key, query = self._target()
+        body = self.rfile.read(int(self.headers['Content-Length'] or 0))
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = {}
+            self._reply(200, f'<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>'
+                             f'</InitiateMultipartUploadResult>'.encode())
+        else:
+            FakeS3Handler.complete_requests += 1
+            parts = self.uploads.pop(query['uploadId'][0])
+            numbers = [int(number) for number in re.findall(rb'<PartNumber>(\d+)</PartNumber>', body)]
+            self.objects[key] = b''.join(parts[number] for number in numbers)
+            if self.drop_after_complete:
+                self.close_connection = True
+                return
+            self._reply(200, b'<CompleteMultipartUploadResult><ETag>"x"</ETag></CompleteMultipartUploadResult>')
+
+    def do_HEAD(self):
+        key, _ = self._target()
+        self.send_response(200 if key in self.objects else 404)
+        self.send_header('Content-Length', str(len(self.objects.get(key, b''))))
+        self.end_headers()
+
+    def do_GET(self):
+        key, _ = self._target()
+        if key not in self.objects:
+            return self._reply(404)
+        data = self.objects[key]
+        start = int(re.match(r'bytes=(\d+)-', self.headers.get('Range', 'bytes=0-')).group(1))
+        try:
+            self._reply(206, data[start:])
+        except ConnectionResetError:
+            pass
+
+    def do_DELETE(self):
+        key, query = self._target()
+        if 'uploadId' in query:
+            self.uploads.pop(query['uploadId'][0], None)
+        else:
+            self.objects.pop(key, None)
+        self._reply(204)
+
+
+class S3StorageTests(StorageTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.staging = tempfile.mkdtemp()
+        cls.s3_settings = override_settings(
+            STORAGES={'default': {'BACKEND': 'storage.s3.S3Storage'},
+                      'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}},
+            STORAGE_S3_ENDPOINT_URL=f'http://127.0.0.1:{cls.server.server_port}', STORAGE_S3_BUCKET='test',
+            STORAGE_S3_ACCESS_KEY='key', STORAGE_S3_SECRET_KEY='secret', STORAGE_S3_PART_SIZE=5 * 1024 * 1024,
+            STORAGE_STAGING_DIR=cls.staging, STORAGE_PREVIEWS_ENABLED=False)
+        super().setUpClass()
+        # Поверх MEDIA_ROOT базового класса: его override снимается class cleanup уже после tearDownClass
+        cls.s3_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.s3_settings.disable()
+        super().tearDownClass()
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.staging, ignore_errors=True)
+
+    def test_multipart_save_and_ranged_read(self):
+        storage = S3Storage()
+        content = os.urandom(11 * 1024 * 1024)
+        name = storage.save('user_x/big.bin', ContentFile(content))
+        self.assertEqual(FakeS3Handler.objects[name], content)
+        with storage.open(name) as fh:
+            self.assertEqual(fh.size, len(content))
+            fh.seek(7 * 1024 * 1024)
+            self.assertEqual(fh.read(100), content[7 * 1024 * 1024:7 * 1024 * 1024 + 100])
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_failed_abort_keeps_original_error(self):
+        storage = S3Storage()
+        request = storage._request
+
+        def failing(method, name, query=None, **kwargs):
+            if method == 'POST' and 'uploadId' in (query or {}):
+                raise ValueError('complete failed')
+            if method == 'DELETE':
+                raise ConnectionError('abort failed')
+            return request(method, name, query=query, **kwargs)
+
+        storage._request = failing
+        with self.assertRaisesMessage(ValueError, 'complete failed'), self.assertLogs('storage.s3', 'WARNING'):
+            storage.save('user_x/big.bin', ContentFile(os.urandom(6 * 1024 * 1024)))
+
+    def test_complete_is_not_resent_after_disconnect(self):
+        storage = S3Storage()
+        sent = FakeS3Handler.complete_requests
+        with mock.patch.object(FakeS3Handler, 'drop_after_complete', True):
+            with self.assertRaises(ConnectionError):
+                storage.save('user_x/big.bin', ContentFile(os.urandom(6 * 1024 * 1024)))
+        self.assertEqual(FakeS3Handler.complete_requests, sent + 1)
+        # Следующие запросы идут по новому соединению
+        self.assertTrue(storage.exists('user_x/big.bin'))
+        storage.delete('user_x/big.bin')
+
+    def test_upload_download_and_presigned_redirect(self):
+        file = self.upload()
+        self.assertEqual(FakeS3Handler.objects[file.file.name], b'0123456789')
+        response = self.client.get(f'/api/storage/{file.pk}/', HTTP_RANGE='bytes=2-5')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+        with override_settings(STORAGE_S3_PRESIGNED_DOWNLOADS=True):
+            for url in (f'/api/storage/{file.pk}/', f'/api/storage/share/{file.share_link}/'):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 302)
+                self.assertIn(f'/test/{file.file.name}?', response['Location'])
+                self.assertIn('X-Amz-Signature=', response['Location'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/storage/{file.pk}/')
+        self.assertEqual(FakeS3Handler.objects, {})
+        self.assertEqual(os.listdir(os.path.join(self.staging, 'blobs', 'tmp')), [])
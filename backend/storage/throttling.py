@@ -0,0 +1,203 @@
+"""Ограничение скачиваний по публичным ссылкам: одновременные загрузки и байты в секунду.
+
+Лимиты действуют на ссылку и на IP клиента. Состояние (ведро токенов и
+занятые слоты) хранится в файле на каждый ключ в ``STORAGE_SHARE_THROTTLE_DIR``
+и меняется под ``flock``, поэтому его видят все воркеры gunicorn на машине.
+Слот освобождается при закрытии ответа; слоты умерших процессов снимаются
+при следующей попытке занять слот.
+
+Скорость выравнивается в самом потоке ответа: блок списывается из ведра, и
+если оно ушло в минус, поток спит, пока долг не погасится. Ответ, отданный фронтовым
+сервером (X-Accel-Redirect), ограничивается заголовком X-Accel-Limit-Rate
+на соединение, а его слот освобождается сразу.
+"""
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import time
+import uuid
+from django.conf import settings
+
+# Через сколько секунд предлагать повторить запрос, отклоненный по числу одновременных скачиваний
+RETRY_AFTER = 5
+
+# Ведро вмещает столько секунд трафика: короткий всплеск проходит без задержки
+BURST_SECONDS = 1
+
+# Файлы состояния ключей, к которым не обращались столько секунд, удаляются
+STALE_AFTER = 3600
+_last_prune = 0.0
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def client_ip(request):
+    header = settings.STORAGE_SHARE_CLIENT_IP_HEADER
+    if header and request.META.get(header):
+        # X-Forwarded-For: клиент - первый адрес в списке
+        return request.META[header].split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def _path(key):
+    return os.path.join(settings.STORAGE_SHARE_THROTTLE_DIR, hashlib.sha256(key.encode()).hexdigest()[:32])
+
+
+@contextlib.contextmanager
+def _locked_state(key):
+    """Состояние ключа ``{'tokens', 'at', 'slots'}`` под эксклюзивной блокировкой; изменения сохраняются."""
+    os.makedirs(settings.STORAGE_SHARE_THROTTLE_DIR, exist_ok=True)
+    fd = os.open(_path(key), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        raw = os.pread(fd, 1024 * 1024, 0)
+        try:
+            state = json.loads(raw) if raw else {}
+        except ValueError:
+            state = {}
+        state.setdefault('slots', {})
+        yield state
+        data = json.dumps(state).encode()
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+    finally:
+        os.close(fd)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _prune():
+    """Удаляет давно не тронутые файлы состояния (не чаще раза в STALE_AFTER / 6 секунд на процесс)."""
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < STALE_AFTER / 6:
+        return
+    _last_prune = now
+    with contextlib.suppress(FileNotFoundError), os.scandir(settings.STORAGE_SHARE_THROTTLE_DIR) as entries:
+        for entry in entries:
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat().st_mtime < now - STALE_AFTER:
+                    os.remove(entry.path)
+
+
+class Lease:
+    """Занятые слоты одного скачивания и расход его байтов из ведер."""
+
+    def __init__(self, limits):
+        # [(ключ, максимум одновременных, байт в секунду)]; 0 - без ограничения
+        self.limits = limits
+        self.slot = uuid.uuid4().hex
+        self.held = []
+
+    @property
+    def rate(self):
+        return min((rate for _, _, rate in self.limits if rate), default=0)
+
+    def acquire(self):
+        for key, concurrent, _ in self.limits:
+            if not concurrent:
+                continue
+            with _locked_state(key) as state:
+                slots = state['slots']
+                for slot, pid in list(slots.items()):
+                    if not _alive(pid):
+                        del slots[slot]
+                if len(slots) >= concurrent:
+                    self.release()
+                    raise Throttled(RETRY_AFTER)
+                slots[self.slot] = os.getpid()
+            self.held.append(key)
+        _prune()
+        return self
+
+    def release(self):
+        while self.held:
+            with _locked_state(self.held.pop()) as state:
+                state['slots'].pop(self.slot, None)
+
+    def take(self, size):
+        """Списывает ``size`` байт из ведер; возвращает, сколько секунд подождать перед следующим блоком."""
+        wait = 0.0
+        now = time.time()
+        for key, _, rate in self.limits:
+            if not rate:
+                continue
+            capacity = rate * BURST_SECONDS
+            with _locked_state(key) as state:
+                tokens = min(capacity, state.get('tokens', capacity) + (now - state.get('at', now)) * rate)
+                state['tokens'] = tokens - size
+                state['at'] = now
+            wait = max(wait, (size - tokens) / rate)
+        return wait
+
+
+def acquire(request, user_file):
+    """Занимает слоты скачивания по ссылке ``user_file``; ``Throttled``, если лимит исчерпан."""
+    ip = client_ip(request)
+    return Lease([
+        (f'link:{user_file.share_link}', settings.STORAGE_SHARE_MAX_CONCURRENT_PER_LINK,
+         settings.STORAGE_SHARE_RATE_PER_LINK),
+        (f'ip:{ip}', settings.STORAGE_SHARE_MAX_CONCURRENT_PER_IP, settings.STORAGE_SHARE_RATE_PER_IP),
+    ]).acquire()
+
+
+class _Stream:
+    def __init__(self, content, lease):
+        self.content = content
+        self.lease = lease
+
+    def __iter__(self):
+        for chunk in self.content:
+            wait = self.lease.take(len(chunk))
+            if wait > 0:
+                time.sleep(wait)
+            yield chunk
+
+    def close(self):
+        self.lease.release()
+
+
+class _AsyncStream(_Stream):
+    __iter__ = None
+
+    async def __aiter__(self):
+        async for chunk in self.content:
+            wait = await asyncio.to_thread(self.lease.take, len(chunk))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield chunk
+
+
+def apply(response, lease):
+    """Пропускает тело ответа через ведра ``lease`` и освобождает слоты, когда ответ закрыт."""
+    if not lease.held and not lease.rate:
+        return response
+    if not response.streaming:
+        if response.has_header('X-Accel-Redirect') and lease.rate:
+            response['X-Accel-Limit-Rate'] = str(lease.rate)
+        lease.release()
+        return response
+    if not lease.rate:
+        # Тело не трогаем, чтобы FileResponse сохранил wsgi.file_wrapper (sendfile)
+        response._resource_closers.append(lease.release)
+    elif response.is_async:
+        response.streaming_content = _AsyncStream(response.streaming_content, lease)
+    else:
+        # FileResponse теряет wsgi.file_wrapper: байты должны идти через ведро
+        response.streaming_content = _Stream(response.streaming_content, lease)
+    return response
@@ -0,0 +1,80 @@
+"""Прием файла из multipart-запроса сразу на ту файловую систему, где он будет храниться.
+
+Обработчики Django по умолчанию пишут загрузку во временный файл, после чего
+ее еще раз читают при копировании в хранилище и при подсчете SHA-256.
+``StorageUploadHandler`` пишет куски во временный файл рядом с блобами, в том
+же проходе считает размер и SHA-256 (и сжимает, см. compression), а на место
+файл попадает переименованием: ``blobs.commit`` для блобов и
+``FileSystemStorage`` (``temporary_file_path``) для файлов вне блобов.
+"""
+import os
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from . import blobs, compression
+
+
+class StoredUpload(UploadedFile):
+    """Загруженный файл, уже лежащий в хранилище, с посчитанными ``sha256`` и ``codec``.
+
+    ``size`` - размер исходных байтов; при ``codec`` на диске лежат сжатые.
+    """
+
+    def __init__(self, path, name, content_type, size, charset, content_type_extra, sha256, codec):
+        super().__init__(open(path, 'rb'), name, content_type, size, charset, content_type_extra)
+        self.path = path
+        self.sha256 = sha256
+        self.codec = codec
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        super().close()
+        # Файл, который так и не перенесли на место (ошибка валидации, квота), удаляется
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class StorageUploadHandler(FileUploadHandler):
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.path = blobs.temp_path()
+        self.out = open(self.path, 'wb')
+        self.writer = compression.StreamWriter(self.out, self.file_name)
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self.writer.write(raw_data)
+        except BaseException:
+            self.upload_interrupted()
+            raise
+
+    def file_complete(self, file_size):
+        try:
+            codec, sha256, size = self.writer.close()
+        finally:
+            self.out.close()
+        return StoredUpload(self.path, self.file_name, self.content_type, size, self.charset,
+                            self.content_type_extra, sha256, codec)
+
+    def upload_interrupted(self):
+        if hasattr(self, 'out'):
+            self.out.close()
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def install(request):
+    """Ставит ``StorageUploadHandler`` единственным обработчиком загрузки запроса (до чтения тела)."""
+    request.upload_handlers = [StorageUploadHandler(request)]
+
+
+def discard(request):
+    """Удаляет недописанный временный файл, если разбор тела запроса прервался."""
+    for handler in request.upload_handlers:
+        if isinstance(handler, StorageUploadHandler):
+            handler.upload_interrupted()
@@ -0,0 +1,154 @@
+import os
+import re
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .models import StorageUsage, UploadSession, UserFile
+from . import blobs, compression, staging
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+UPLOAD_CHUNK_READ_SIZE = 64 * 1024
+
+
+class ChunkError(Exception):
+    pass
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def parse_content_range(header):
+    """Разбирает заголовок ``Content-Range: bytes start-end/total``."""
+    match = CONTENT_RANGE_RE.match(header.strip())
+    if not match:
+        raise ChunkError('Неверный заголовок Content-Range')
+    start, end = int(match.group(1)), int(match.group(2))
+    total = None if match.group(3) == '*' else int(match.group(3))
+    if end < start:
+        raise ChunkError('Неверный заголовок Content-Range')
+    return start, end, total
+
+
+def check_chunk(session, start, end):
+    if start > session.received:
+        raise ChunkError('Пропущена часть файла')
+    if end >= session.size:
+        raise ChunkError('Кусок выходит за границы файла')
+    if end - start + 1 > settings.STORAGE_UPLOAD_MAX_CHUNK_SIZE:
+        raise ChunkError('Слишком большой кусок')
+
+
+def write_part(session, start, end, stream):
+    """Дописывает байты из ``stream`` в part-файл; только файловый ввод-вывод, без БД."""
+    path = staging.local_path(session.part_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    expected = end - start + 1
+    written = 0
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as part:
+        part.seek(start)
+        while written < expected and stream is not None:
+            data = stream.read(min(UPLOAD_CHUNK_READ_SIZE, expected - written))
+            if not data:
+                break
+            part.write(data)
+            written += len(data)
+    return written
+
+
+def write_chunk(session, start, end, stream):
+    """Пишет кусок в part-файл сессии начиная с ``start``.
+
+    Повторная отправка уже полученного куска безопасна: данные просто
+    перезаписываются по тем же смещениям. Пропуски не допускаются.
+    """
+    check_chunk(session, start, end)
+    written = write_part(session, start, end, stream)
+
+    UploadSession.objects.filter(pk=session.pk).update(
+        received=Greatest(F('received'), start + written), updated_at=timezone.now())
+    session.refresh_from_db(fields=['received', 'updated_at'])
+    if written != end - start + 1:
+        raise ChunkError('Получено меньше данных, чем указано в Content-Range')
+    return session
+
+
+def finalize(session):
+    """Переносит собранный part-файл в хранилище пользователя и создает ``UserFile``.
+
+    Сессию сначала забирает удаление ее строки: из параллельных запросов
+    завершает загрузку только тот, чей DELETE удалил строку, остальные
+    получают ``ChunkError``. При ошибке сессия возвращается, и завершение можно повторить.
+    """
+    if not UploadSession.objects.filter(pk=session.pk).delete()[0]:
+        raise ChunkError('Загрузка уже завершается')
+    part_path = staging.local_path(session.part_path)
+    try:
+        return _finalize(session, part_path)
+    except BaseException:
+        if not os.path.exists(part_path):
+            session.received = 0
+        session.save(force_insert=True)
+        raise
+
+
+def _finalize(session, part_path):
+    user_file = UserFile(user=session.user, original_name=session.original_name)
+    if not os.path.exists(part_path) and session.size == 0:
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        open(part_path, 'wb').close()
+
+    if not StorageUsage.charge(session.user, session.size):
+        raise QuotaExceeded
+    # Перенос в хранилище (с S3 - загрузка) идет вне транзакции
+    try:
+        store_path(user_file, part_path, session.size)
+    except BaseException:
+        StorageUsage.release(session.user_id, session.size)
+        raise
+    try:
+        with transaction.atomic():
+            user_file.save()
+    except BaseException:
+        StorageUsage.release(session.user_id, session.size)
+        user_file.release_content()
+        raise
+    return user_file
+
+
+def store_path(user_file, path, size):
+    """Делает локальный файл ``path`` содержимым ``user_file`` (блобом или отдельным файлом); ``path`` исчезает.
+
+    Заполняет file, blob, size, codec и sha256 (кроме несжатого отдельного файла), но не сохраняет ``user_file``.
+    """
+    if settings.STORAGE_DEDUPLICATE:
+        blob = blobs.ingest_path(path, user_file.original_name)
+        user_file.blob = blob
+        user_file.sha256 = blob.sha256
+        user_file.codec = blob.codec
+        user_file.size = blob.size
+        user_file.file = blob.file.name
+        return
+    user_file.blob = None
+    user_file.codec, user_file.size = '', size
+    name = UserFile._meta.get_field('file').generate_filename(user_file, user_file.original_name)
+    name = default_storage.get_available_name(name)
+    if compression.codec_for_path(path, user_file.original_name):
+        compressed = blobs.temp_path()
+        with open(path, 'rb') as source, open(compressed, 'wb') as out:
+            user_file.codec, user_file.sha256, user_file.size = compression.write_stream(
+                iter(lambda: source.read(UPLOAD_CHUNK_READ_SIZE), b''), out, user_file.original_name, size)
+        os.remove(path)
+        path = compressed
+    user_file.file = staging.place(path, name)
+
+
+def discard(session):
+    path = staging.local_path(session.part_path)
+    if os.path.exists(path):
+        os.remove(path)
+    session.delete()
@@ -1,8 +1,24 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path('', views.file_list, name='file_list'),
     path('<int:pk>/', views.file_detail, name='file_detail'),
+    path('<int:pk>/preview/', views.file_preview, name='file_preview'),
+    path('<int:pk>/versions/', views.version_list, name='version_list'),
+    path('<int:pk>/versions/<int:number>/', views.version_detail, name='version_detail'),
+    path('<int:pk>/versions/<int:number>/restore/', views.version_restore, name='version_restore'),
+    path('chunks/', views.chunk_index, name='chunk_index'),
+    path('search/', views.file_search, name='file_search'),
+    path('changes/', views.file_changes, name='file_changes'),
+    path('archive/', views.file_archive, name='file_archive'),
+    path('batch/', views.file_batch, name='file_batch'),
+    path('uploads/', views.upload_list, name='upload_list'),
+    path('uploads/<uuid:pk>/', views.upload_detail, name='upload_detail'),
+    path('uploads/<uuid:pk>/complete/', views.upload_complete, name='upload_complete'),
     path('share/<uuid:share_link>/', views.file_share, name='file_share'),
+    # Асинхронные варианты для запуска под ASGI
+    path('stream/<int:pk>/', async_views.file_download, name='file_stream'),
+    path('stream/share/<uuid:share_link>/', async_views.file_share_download, name='file_share_stream'),
+    path('stream/uploads/<uuid:pk>/', async_views.upload_chunk, name='upload_chunk_stream'),
 ]
@@ -0,0 +1,335 @@
+"""Версии содержимого файла из кусков, которые хранятся один раз.
+
+Версия (FileVersion) - упорядоченный список кусков (VersionChunk), нарезанных
+по содержимому (storage.chunking). Последняя версия - это текущее содержимое
+UserFile (блоб или отдельный файл), так что скачивание, превью, публичные
+ссылки и архивы работают как прежде, а ее куски - только хеши и смещения в
+этом содержимом. Когда версия становится прежней, ее куски переходят в блобы
+с SHA-256 куска: совпадающие куски разных версий и файлов лежат на диске однажды.
+
+Новая версия загружается целиком (сервер режет ее сам) или разностью:
+клиент режет файл тем же алгоритмом, узнает через ``missing_chunks``, каких
+кусков у сервера нет, и присылает манифест всех кусков версии и одним потоком
+байты только отсутствующих - в порядке первого появления в манифесте.
+
+Версия 1 создается из прежнего содержимого при первом изменении файла.
+Прежние версии занимают квоту владельца своим размером, их число ограничено
+STORAGE_MAX_FILE_VERSIONS. Все байты сохраняются до транзакции; транзакция
+только публикует версию, если файл за это время не изменился.
+"""
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import re
+from collections import Counter, namedtuple
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from .compression import open_stored
+from .models import Blob, FileVersion, PreviewJob, StorageUsage, UserFile, VersionChunk
+from .previews import preview_kind
+from .uploads import QuotaExceeded, store_path
+from . import blobs, chunking
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# Сколько хешей проверять одним запросом (лимит параметров SQLite)
+LOOKUP_BATCH_SIZE = 500
+
+CHANGED = 'Файл изменился во время загрузки, повторите'
+
+# Кусок версии: ``data`` - байты или ``None``, если кусок уже хранится
+Piece = namedtuple('Piece', 'sha256 size data')
+
+
+class VersionError(Exception):
+    pass
+
+
+class MissingChunks(VersionError):
+    """В запросе нет байтов кусков, которых у сервера нет; ``missing`` - их хеши."""
+
+    def __init__(self, missing):
+        super().__init__('Не хватает кусков версии')
+        self.missing = missing
+
+
+def known_chunks(user_id, hashes):
+    """Хеши из ``hashes``, куски с которыми уже есть в версиях файлов пользователя.
+
+    Чужие куски не учитываются: иначе по ответу можно было бы узнать,
+    есть ли у кого-то файл с известным содержимым.
+    """
+    hashes = list(hashes)
+    known = set()
+    for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+        known.update(VersionChunk.objects.filter(
+            sha256__in=hashes[start:start + LOOKUP_BATCH_SIZE], version__user_file__user_id=user_id,
+        ).order_by().values_list('sha256', flat=True).distinct())
+    return known
+
+
+def missing_chunks(user_id, hashes):
+    """Хеши из ``hashes`` без повторов, в исходном порядке, которых у пользователя нет."""
+    hashes = list(dict.fromkeys(hashes))
+    known = known_chunks(user_id, hashes)
+    return [sha256 for sha256 in hashes if sha256 not in known]
+
+
+def parse_manifest(value):
+    """Манифест версии - JSON-список ``{"sha256": ..., "size": ...}``; возвращает список ``(sha256, size)``."""
+    try:
+        entries = json.loads(value) if isinstance(value, (str, bytes)) else value
+    except ValueError:
+        raise VersionError('Манифест должен быть JSON-списком кусков')
+    if not isinstance(entries, list):
+        raise VersionError('Манифест должен быть JSON-списком кусков')
+    manifest = []
+    for entry in entries:
+        sha256 = entry.get('sha256') if isinstance(entry, dict) else None
+        size = entry.get('size') if isinstance(entry, dict) else None
+        if not isinstance(sha256, str) or not SHA256_RE.match(sha256):
+            raise VersionError('Неверный SHA-256 куска')
+        if not isinstance(size, int) or isinstance(size, bool) or not 0 < size <= chunking.MAX_SIZE:
+            raise VersionError(f'Размер куска должен быть от 1 до {chunking.MAX_SIZE} байт')
+        manifest.append((sha256, size))
+    return manifest
+
+
+def file_pieces(blocks):
+    """Куски содержимого из потока блоков байтов, нарезанные сервером."""
+    for data in chunking.split(blocks):
+        yield Piece(hashlib.sha256(data).hexdigest(), len(data), data)
+
+
+def delta_pieces(user_id, manifest, stream, stream_size):
+    """Куски версии по манифесту: отсутствующие у пользователя читаются из ``stream`` по порядку.
+
+    Проверяет заранее, что ``stream`` содержит ровно отсутствующие куски, иначе - ``MissingChunks``.
+    """
+    known = known_chunks(user_id, {sha256 for sha256, _ in manifest})
+    expected, sent = 0, set()
+    missing = []
+    for sha256, size in manifest:
+        if sha256 not in known and sha256 not in sent:
+            sent.add(sha256)
+            missing.append(sha256)
+            expected += size
+    if expected != stream_size:
+        raise MissingChunks(missing)
+
+    def pieces():
+        for sha256, size in manifest:
+            if sha256 not in sent:
+                yield Piece(sha256, size, None)
+                continue
+            sent.discard(sha256)
+            data = stream.read(size)
+            if len(data) != size or hashlib.sha256(data).hexdigest() != sha256:
+                raise VersionError(f'Байты куска не совпадают с манифестом: {sha256}')
+            yield Piece(sha256, size, data)
+
+    return pieces()
+
+
+def read_blob(blob):
+    """Исходные байты блоба блоками."""
+    with open_stored(blob.file.storage, blob.file.name, blob.codec) as fh:
+        yield from iter(lambda: fh.read(READ_BLOCK_SIZE), b'')
+
+
+def read_version(version):
+    """Исходные байты версии блоками: прежней - из блобов кусков, последней - из содержимого файла."""
+    for _ in range(2):
+        chunks = list(version.chunks.select_related('blob').order_by('index'))
+        if all(chunk.blob is not None for chunk in chunks):
+            for chunk in chunks:
+                yield from read_blob(chunk.blob)
+            return
+        user_file = UserFile.objects.get(pk=version.user_file_id)
+        # Если файл успел измениться, куски версии уже перешли в блобы
+        if user_file.sha256 == version.sha256:
+            with user_file.open_content() as fh:
+                yield from iter(lambda: fh.read(READ_BLOCK_SIZE), b'')
+            return
+    raise VersionError(CHANGED)
+
+
+class ChunkReader:
+    """Байты кусков из версий файлов пользователя: из блоба или из содержимого файла по смещению.
+
+    Файлы остаются открытыми до ``close()``, поэтому куски одного файла,
+    идущие по порядку, читаются за один проход без повторной распаковки.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.files = {}
+        self.stack = contextlib.ExitStack()
+
+    def close(self):
+        self.stack.close()
+
+    def find(self, sha256, size):
+        """Байты куска с хешем ``sha256``; нет такого куска - ``MissingChunks``."""
+        chunk = (VersionChunk.objects.filter(version__user_file__user_id=self.user_id, sha256=sha256, size=size)
+                 .select_related('blob', 'version__user_file').order_by(F('blob').asc(nulls_last=True)).first())
+        if chunk is None:
+            raise MissingChunks([sha256])
+        return self.read(chunk)
+
+    def read(self, chunk):
+        if chunk.blob is not None:
+            data = b''.join(read_blob(chunk.blob))
+        else:
+            data = self._read_at(chunk.version.user_file, chunk.offset, chunk.size)
+        # Несовпадение - файл заменили, пока читались куски его последней версии
+        if len(data) != chunk.size or hashlib.sha256(data).hexdigest() != chunk.sha256:
+            raise VersionError(CHANGED)
+        return data
+
+    def _read_at(self, user_file, offset, size):
+        entry = self.files.get(user_file.file.name)
+        if entry is None or entry[1] > offset:
+            entry = self.files[user_file.file.name] = [self.stack.enter_context(user_file.open_content()), 0]
+        if entry[1] != offset:
+            entry[0].seek(offset)
+        data = entry[0].read(size)
+        entry[1] = offset + len(data)
+        return data
+
+
+def _back(sha256, size, read, staged):
+    """Блоб для куска прежней версии: ссылка на существующий или новый из ``read()``; ссылка считается в ``staged``."""
+    blob = blobs.reference(sha256) or blobs.ingest_file(ContentFile(read(), name=sha256))
+    staged[blob.pk] += 1
+    if blob.size != size:
+        raise VersionError(f'Размер куска не совпадает с хранимым: {sha256}')
+    return blob
+
+
+def _history_chunks(user_file, number, reader, staged):
+    """Куски версии ``number``, которая станет прежней, с блобами; без версий - куски версии 1 из содержимого файла."""
+    if number is not None:
+        chunks = list(VersionChunk.objects.filter(version__user_file=user_file, version__number=number,
+                                                  blob__isnull=True).select_related('version__user_file'))
+        for chunk in chunks:
+            chunk.blob = _back(chunk.sha256, chunk.size, lambda: reader.read(chunk), staged)
+        return chunks
+
+    chunks = []
+    offset = 0
+    with user_file.open_content() as fh:
+        for index, piece in enumerate(file_pieces(iter(lambda: fh.read(READ_BLOCK_SIZE), b''))):
+            blob = _back(piece.sha256, piece.size, lambda: piece.data, staged)
+            chunks.append(VersionChunk(index=index, sha256=piece.sha256, size=piece.size, offset=offset, blob=blob))
+            offset += piece.size
+    return chunks
+
+
+def _write_version(pieces, reader, out):
+    """Пишет байты ``pieces`` в ``out``; возвращает несохраненные куски (без блобов), SHA-256 и размер."""
+    digest = hashlib.sha256()
+    chunks = []
+    offset = 0
+    for index, piece in enumerate(pieces):
+        data = reader.find(piece.sha256, piece.size) if piece.data is None else piece.data
+        out.write(data)
+        digest.update(data)
+        chunks.append(VersionChunk(index=index, sha256=piece.sha256, size=piece.size, offset=offset))
+        offset += len(data)
+    return chunks, digest.hexdigest(), offset
+
+
+def _prune(user_file):
+    if settings.STORAGE_MAX_FILE_VERSIONS:
+        stale = user_file.versions.order_by('-number').values_list('pk', flat=True)[settings.STORAGE_MAX_FILE_VERSIONS:]
+        FileVersion.objects.filter(pk__in=list(stale)).delete_with_chunks()
+
+
+def _publish(user_file, number, history, content, chunks, sha256, size):
+    """Делает подготовленное содержимое ``content`` новой версией; вызывается в транзакции."""
+    locked = UserFile.objects.select_for_update().select_related('user').get(pk=user_file.pk)
+    last = locked.versions.aggregate(last=Max('number'))['last']
+    if locked.file.name != user_file.file.name or last != number:
+        raise VersionError(CHANGED)
+
+    if number is None:
+        number = 1
+        first = FileVersion.objects.create(user_file=locked, number=number, size=locked.size, sha256=locked.sha256)
+        for chunk in history:
+            chunk.version = first
+        VersionChunk.objects.bulk_create(history, batch_size=LOOKUP_BATCH_SIZE)
+    else:
+        VersionChunk.objects.bulk_update(history, ['blob'], batch_size=LOOKUP_BATCH_SIZE)
+    version = FileVersion.objects.create(user_file=locked, number=number + 1, size=size, sha256=sha256)
+    for chunk in chunks:
+        chunk.version = version
+    VersionChunk.objects.bulk_create(chunks, batch_size=LOOKUP_BATCH_SIZE)
+
+    previous = copy.copy(locked)
+    locked.file, locked.blob, locked.codec = content.file.name, content.blob, content.codec
+    locked.size, locked.sha256 = size, sha256
+    locked.preview = ''
+    locked.uploaded_at = timezone.now()
+    locked.save(update_fields=['file', 'blob', 'size', 'codec', 'sha256', 'preview', 'uploaded_at'])
+    previous.release_content()
+    if settings.STORAGE_PREVIEWS_ENABLED and preview_kind(locked.original_name):
+        PreviewJob.objects.create(user_file=locked)
+
+    _prune(locked)
+    # Прежнее содержимое осталось в квоте как версия, новое добавляется целиком
+    if not StorageUsage.charge(locked.user, size, files=0):
+        raise QuotaExceeded
+    return version
+
+
+def commit(user_file, size, pieces):
+    """Создает из ``pieces`` новую версию файла размером ``size`` и делает ее текущим содержимым.
+
+    Новое содержимое и блобы кусков прежней версии сохраняются до транзакции,
+    короткая транзакция только публикует версию. Превышение квоты - ``QuotaExceeded``,
+    неверные куски или файл, измененный за время загрузки, - ``VersionError``.
+    """
+    user_file = UserFile.objects.select_related('user').get(pk=user_file.pk)
+    if not StorageUsage.has_room(user_file.user, size):
+        raise QuotaExceeded
+    number = user_file.versions.aggregate(last=Max('number'))['last']
+
+    staged = Counter()
+    content = copy.copy(user_file)
+    content.file, content.blob = '', None
+    reader = ChunkReader(user_file.user_id)
+    path = blobs.temp_path()
+    try:
+        try:
+            history = _history_chunks(user_file, number, reader, staged)
+            with open(path, 'wb') as out:
+                chunks, sha256, written = _write_version(pieces, reader, out)
+        finally:
+            reader.close()
+        if written != size:
+            raise VersionError('Размер версии не совпадает с заявленным')
+        store_path(content, path, size)
+        with transaction.atomic():
+            return _publish(user_file, number, history, content, chunks, sha256, size)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        Blob.release_many(staged)
+        if content.file:
+            content.release_content()
+        raise
+
+
+def restore(version):
+    """Новая версия с содержимым ``version``: куски читаются из уже хранимых, без загрузки."""
+    pieces = [Piece(sha256, size, None) for sha256, size in
+              version.chunks.order_by('index').values_list('sha256', 'size')]
+    return commit(version.user_file, version.size, pieces)
@@ -1,24 +1,39 @@
-import os
+import mimetypes
 from django.shortcuts import get_object_or_404
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
-from django.http import FileResponse
+from rest_framework.utils.urls import replace_query_param
+from django.conf import settings
+from django.db import transaction
+from django.core.files.storage import default_storage
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
 from django.utils.text import get_valid_filename
-from django.utils import timezone
-from .models import UserFile
-from .serializers import FileSerializer, FileRenameSerializer
+from .models import StorageUsage, UserFile, UploadSession
+from .serializers import (FileListSerializer, FileSerializer, FileRenameSerializer, FileVersionSerializer,
+                          UploadSessionSerializer)
+from .downloads import serve_file
+from . import (archives, bookkeeping, chunking, changes, pagination, search, throttling, upload_handlers, uploads,
+               versions)
+from common.renderers import FastJSONRenderer
 from users.models import CustomUser
 from rest_framework.permissions import AllowAny
 
 
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
+@renderer_classes([FastJSONRenderer, BrowsableAPIRenderer])
 def file_list(request):
     if request.method == 'GET':
+        user_id = request.user.pk
         if request.user.is_administrator:
             user_id = request.query_params.get('user_id')
+            if user_id and not user_id.isdigit():
+                return Response({'error': 'Параметр user_id должен быть целым числом'},
+                                status=status.HTTP_400_BAD_REQUEST)
             if user_id:
                 files = UserFile.objects.filter(user_id=user_id)
             else:
@@ -26,17 +41,120 @@ def file_list(request):
         else:
             files = UserFile.objects.filter(user=request.user)
 
-        serializer = FileSerializer(files, many=True, context={'request': request})
-        return Response(serializer.data)
+        # Курсор по тем же файлам, что в списке: в общем списке администратора - по всему журналу
+        change_cursor = changes.latest(int(user_id) if user_id else None)
+        try:
+            files = pagination.apply_filters(files, request.query_params)
+            page, next_cursor = pagination.paginate(FileListSerializer.columns(files), request.query_params)
+        except pagination.ListingError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = FileListSerializer(page, context={'request': request})
+        response = Response(serializer.data)
+        # Курсор журнала, прочитанный до списка: изменения во время листинга придут в /changes/ повторно
+        response['X-Change-Cursor'] = str(change_cursor)
+        if next_cursor:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', next_cursor)
+            response['Link'] = f'<{next_url}>; rel="next"'
+            response['X-Next-Cursor'] = next_cursor
+        return response
 
     elif request.method == 'POST':
-        serializer = FileSerializer(data=request.data, context={'request': request})
+        if settings.STORAGE_DIRECT_UPLOADS:
+            upload_handlers.install(request)
+        try:
+            data = request.data
+        except Exception:
+            upload_handlers.discard(request)
+            raise
+        serializer = FileSerializer(data=data, context={'request': request})
         if serializer.is_valid():
-            serializer.save()
+            size = serializer.validated_data['file'].size
+            if not StorageUsage.charge(request.user, size):
+                return Response({'error': 'Превышена квота хранилища'},
+                                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            # Байты уходят в хранилище вне транзакции; при ошибке место возвращается
+            try:
+                serializer.save()
+            except BaseException:
+                StorageUsage.release(request.user.pk, size)
+                raise
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def file_search(request):
+    """Поиск по имени и комментарию через полнотекстовый индекс (storage.search), по релевантности."""
+    query = request.query_params.get('q', '')
+    if not search.terms(query):
+        return Response({'error': 'Укажите поисковый запрос'}, status=status.HTTP_400_BAD_REQUEST)
+
+    user_id = request.user.pk
+    if request.user.is_administrator:
+        user_id = request.query_params.get('user_id') or None
+    if user_id is not None and not str(user_id).isdigit():
+        return Response({'error': 'Параметр user_id должен быть целым числом'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = pagination.parse_limit(request.query_params)
+        after = None
+        if request.query_params.get('cursor'):
+            after = pagination.decode_cursor(request.query_params['cursor'], 'rank')
+    except pagination.ListingError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    rows = search.ranked(query, None if user_id is None else int(user_id), limit + 1, after)
+    files = UserFile.objects.select_related('user').in_bulk([pk for pk, _ in rows[:limit]])
+    page = [files[pk] for pk, _ in rows[:limit] if pk in files]
+
+    serializer = FileSerializer(page, many=True, context={'request': request})
+    response = Response(serializer.data)
+    if len(rows) > limit:
+        last_pk, last_score = rows[limit - 1]
+        next_cursor = pagination.encode_cursor('rank', last_score, last_pk)
+        next_url = replace_query_param(request.build_absolute_uri(), 'cursor', next_cursor)
+        response['Link'] = f'<{next_url}>; rel="next"'
+        response['X-Next-Cursor'] = next_cursor
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def file_changes(request):
+    """Изменения файлов после курсора из X-Change-Cursor списка или из прошлого ответа (storage.changes).
+
+    ``resync: true`` - журнал не покрывает курсор, клиенту нужно заново получить полный список.
+    Как и список файлов, администратору без ``user_id`` отдаются изменения всех пользователей.
+    """
+    user_id = request.user.pk
+    if request.user.is_administrator:
+        user_id = request.query_params.get('user_id')
+    if user_id and not str(user_id).isdigit():
+        return Response({'error': 'Параметр user_id должен быть целым числом'}, status=status.HTTP_400_BAD_REQUEST)
+
+    cursor = request.query_params.get('cursor', '')
+    if not cursor.isdigit():
+        return Response({'error': 'Параметр cursor должен быть целым числом'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = pagination.parse_limit(request.query_params)
+    except pagination.ListingError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    rows, cursor, has_more, resync = changes.since(int(user_id) if user_id else None, int(cursor), limit)
+    context = {'request': request}
+    return Response({
+        'changes': [
+            {'id': file_id, 'op': kind, 'file': FileSerializer(file, context=context).data if file else None}
+            for file_id, kind, file in rows
+        ],
+        'cursor': cursor,
+        'has_more': has_more,
+        'resync': resync,
+    })
+
+
 @api_view(['GET', 'DELETE', 'PATCH'])
 @permission_classes([IsAuthenticated])
 def file_detail(request, pk):
@@ -49,17 +167,12 @@ def file_detail(request, pk):
         return Response({'error': 'Нет прав доступа'}, status=status.HTTP_403_FORBIDDEN)
 
     if request.method == 'GET':
-        file.last_downloaded_at = timezone.now()
-        file.save()
-
-        response = FileResponse(file.file.open('rb'))
-        response['Content-Disposition'] = f'attachment; filename="{get_valid_filename(file.original_name)}"'
+        response = serve_file(request, file)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT, status.HTTP_302_FOUND):
+            bookkeeping.record_download(file)
         return response
 
     elif request.method == 'DELETE':
-        file_path = file.file.path
-        if os.path.exists(file_path):
-            os.remove(file_path)
         file.delete()
         return Response({'message': 'Файл удален'})
 
@@ -80,6 +193,130 @@ def file_detail(request, pk):
                         status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def file_preview(request, pk):
+    try:
+        file = UserFile.objects.get(pk=pk)
+    except UserFile.DoesNotExist:
+        return Response({'error': 'Файл не найден'}, status=status.HTTP_404_NOT_FOUND)
+
+    if not request.user.is_administrator and file.user_id != request.user.pk:
+        return Response({'error': 'Нет прав доступа'}, status=status.HTTP_403_FORBIDDEN)
+    if not file.preview:
+        return Response({'error': 'Превью еще не готово'}, status=status.HTTP_404_NOT_FOUND)
+
+    content_type = 'text/plain; charset=utf-8' if file.preview.endswith('.txt') else None
+    response = FileResponse(default_storage.open(file.preview, 'rb'), content_type=content_type)
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+def _versioned_file(request, pk):
+    """Файл для запросов о версиях и ответ с ошибкой, если он не найден или чужой."""
+    try:
+        file = UserFile.objects.get(pk=pk)
+    except UserFile.DoesNotExist:
+        return None, Response({'error': 'Файл не найден'}, status=status.HTTP_404_NOT_FOUND)
+    if not request.user.is_administrator and file.user_id != request.user.pk:
+        return None, Response({'error': 'Нет прав доступа'}, status=status.HTTP_403_FORBIDDEN)
+    return file, None
+
+
+def _commit_version(commit):
+    """Выполняет ``commit`` и переводит ошибки версий в ответы."""
+    try:
+        version = commit()
+    except versions.MissingChunks as e:
+        return Response({'error': str(e), 'missing': e.missing}, status=status.HTTP_409_CONFLICT)
+    except versions.VersionError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except uploads.QuotaExceeded:
+        return Response({'error': 'Превышена квота хранилища'},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    return Response(FileVersionSerializer(version).data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def version_list(request, pk):
+    """Версии файла (storage.versions), новые - первыми.
+
+    POST создает новую версию: целиком из ``file`` или разностью - ``manifest``
+    со всеми кусками версии и ``chunks`` с байтами отсутствующих у сервера кусков.
+    """
+    file, error = _versioned_file(request, pk)
+    if error:
+        return error
+
+    if request.method == 'GET':
+        return Response(FileVersionSerializer(file.versions.all(), many=True).data)
+
+    if 'manifest' in request.data:
+        try:
+            manifest = versions.parse_manifest(request.data['manifest'])
+        except versions.VersionError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        stream = request.FILES.get('chunks')
+        size = sum(size for _, size in manifest)
+        return _commit_version(lambda: versions.commit(file, size, versions.delta_pieces(
+            file.user_id, manifest, stream, stream.size if stream else 0)))
+    upload = request.FILES.get('file')
+    if upload is None:
+        return Response({'error': 'Нужен файл или манифест версии'}, status=status.HTTP_400_BAD_REQUEST)
+    return _commit_version(lambda: versions.commit(file, upload.size, versions.file_pieces(upload.chunks())))
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def version_detail(request, pk, number):
+    """Содержимое версии: куски потоком по порядку."""
+    file, error = _versioned_file(request, pk)
+    if error:
+        return error
+    version = file.versions.filter(number=number).first()
+    if version is None:
+        return Response({'error': 'Версия не найдена'}, status=status.HTTP_404_NOT_FOUND)
+
+    etag = f'"{version.sha256}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        content_type = mimetypes.guess_type(file.original_name)[0] or 'application/octet-stream'
+        response = StreamingHttpResponse(versions.read_version(version), content_type=content_type)
+        response['Content-Length'] = str(version.size)
+        response['Content-Disposition'] = f'attachment; filename="{get_valid_filename(file.original_name)}"'
+    response['ETag'] = etag
+    return response
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def version_restore(request, pk, number):
+    """Делает содержимое версии текущим - новой версией поверх последней."""
+    file, error = _versioned_file(request, pk)
+    if error:
+        return error
+    version = file.versions.filter(number=number).first()
+    if version is None:
+        return Response({'error': 'Версия не найдена'}, status=status.HTTP_404_NOT_FOUND)
+    return _commit_version(lambda: versions.restore(version))
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def chunk_index(request):
+    """GET - параметры нарезки на куски (storage.chunking); POST - какие из ``chunks`` (SHA-256) нужно загрузить."""
+    if request.method == 'GET':
+        return Response({'algorithm': chunking.ALGORITHM, 'min_size': chunking.MIN_SIZE,
+                         'max_size': chunking.MAX_SIZE})
+
+    hashes = request.data.get('chunks')
+    if not isinstance(hashes, list) or not all(
+            isinstance(sha256, str) and versions.SHA256_RE.match(sha256) for sha256 in hashes):
+        return Response({'error': 'Нужен список SHA-256 кусков'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'missing': versions.missing_chunks(request.user.pk, hashes)})
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def file_share(request, share_link):
@@ -88,9 +325,180 @@ def file_share(request, share_link):
     except UserFile.DoesNotExist:
         return Response({'error': 'Файл не найден'}, status=status.HTTP_404_NOT_FOUND)
 
-    file.last_downloaded_at = timezone.now()
-    file.save()
+    try:
+        lease = throttling.acquire(request, file)
+    except throttling.Throttled as e:
+        return Response({'error': 'Слишком много одновременных скачиваний, повторите позже'},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': str(e.retry_after)})
+
+    try:
+        response = throttling.apply(serve_file(request, file), lease)
+    except BaseException:
+        lease.release()
+        raise
+    if response.status_code in (status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT, status.HTTP_302_FOUND):
+        bookkeeping.record_download(file)
+    return response
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def upload_list(request):
+    if request.method == 'GET':
+        sessions = UploadSession.objects.filter(user=request.user)
+        serializer = UploadSessionSerializer(sessions, many=True)
+        return Response(serializer.data)
+
+    elif request.method == 'POST':
+        serializer = UploadSessionSerializer(data=request.data)
+        if serializer.is_valid():
+            if not StorageUsage.has_room(request.user, serializer.validated_data['size']):
+                return Response({'error': 'Превышена квота хранилища'},
+                                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            serializer.save(user=request.user)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET', 'PUT', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def upload_detail(request, pk):
+    try:
+        session = UploadSession.objects.get(pk=pk, user=request.user)
+    except UploadSession.DoesNotExist:
+        return Response({'error': 'Сессия загрузки не найдена'}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == 'GET':
+        return Response(UploadSessionSerializer(session).data)
+
+    elif request.method == 'PUT':
+        try:
+            start, end, total = uploads.parse_content_range(request.headers.get('Content-Range', ''))
+            if total is not None and total != session.size:
+                raise uploads.ChunkError('Размер файла не совпадает с сессией')
+            uploads.write_chunk(session, start, end, request.stream)
+        except uploads.ChunkError as e:
+            return Response({'error': str(e), 'received': session.received},
+                            status=status.HTTP_409_CONFLICT)
+        return Response(UploadSessionSerializer(session).data)
+
+    elif request.method == 'DELETE':
+        uploads.discard(session)
+        return Response({'message': 'Загрузка отменена'})
+
 
-    response = FileResponse(file.file.open('rb'))
-    response['Content-Disposition'] = f'attachment; filename="{get_valid_filename(file.original_name)}"'
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def upload_complete(request, pk):
+    try:
+        session = UploadSession.objects.get(pk=pk, user=request.user)
+    except UploadSession.DoesNotExist:
+        return Response({'error': 'Сессия загрузки не найдена'}, status=status.HTTP_404_NOT_FOUND)
+
+    if not session.is_complete:
+        return Response({'error': 'Файл загружен не полностью', 'received': session.received},
+                        status=status.HTTP_409_CONFLICT)
+
+    try:
+        file = uploads.finalize(session)
+    except uploads.ChunkError as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+    except uploads.QuotaExceeded:
+        return Response({'error': 'Превышена квота хранилища'},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    serializer = FileSerializer(file, context={'request': request})
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def file_archive(request):
+    """ZIP с выбранными файлами (``ids``) или со всеми файлами пользователя (``all``)."""
+    params = request.data if request.method == 'POST' else request.query_params
+    if params.get('all') in (True, 'true', '1'):
+        user_id = params.get('user_id') if request.user.is_administrator else None
+        if user_id and not str(user_id).isdigit():
+            return Response({'error': 'Параметр user_id должен быть целым числом'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        files = UserFile.objects.filter(user_id=user_id or request.user.pk)
+    else:
+        ids = params.get('ids') or []
+        if isinstance(ids, str):
+            ids = ids.split(',')
+        try:
+            ids = {int(pk) for pk in ids}
+        except (TypeError, ValueError):
+            return Response({'error': 'Неверный список файлов'}, status=status.HTTP_400_BAD_REQUEST)
+        if not ids:
+            return Response({'error': 'Не выбраны файлы'}, status=status.HTTP_400_BAD_REQUEST)
+
+        files = UserFile.objects.filter(pk__in=ids)
+        found = dict(files.values_list('pk', 'user_id'))
+        missing = ids - found.keys()
+        if missing:
+            return Response({'error': 'Файл не найден', 'ids': sorted(missing)},
+                            status=status.HTTP_404_NOT_FOUND)
+        if not request.user.is_administrator and any(uid != request.user.pk for uid in found.values()):
+            return Response({'error': 'Нет прав доступа'}, status=status.HTTP_403_FORBIDDEN)
+
+    files = files.order_by('id')
+    for file in files.only('id'):
+        bookkeeping.record_download(file)
+
+    response = StreamingHttpResponse(archives.stream_zip(files.iterator()), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="files.zip"'
     return response
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def file_batch(request):
+    """Пакет операций ``delete`` / ``comment`` / ``rename`` над файлами в одной транзакции.
+
+    Права проверяются одним запросом на весь пакет, результат возвращается по каждой операции.
+    """
+    operations = request.data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return Response({'error': 'Нужен непустой список operations'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(operations) > settings.STORAGE_BATCH_MAX_OPERATIONS:
+        return Response({'error': f'Не больше {settings.STORAGE_BATCH_MAX_OPERATIONS} операций за раз'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    ids = {op.get('id') for op in operations if isinstance(op, dict) and isinstance(op.get('id'), int)}
+    files = UserFile.objects.filter(pk__in=ids).only('id', 'user_id', 'comment', 'original_name').order_by()
+    if not request.user.is_administrator:
+        files = files.filter(user=request.user)
+    files = {file.pk: file for file in files}
+
+    results = []
+    changed = {}
+    to_delete = set()
+    for op in operations:
+        op = op if isinstance(op, dict) else {}
+        pk, action = op.get('id'), op.get('op')
+        result = {'id': pk, 'op': action}
+        results.append(result)
+
+        file = files.get(pk)
+        if file is None or pk in to_delete:
+            result['error'] = 'Файл не найден'
+        elif action == 'delete':
+            to_delete.add(pk)
+            changed.pop(pk, None)
+        elif action == 'comment' and isinstance(op.get('comment'), str):
+            file.comment = op['comment']
+            changed[pk] = file
+        elif action == 'rename' and isinstance(op.get('original_name'), str) and op['original_name'].strip():
+            file.original_name = op['original_name'].strip()[:255]
+            changed[pk] = file
+        else:
+            result['error'] = 'Неверные данные'
+        result['status'] = 'error' if 'error' in result else 'ok'
+
+    with transaction.atomic():
+        if changed:
+            UserFile.objects.bulk_update(changed.values(), ['comment', 'original_name'], batch_size=500)
+        if to_delete:
+            UserFile.objects.filter(pk__in=to_delete).delete_with_storage()
+
+    return Response({'results': results})
@@ -1,10 +1,23 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.forms import AdminPasswordChangeForm
 from .models import CustomUser
+from . import tokens
+
+
+class RevokingPasswordChangeForm(AdminPasswordChangeForm):
+    """Смена пароля в админке отзывает все выданные пользователю токены."""
+
+    def save(self, commit=True):
+        user = super().save(commit=commit)
+        if commit:
+            tokens.revoke(user)
+        return user
 
 
 @admin.register(CustomUser)
 class CustomUserAdmin(UserAdmin):
+    change_password_form = RevokingPasswordChangeForm
     list_display = ('username', 'email', 'full_name', 'is_administrator', 'is_staff', 'is_superuser', 'is_active')
     list_filter = ('is_administrator', 'is_staff', 'is_superuser', 'is_active')
     search_fields = ('username', 'email', 'full_name')
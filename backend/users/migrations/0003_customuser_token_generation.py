@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_customuser_storage_quota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='token_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 
@@ -7,6 +8,9 @@ class CustomUser(AbstractUser):
     full_name = models.CharField(max_length=255)
     storage_path = models.CharField(max_length=255, blank=True)
     is_administrator = models.BooleanField(default=False)
+    storage_quota = models.BigIntegerField(null=True, blank=True)
+    # Увеличение отзывает все выданные пользователю токены (users.tokens)
+    token_generation = models.PositiveIntegerField(default=0)
 
     def save(self, *args, **kwargs):
         if not self.storage_path:
@@ -15,3 +19,10 @@ class CustomUser(AbstractUser):
 
     def __str__(self):
         return self.username
+
+    @property
+    def quota(self):
+        """Квота в байтах: персональная или общая из настроек; ``None`` - без ограничений."""
+        if self.storage_quota is not None:
+            return self.storage_quota
+        return settings.STORAGE_DEFAULT_QUOTA
@@ -57,10 +57,13 @@ class UserSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = CustomUser
-        fields = ('id', 'username', 'email', 'full_name', 'is_administrator', 'files_count', 'total_size')
+        fields = ('id', 'username', 'email', 'full_name', 'is_administrator', 'files_count', 'total_size',
+                  'storage_quota')
 
     def get_files_count(self, obj):
-        return obj.files.count()
+        usage = getattr(obj, 'storage_usage', None)
+        return usage.files_count if usage else 0
 
     def get_total_size(self, obj):
-        return sum(file.size for file in obj.files.all())
+        usage = getattr(obj, 'storage_usage', None)
+        return usage.bytes_used if usage else 0
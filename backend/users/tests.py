@@ -1,3 +1,80 @@
-from django.test import TestCase
+from unittest import mock
+from django.contrib.auth.hashers import make_password
+from django.test import TestCase, override_settings
+from users.models import CustomUser
+from users import tokens
 
-# Create your tests here.
+
+class TokenTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='owner1', email='owner@example.com', password='Passw0rd!', full_name='Owner')
+        self.addCleanup(tokens.evict, self.user.pk)
+
+    def get(self, access_token):
+        return self.client.get('/api/storage/', HTTP_AUTHORIZATION=f'Bearer {access_token}')
+
+    def test_issue_verify_and_refresh(self):
+        pair = tokens.issue_tokens(self.user)
+        self.assertEqual(tokens.user_from_access(pair['access_token']).pk, self.user.pk)
+        self.assertEqual(self.get(pair['access_token']).status_code, 200)
+
+        response = self.client.post('/api/auth/token/refresh/', {'refresh_token': pair['refresh_token']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(response.json()['access_token']).status_code, 200)
+        # Refresh-токен не годится как access-токен и наоборот
+        with self.assertRaisesMessage(tokens.TokenError, 'Неверный токен'):
+            tokens.user_from_access(pair['refresh_token'])
+        with self.assertRaisesMessage(tokens.TokenError, 'Неверный токен'):
+            tokens.refresh_tokens(pair['access_token'])
+
+    def test_revoke(self):
+        pair = tokens.issue_tokens(self.user)
+        self.assertEqual(self.get(pair['access_token']).status_code, 200)
+        tokens.revoke(self.user)
+        response = self.get(pair['access_token'])
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['detail'], 'Токен отозван')
+        with self.assertRaisesMessage(tokens.TokenError, 'Токен отозван'):
+            tokens.refresh_tokens(pair['refresh_token'])
+        self.assertEqual(self.get(tokens.issue_tokens(self.user)['access_token']).status_code, 200)
+
+    def test_tampered_token(self):
+        access_token = tokens.issue_tokens(self.user)['access_token']
+        forged = access_token[:-1] + ('A' if access_token[-1] != 'A' else 'B')
+        with self.assertRaisesMessage(tokens.TokenError, 'Неверный токен'):
+            tokens.user_from_access(forged)
+        self.assertEqual(self.get(forged).status_code, 403)
+        self.assertEqual(self.get('not-a-token').status_code, 403)
+
+    @override_settings(AUTH_ACCESS_TOKEN_TTL=60)
+    def test_expiry(self):
+        with mock.patch('django.core.signing.time.time', return_value=1_000_000):
+            pair = tokens.issue_tokens(self.user)
+        with mock.patch('django.core.signing.time.time', return_value=1_000_000 + 61):
+            with self.assertRaisesMessage(tokens.TokenError, 'Срок действия токена истек'):
+                tokens.user_from_access(pair['access_token'])
+            # Refresh-токен живет дольше access-токена
+            self.assertIn('access_token', tokens.refresh_tokens(pair['refresh_token']))
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.PBKDF2PasswordHasher',
+                                         'django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_login_with_hash_upgrade_keeps_tokens_valid(self):
+        CustomUser.objects.filter(pk=self.user.pk).update(password=make_password('Passw0rd!', hasher='md5'))
+        response = self.client.post('/api/auth/login/', {'username': 'owner1', 'password': 'Passw0rd!',
+                                                         'session': False}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(CustomUser.objects.get(pk=self.user.pk).password.startswith('pbkdf2_sha256$'))
+        self.assertEqual(self.get(response.json()['access_token']).status_code, 200)
+
+    def test_admin_password_change_revokes(self):
+        access_token = tokens.issue_tokens(self.user)['access_token']
+        admin = CustomUser.objects.create_superuser(
+            username='admin1', email='admin@example.com', password='Passw0rd!', full_name='Admin')
+        self.client.force_login(admin)
+        response = self.client.post(f'/admin/users/customuser/{self.user.pk}/password/',
+                                    {'password1': 'N3wPassw0rd!', 'password2': 'N3wPassw0rd!'})
+        self.assertEqual(response.status_code, 302)
+        self.client.logout()
+        self.assertEqual(self.get(access_token).status_code, 403)
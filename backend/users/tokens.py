@@ -0,0 +1,118 @@
+"""Подписанные токены доступа, которые не хранятся на сервере.
+
+Токен - строка ``django.core.signing`` (HMAC-SHA256 на SECRET_KEY) с id
+пользователя и его ``token_generation``; срок жизни проверяется по метке
+времени подписи. Увеличение ``CustomUser.token_generation`` отзывает все
+выданные пользователю токены: это делают ``revoke`` при выходе и смена
+пароля в админке. Обновление хэша пароля при входе токены не отзывает.
+
+Пользователи держатся в памяти процесса AUTH_TOKEN_USER_CACHE_TTL секунд,
+поэтому большинство запросов с access-токеном проходят без обращений к БД.
+Изменения пользователя в этом процессе сбрасывают кэш сразу, в остальных
+процессах - не позже чем через TTL. Refresh-токен всегда проверяется по БД.
+"""
+import copy
+import threading
+import time
+from django.conf import settings
+from django.core import signing
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from .models import CustomUser
+
+ACCESS_SALT = 'users.tokens.access'
+REFRESH_SALT = 'users.tokens.refresh'
+
+# Больше пользователей в кэше процесса не держим
+USER_CACHE_MAX_SIZE = 10000
+
+# user_id -> (пользователь, момент устаревания по time.monotonic())
+_users = {}
+_lock = threading.Lock()
+
+
+class TokenError(Exception):
+    pass
+
+
+def issue_tokens(user):
+    payload = [user.pk, user.token_generation]
+    return {
+        'access_token': signing.dumps(payload, salt=ACCESS_SALT),
+        'refresh_token': signing.dumps(payload, salt=REFRESH_SALT),
+        'expires_in': settings.AUTH_ACCESS_TOKEN_TTL,
+    }
+
+
+def _load(token, salt, max_age):
+    try:
+        user_id, generation = signing.loads(token, salt=salt, max_age=max_age)
+    except signing.SignatureExpired:
+        raise TokenError('Срок действия токена истек')
+    except (signing.BadSignature, TypeError, ValueError):
+        raise TokenError('Неверный токен')
+    return user_id, generation
+
+
+def _check(user, generation):
+    if user is None or not user.is_active or user.token_generation != generation:
+        raise TokenError('Токен отозван')
+    return user
+
+
+def user_from_access(token):
+    """Пользователь по access-токену; при ошибке - ``TokenError``."""
+    user_id, generation = _load(token, ACCESS_SALT, settings.AUTH_ACCESS_TOKEN_TTL)
+    return _check(get_cached_user(user_id), generation)
+
+
+def refresh_tokens(token):
+    """Новая пара токенов по refresh-токену; пользователь читается из БД, а не из кэша."""
+    user_id, generation = _load(token, REFRESH_SALT, settings.AUTH_REFRESH_TOKEN_TTL)
+    user = _check(CustomUser.objects.filter(pk=user_id).first(), generation)
+    _remember(user)
+    return issue_tokens(user)
+
+
+def revoke(user):
+    """Отзывает все токены пользователя."""
+    CustomUser.objects.filter(pk=user.pk).update(token_generation=F('token_generation') + 1)
+    user.refresh_from_db(fields=['token_generation'])
+    evict(user.pk)
+
+
+def get_cached_user(user_id):
+    now = time.monotonic()
+    with _lock:
+        entry = _users.get(user_id)
+    if entry and entry[1] > now:
+        # Копия: запросы в разных потоках не делят один объект
+        return copy.copy(entry[0])
+    user = CustomUser.objects.filter(pk=user_id).first()
+    if user is not None:
+        _remember(user)
+    return user
+
+
+def _remember(user):
+    now = time.monotonic()
+    with _lock:
+        if len(_users) >= USER_CACHE_MAX_SIZE:
+            for user_id in [pk for pk, (_, expires) in _users.items() if expires <= now]:
+                del _users[user_id]
+            if len(_users) >= USER_CACHE_MAX_SIZE:
+                _users.clear()
+        _users[user.pk] = (copy.copy(user), now + settings.AUTH_TOKEN_USER_CACHE_TTL)
+
+
+def evict(user_id):
+    with _lock:
+        _users.pop(user_id, None)
+
+
+def _evict_saved(sender, instance, **kwargs):
+    evict(instance.pk)
+
+
+post_save.connect(_evict_saved, sender=CustomUser, dispatch_uid='users.tokens.evict_saved')
+post_delete.connect(_evict_saved, sender=CustomUser, dispatch_uid='users.tokens.evict_deleted')
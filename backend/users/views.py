@@ -3,7 +3,9 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth import authenticate, login, logout
+from django.db import transaction
 from .models import CustomUser
+from . import tokens
 from .serializers import UserRegistrationSerializer, UserLoginSerializer, UserSerializer
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
@@ -41,7 +43,9 @@ def login_view(request):
         user = authenticate(request, username=username, password=password)
 
         if user is not None:
-            login(request, user)
+            # Клиенты с токенами могут отказаться от сессии: "session": false
+            if request.data.get('session', True) is not False:
+                login(request, user)
             print(f"User {username} authenticated successfully. Session: {request.session.session_key}")
 
             return Response({
@@ -53,7 +57,8 @@ def login_view(request):
                     'email': user.email,
                     'full_name': user.full_name,
                     'is_administrator': user.is_administrator
-                }
+                },
+                **tokens.issue_tokens(user),
             })
         else:
             print(f"Authentication FAILED for user: {username}")
@@ -70,9 +75,24 @@ def login_view(request):
     }, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def token_refresh(request):
+    refresh_token = request.data.get('refresh_token')
+    if not isinstance(refresh_token, str) or not refresh_token:
+        return Response({'error': 'Не указан refresh_token'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        return Response(tokens.refresh_tokens(refresh_token))
+    except tokens.TokenError as e:
+        return Response({'error': str(e)}, status=status.HTTP_401_UNAUTHORIZED)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def logout_view(request):
+    # Выход отзывает и все выданные пользователю токены
+    tokens.revoke(request.user)
     logout(request)
     return Response({'message': 'Выход выполнен успешно'})
 
@@ -80,7 +100,7 @@ def logout_view(request):
 @api_view(['GET'])
 @permission_classes([IsAdminUser])
 def user_list(request):
-    users = CustomUser.objects.all()
+    users = CustomUser.objects.select_related('storage_usage')
     serializer = UserSerializer(users, many=True)
     return Response(serializer.data)
 
@@ -89,7 +109,7 @@ def user_list(request):
 @permission_classes([IsAdminUser])
 def user_detail(request, pk):
     try:
-        user = CustomUser.objects.get(pk=pk)
+        user = CustomUser.objects.select_related('storage_usage').get(pk=pk)
     except CustomUser.DoesNotExist:
         return Response({'error': 'Пользователь не найден'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -97,7 +117,9 @@ def user_detail(request, pk):
         serializer = UserSerializer(user)
         return Response(serializer.data)
     elif request.method == 'DELETE':
-        user.delete()
+        with transaction.atomic():
+            user.files.all().delete_with_storage()
+            user.delete()
         return Response({'message': 'Пользователь удален'})
     elif request.method == 'PATCH':
         is_admin = request.data.get('is_administrator')
@@ -105,4 +127,12 @@ def user_detail(request, pk):
             user.is_administrator = is_admin
             user.save()
             return Response({'message': 'Статус обновлен'})
+        if 'storage_quota' in request.data:
+            quota = request.data['storage_quota']
+            if quota is not None and (not isinstance(quota, int) or isinstance(quota, bool) or quota < 0):
+                return Response({'error': 'Квота должна быть неотрицательным целым числом'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            user.storage_quota = quota
+            user.save(update_fields=['storage_quota'])
+            return Response({'message': 'Квота обновлена'})
         return Response({'error': 'Неверные данные'}, status=status.HTTP_400_BAD_REQUEST)
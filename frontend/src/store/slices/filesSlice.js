@@ -21,17 +21,25 @@ export const fetchFiles = createAsyncThunk(
   'files/fetchFiles',
   async (userId = null, { rejectWithValue }) => {
     try {
-      const url = userId ? `/api/storage/?user_id=${userId}` : '/api/storage/';
-      const response = await fetch(url, {
-        credentials: 'include',
-      });
+      // Список отдается страницами, следующая страница - в заголовке Link
+      let url = userId ? `/api/storage/?user_id=${userId}` : '/api/storage/';
+      const files = [];
+      while (url) {
+        const response = await fetch(url, {
+          credentials: 'include',
+        });
 
-      if (!response.ok) {
-        const error = await response.json();
-        return rejectWithValue(error);
+        if (!response.ok) {
+          const error = await response.json();
+          return rejectWithValue(error);
+        }
+
+        files.push(...(await response.json()));
+        const next = (response.headers.get('Link') || '').match(/<([^>]+)>;\s*rel="next"/);
+        url = next ? next[1] : null;
       }
 
-      return await response.json();
+      return files;
     } catch (error) {
       return rejectWithValue(error.message);
     }
@@ -1,45 +1,73 @@
 const path = require('path');
+const zlib = require('zlib');
 const HtmlWebpackPlugin = require('html-webpack-plugin');
+const CompressionPlugin = require('compression-webpack-plugin');
 
-module.exports = {
-  entry: './src/index.js',
-  output: {
-    path: path.resolve(__dirname, 'dist'),
-    filename: 'bundle.js',
-    publicPath: '/'
-  },
-  module: {
-    rules: [
-      {
-        test: /\.(js|jsx)$/,
-        exclude: /node_modules/,
-        use: {
-          loader: 'babel-loader'
+// Ассеты, которые сжимаем заранее: WhiteNoise/nginx отдают готовые .br и .gz без сжатия на лету
+const COMPRESSIBLE = /\.(js|css|svg|json|txt|map)$/;
+
+module.exports = (env, argv) => {
+  const production = argv.mode === 'production';
+
+  return {
+    entry: './src/index.js',
+    output: {
+      path: path.resolve(__dirname, 'dist'),
+      // Хеш содержимого в имени: такие файлы кешируются как immutable (WHITENOISE_IMMUTABLE_FILE_TEST)
+      filename: production ? '[name].[contenthash:12].js' : 'bundle.js',
+      // collectstatic кладет dist в STATIC_ROOT, и в продакшене ассеты отдаются из /static/
+      publicPath: production ? '/static/' : '/',
+      clean: true
+    },
+    module: {
+      rules: [
+        {
+          test: /\.(js|jsx)$/,
+          exclude: /node_modules/,
+          use: {
+            loader: 'babel-loader'
+          }
+        },
+        {
+          test: /\.css$/,
+          use: ['style-loader', 'css-loader']
+        }
+      ]
+    },
+    resolve: {
+      extensions: ['.js', '.jsx']
+    },
+    plugins: [
+      new HtmlWebpackPlugin({
+        template: './public/index.html'
+      }),
+      ...(production ? [
+        new CompressionPlugin({
+          filename: '[path][base].gz',
+          algorithm: 'gzip',
+          compressionOptions: { level: 9 },
+          test: COMPRESSIBLE,
+          threshold: 1024
+        }),
+        new CompressionPlugin({
+          filename: '[path][base].br',
+          algorithm: 'brotliCompress',
+          compressionOptions: { params: { [zlib.constants.BROTLI_PARAM_QUALITY]: 11 } },
+          test: COMPRESSIBLE,
+          threshold: 1024
+        })
+      ] : [])
+    ],
+    devServer: {
+      historyApiFallback: true,
+      port: 3000,
+      hot: true,
+      proxy: {
+        '/api': {
+          target: 'http://localhost:8000',
+          changeOrigin: true
         }
-      },
-      {
-        test: /\.css$/,
-        use: ['style-loader', 'css-loader']
-      }
-    ]
-  },
-  resolve: {
-    extensions: ['.js', '.jsx']
-  },
-  plugins: [
-    new HtmlWebpackPlugin({
-      template: './public/index.html'
-    })
-  ],
-  devServer: {
-    historyApiFallback: true,
-    port: 3000,
-    hot: true,
-    proxy: {
-      '/api': {
-        target: 'http://localhost:8000',
-        changeOrigin: true
       }
     }
-  }
-};
\ No newline at end of file
+  };
+};